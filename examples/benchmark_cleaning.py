@@ -0,0 +1,90 @@
+"""
+Scaling check of the Sensors/Geography cleaning stages (delimit_data_by_threshold,
+delimit_sensors_by_osm_quantile and delimit_meshgrid_by_quantiles) on synthetic
+hourly data, up to 10k sensors x 1 year. For the small sizes, the results of
+delimit_data_by_threshold are checked against the former loop implementation.
+Usage: python benchmark_cleaning.py [max_sensors] [max_hours]
+"""
+import sys
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+import sensingbee.source as sb
+
+
+def synthetic_sensors(n_sensors, n_hours, variables=('NO2','Temperature'), seed=0):
+    rng = np.random.RandomState(seed)
+    lon, lat = rng.uniform(-1.8, -1.51, n_sensors), rng.uniform(54.96, 55.05, n_sensors)
+    S = sb.Sensors.__new__(sb.Sensors)
+    names = pd.Index(['sensor_{}'.format(i) for i in range(n_sensors)], name='Sensor Name')
+    S.sensors = gpd.GeoDataFrame({'lon':lon, 'lat':lat}, index=names,
+                                 geometry=[shapely.geometry.Point(xy) for xy in zip(lon, lat)])
+    times = pd.date_range('2018-01-01', periods=n_hours, freq='h')
+    n = n_sensors*n_hours
+    codes = [np.repeat(np.arange(len(variables), dtype=np.int8), n),
+             np.tile(np.repeat(np.arange(n_sensors, dtype=np.int32), n_hours), len(variables)),
+             np.tile(np.arange(n_hours, dtype=np.int32), n_sensors*len(variables))]
+    index = pd.MultiIndex(levels=[list(variables), names, times], codes=codes,
+                          names=['Variable','Sensor Name','Timestamp'], verify_integrity=False)
+    offsets = rng.normal(0, 15, (len(variables), n_sensors, 1)) # some sensors are off
+    values = (rng.gamma(4., 10., (len(variables), n_sensors, n_hours)) + offsets).astype(float).ravel()
+    S.data = pd.DataFrame({'Value': values}, index=index)
+    return S
+
+def synthetic_geography(n_cells, seed=0):
+    rng = np.random.RandomState(seed)
+    G = sb.Geography.__new__(sb.Geography)
+    G.lines = gpd.GeoDataFrame({'highway': ['primary']*50},
+                               geometry=[shapely.geometry.LineString(rng.uniform([-1.8,54.96], [-1.51,55.05], (4,2))) for _ in range(50)])
+    G.points = gpd.GeoDataFrame({'highway': ['traffic_signals']*200},
+                                geometry=[shapely.geometry.Point(p) for p in rng.uniform([-1.8,54.96], [-1.51,55.05], (200,2))])
+    lon, lat = rng.uniform(-1.8, -1.51, n_cells), rng.uniform(54.96, 55.05, n_cells)
+    G.meshgrid = gpd.GeoDataFrame({'lon':lon, 'lat':lat}, geometry=[shapely.geometry.Point(xy) for xy in zip(lon, lat)])
+    return G
+
+# The former implementation, for checking the results.
+def reference_delimit_data_by_threshold(S, t_dict):
+    off, S.dropped_sensors, S.dropped_data = {}, {}, {}
+    for var, threshold in t_dict.items():
+        D = S.data.loc[var]['Value']
+        off[var] = []
+        for i,si in enumerate(D.index.get_level_values(0).unique()):
+            if D.loc[si].mean() > threshold:
+                off[var].append((var,si))
+        S.dropped_sensors[var] = len(off[var])/i
+        S.dropped_data[var] = 1 - (S.data.drop(off[var]).loc[var].shape[0]/S.data.loc[var].shape[0])
+        S.data = S.data.drop(off[var])
+    return S
+
+
+if __name__ == '__main__':
+    max_sensors = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    max_hours = int(sys.argv[2]) if len(sys.argv) > 2 else 8760
+    thresholds = {'NO2': 50, 'Temperature': 55}
+    osm_args = {'line_objs': ['primary'], 'point_objs': ['traffic_signals']}
+    print('{:>8} {:>6} {:>12} {:>11} {:>11} {:>10} {:>11}'.format('sensors','hours','rows','threshold','reference','osm (s)','mesh (s)'))
+    for n_sensors, n_hours in [(100, 24*7), (1000, 24*30), (max_sensors, max_hours)]:
+        S = synthetic_sensors(n_sensors, n_hours, variables=('NO2',) if n_sensors*n_hours > 1e7 else ('NO2','Temperature'))
+        rows = len(S.data)
+        reference = '-'
+        if rows <= 2e6:
+            R = synthetic_sensors(n_sensors, n_hours)
+            t0 = time.time()
+            reference_delimit_data_by_threshold(R, thresholds)
+            reference = '{:.2f}'.format(time.time()-t0)
+        t0 = time.time()
+        S.delimit_data_by_threshold(thresholds)
+        t_threshold = time.time()-t0
+        if rows <= 2e6:
+            assert S.data.equals(R.data) and all(np.isclose(S.dropped_data[v], R.dropped_data[v]) for v in thresholds)
+        G = synthetic_geography(n_sensors)
+        t0 = time.time()
+        S.delimit_sensors_by_osm_quantile(dict(Geography=G, **osm_args))
+        t_osm = time.time()-t0
+        t0 = time.time()
+        G.delimit_meshgrid_by_quantiles(dict(Geography=G, input_pointdf=G.meshgrid, **osm_args))
+        t_mesh = time.time()-t0
+        print('{:>8} {:>6} {:>12} {:>11.2f} {:>11} {:>10.2f} {:>11.2f}'.format(n_sensors, n_hours, rows, t_threshold, reference, t_osm, t_mesh))
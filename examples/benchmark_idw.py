@@ -0,0 +1,76 @@
+"""
+Benchmark of accuracy against latency of the training-free IDW models (see
+sensingbee.idw) and the trained gradient boosting and random forest ones, on a
+synthetic dataset (see sensingbee.synthetic). For each model, the 10-fold CV r2
+and mse on the training features (the neighbours' channels leave the sensor
+itself out, so the IDW scores are out of sample too), the seconds to get it
+ready (the CV fit; none for Bee.idw) and the milliseconds to predict the
+meshgrid at one timestamp and at all of them are printed. The Bee.idw surfaces of
+the variables with a dotted name (e.g. PM2.5) are checked against the IDW of their
+own meshgrid channels.
+Usage: python benchmark_idw.py [--sensors 100] [--days 30] [--mesh 100]
+       [--variable NO2] [--repeat 5]
+"""
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+
+import sensingbee.source as sb
+from sensingbee import synthetic
+from sensingbee.idw import IDWRegressor, idw
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sensors', type=int, default=100)
+parser.add_argument('--days', type=int, default=30)
+parser.add_argument('--mesh', type=int, default=100)
+parser.add_argument('--variable', default='NO2')
+parser.add_argument('--repeat', type=int, default=5)
+args = parser.parse_args()
+
+configuration__ = synthetic.make_dataset(tempfile.mkdtemp(prefix='sensingbee_'), n_sensors=args.sensors, days=args.days,
+                                         mesh_dimensions=(args.mesh, args.mesh))
+bee = sb.Bee(configuration__).fit(mode='make')
+var = args.variable
+X_mesh = bee.features.mesh_ingestion(bee.sensors, bee.geography, configuration__['Sensors__variables'], timestamp='*')
+# the models are fitted on the features that the meshgrid also has
+train = bee.features.get_train_features(var)
+names = [c for c in pd.unique(pd.Series(X_mesh.columns)) if c in train['X'].columns]
+t = X_mesh.index.get_level_values(0)[0]
+cells = bee.geography.meshgrid.loc[X_mesh.index.get_level_values(1)]
+points = pd.DataFrame({'lat': cells['lat'].values, 'lon': cells['lon'].values}, index=X_mesh.index)
+
+candidates = [('idw p=1', IDWRegressor(var, power=1)), ('idw p=2', IDWRegressor(var, power=2)),
+              ('idw p=3', IDWRegressor(var, power=3)), ('nearest', IDWRegressor(var, k=1)),
+              ('gb', sb.default_regressor()),
+              ('rf', RandomForestRegressor(n_estimators=200, max_depth=5, max_features=0.5))]
+results = []
+for label, regressor in candidates:
+    t0 = time.perf_counter()
+    model = sb.Model(regressor, random_state=0).fit(train['X'][names], train['y'])
+    fit_s = time.perf_counter() - t0
+    latency = {}
+    for scope, X, at in [('one', X_mesh.loc[[t]], points.loc[[t]]), ('all', X_mesh, points)]:
+        seconds = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            model.predict_points(X, at)
+            seconds.append(time.perf_counter() - t0)
+        latency[scope] = 1000*np.median(seconds)
+    results.append({'model': label, 'r2': model.r2, 'r2_std': model.r2_std, 'mse': model.mse,
+                    'ready_s': 0 if isinstance(regressor, IDWRegressor) else fit_s, 'cv_s': fit_s,
+                    'predict_one_ms': latency['one'], 'predict_all_ms': latency['all']})
+print('{} cells x {} timestamps'.format(len(bee.geography.meshgrid), len(X_mesh.index.levels[0])))
+print(pd.DataFrame(results).set_index('model').round(4).to_string())
+
+t0 = time.perf_counter()
+bee.idw([var]).interpolate([var], timestamp='*')
+print('Bee.idw + Bee.interpolate of all the timestamps (with mesh ingestion): {:.3f} seconds'.format(time.perf_counter()-t0))
+
+for v in [v for v in configuration__['Sensors__variables'] if '.' in v]:
+    bee.idw([v]).interpolate([v], timestamp='*')
+    expected = idw(X_mesh[v].values, X_mesh['d_'+v].values)
+    assert np.allclose(bee.z[v]['pred'].values, expected, equal_nan=True), 'Bee.idw of {} is not the IDW of its channels'.format(v)
+    print('Bee.idw of {} matches the IDW of its meshgrid channels'.format(v))
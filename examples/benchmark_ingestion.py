@@ -0,0 +1,56 @@
+"""
+Benchmark of the training features ingestion: utils.ingestion3 (reference)
+against utils.knn_ingestion, on synthetic sensors as their number and the
+number of timestamps grow. For every size where the reference runs, both
+outputs are checked to be the same.
+"""
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+import sensingbee.utils as utils
+
+
+class SyntheticSensors(object):
+    def __init__(self, n_sensors, n_times, variables=('NO2','Temperature'), availability=0.85, seed=0):
+        rng = np.random.RandomState(seed)
+        lon = rng.uniform(-1.8, -1.51, n_sensors)
+        lat = rng.uniform(54.96, 55.05, n_sensors)
+        names = ['sensor_{}'.format(i) for i in range(n_sensors)]
+        self.sensors = gpd.GeoDataFrame({'lon':lon, 'lat':lat}, index=pd.Index(names, name='name'),
+                                        geometry=[shapely.geometry.Point(xy) for xy in zip(lon, lat)])
+        times = pd.date_range('2018-01-01', periods=n_times, freq='D')
+        index = pd.MultiIndex.from_product([list(variables), names, times],
+                                           names=['Variable','Sensor Name','Timestamp'])
+        self.data = pd.DataFrame({'Value': rng.gamma(4., 10., len(index))}, index=index)
+        self.data = self.data.loc[rng.uniform(size=len(index)) < availability]
+
+
+# The k neighbours are compared within each channel block, as the order in which
+# the reference lays them out depends on the pandas version.
+def same_features(a, b):
+    a, b = a.astype(float), b.astype(float)
+    if not a.index.equals(b.index) or list(a.columns) != list(b.columns):
+        return False
+    return np.allclose(np.sort(a.values.reshape(len(a), -1, 5), axis=2),
+                       np.sort(b.values.reshape(len(b), -1, 5), axis=2), equal_nan=True)
+
+
+if __name__ == '__main__':
+    variables = ['NO2','Temperature']
+    print('{:>8} {:>8} {:>14} {:>14} {:>9} {:>6}'.format('sensors','times','ingestion3 (s)','knn (s)','speedup','same'))
+    for n_sensors, n_times in [(10,5), (20,10), (40,20), (80,30), (200,90), (1000,365), (2000,2000)]:
+        S = SyntheticSensors(n_sensors, n_times, variables)
+        t0 = time.time()
+        zx, zi = utils.knn_ingestion(S, variables, k=5, freq=None)
+        t_knn = time.time() - t0
+        if n_sensors*n_times <= 2400: # the reference takes too long beyond that
+            t0 = time.time()
+            zx3, zi3 = utils.ingestion3(S, variables, k=5, freq=None)
+            t_ref = time.time() - t0
+            same = same_features(zx3, zx) and zi3.index.equals(zi.index)
+            print('{:>8} {:>8} {:>14.2f} {:>14.3f} {:>8.0f}x {:>6}'.format(n_sensors, n_times, t_ref, t_knn, t_ref/t_knn, str(same)))
+        else:
+            print('{:>8} {:>8} {:>14} {:>14.3f} {:>9} {:>6}'.format(n_sensors, n_times, '-', t_knn, '-', '-'))
@@ -0,0 +1,184 @@
+"""
+Benchmark suite of the whole Bee pipeline on a synthetic dataset (see
+sensingbee.synthetic): each stage (Geography, Sensors, ingestion3 and
+knn_ingestion, make_osm_features, Model.fit, mesh_ingestion and Bee.interpolate)
+is timed and its peak memory (resident set growth, sampled) measured. Every run
+is appended as a JSON line to the results file, with the scale, the commit and
+the libraries' versions, and compared with the last run at the same scale found
+there, so that regressions show up between versions. A stage that fails is
+recorded with its error and the suite goes on, recording the stages that depend
+on it as skipped. With --store compact, the
+sensors' data is kept in the compact store (see sensingbee.sensorstore).
+Usage: python benchmark_pipeline.py [--sensors 50] [--days 30] [--sampling 15min]
+       [--frequency D] [--mesh 50] [--store frame] [--results benchmark_results.jsonl]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.ensemble import GradientBoostingRegressor
+
+import sensingbee.source as sb
+import sensingbee.utils as utils
+from sensingbee import synthetic
+
+
+# Resident set size of the process in bytes (None where /proc is not available).
+def rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+class Stage(object):
+    """
+    Times a block and samples the process' RSS every `interval` seconds meanwhile,
+    keeping the peak growth over the RSS at the start.
+    """
+    def __init__(self, results, name, interval=0.01):
+        self.results, self.name, self.interval = results, name, interval
+
+    def __enter__(self):
+        self.start_rss = self.peak_rss = rss()
+        self.running = True
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+        self.t0 = time.perf_counter()
+        return self
+
+    def sample(self):
+        while self.running and self.start_rss is not None:
+            self.peak_rss = max(self.peak_rss, rss())
+            time.sleep(self.interval)
+
+    def __exit__(self, kind, error, traceback):
+        seconds = time.perf_counter() - self.t0
+        self.running = False
+        self.sampler.join()
+        entry = {'seconds': round(seconds, 4)}
+        if self.start_rss is not None:
+            entry['peak_mb'] = round((max(self.peak_rss, rss()) - self.start_rss)/2**20, 2)
+        if error is not None:
+            entry['error'] = '{}: {}'.format(kind.__name__, error)
+        self.results[self.name] = entry
+        print('{:<18} {:>10.3f} s {:>10} MB {}'.format(self.name, seconds, entry.get('peak_mb', '-'), entry.get('error', '')))
+        return True # the suite goes on, the stages that depend on this one check it (see requires)
+
+
+# Whether the stages that a stage depends on ran without errors. If not, the stage is
+# recorded as skipped, instead of failing on what they should have made.
+def requires(stages, name, *dependencies):
+    failed = [d for d in dependencies if 'seconds' not in stages.get(d, {}) or 'error' in stages[d]]
+    if failed:
+        stages[name] = {'skipped': 'requires {}'.format(', '.join(failed))}
+        print('{:<18} {:>12} {:>13} {}'.format(name, '-', '-', stages[name]['skipped']))
+    return not failed
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(sb.__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(scale, folder):
+    configuration__ = synthetic.make_dataset(folder, n_sensors=scale['sensors'], days=scale['days'], sampling=scale['sampling'],
+                                             frequency=scale['frequency'], mesh_dimensions=(scale['mesh'], scale['mesh']))
+    configuration__['Sensors__store'] = scale.get('store', 'frame')
+    variables, var = configuration__['Sensors__variables'], configuration__['Sensors__variables'][0]
+    stages = {}
+    with Stage(stages, 'Geography'):
+        geography = sb.Geography(configuration__, mode='make')
+    if requires(stages, 'Sensors', 'Geography'):
+        with Stage(stages, 'Sensors'):
+            sensors = sb.Sensors(configuration__, 'make', configuration__['DATA_FOLDER'], delimit_geography=geography, delimit_quantiles=True)
+    if requires(stages, 'make_osm_features', 'Geography', 'Sensors'):
+        with Stage(stages, 'make_osm_features'):
+            osmf = sb.Features({}, mode=None).make_osm_features(geography, sensors.sensors, configuration__['osm_line_objs'], configuration__['osm_point_objs'])
+    if requires(stages, 'pull_depr_sensors', 'Sensors'):
+        with Stage(stages, 'pull_depr_sensors'):
+            deprf = utils.pull_depr_sensors(sensors, configuration__['LSOA_PATH'], configuration__['DEPRIVATION_PATH'])
+    if requires(stages, 'ingestion3', 'make_osm_features', 'pull_depr_sensors'):
+        with Stage(stages, 'ingestion3'):
+            utils.ingestion3(sensors, variables, k=5, osmf=osmf, deprf=deprf, freq=scale['frequency'])
+    features = sb.Features({}, mode=None)
+    if requires(stages, 'knn_ingestion', 'make_osm_features', 'pull_depr_sensors'):
+        with Stage(stages, 'knn_ingestion'):
+            features.zx, features.zi = utils.knn_ingestion(sensors, variables, k=5, osmf=osmf, deprf=deprf, freq=scale['frequency'])
+            features.zx = features.zx.dropna()
+    features.frequency = scale['frequency']
+    if requires(stages, 'mesh_ingestion', 'Geography', 'Sensors'):
+        with Stage(stages, 'mesh_ingestion'):
+            X_mesh = features.mesh_ingestion(sensors, geography, variables)
+    if requires(stages, 'Model.fit', 'knn_ingestion', 'mesh_ingestion'):
+        # the model is fitted on the features that the meshgrid also has
+        train = features.get_train_features(var)
+        names = [c for c in pd.unique(pd.Series(X_mesh.columns)) if c in train['X'].columns]
+        model = sb.Model(GradientBoostingRegressor(n_estimators=100, max_depth=5), random_state=0)
+        with Stage(stages, 'Model.fit'):
+            model.fit(train['X'][names], train['y'])
+    if requires(stages, 'Bee.interpolate', 'Model.fit'):
+        bee = sb.Bee(configuration__)
+        bee.geography, bee.sensors, bee.features = geography, sensors, features
+        bee.models, bee.multiregressors = {var: model}, False
+        with Stage(stages, 'Bee.interpolate'):
+            bee.interpolate([var], timestamp='*')
+    return stages
+
+# The last run in the results file at the same scale, if any.
+def previous(path, scale):
+    last = None
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                if record['scale'] == scale:
+                    last = record
+    return last
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sensors', type=int, default=50)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--sampling', default='15min')
+    parser.add_argument('--frequency', default='D')
+    parser.add_argument('--mesh', type=int, default=50)
+    parser.add_argument('--store', default='frame', choices=['frame', 'compact'])
+    parser.add_argument('--results', default='benchmark_results.jsonl')
+    args = parser.parse_args()
+    scale = {'sensors': args.sensors, 'days': args.days, 'sampling': args.sampling, 'frequency': args.frequency, 'mesh': args.mesh}
+    if args.store != 'frame':
+        scale['store'] = args.store
+    folder = tempfile.mkdtemp(prefix='sensingbee_benchmark_')
+    try:
+        print('{:<18} {:>12} {:>13}'.format('stage', 'time', 'peak memory'))
+        stages = run(scale, folder)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    record = {'date': pd.Timestamp.now().isoformat(), 'commit': commit(), 'scale': scale, 'stages': stages,
+              'versions': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                           'sklearn': sklearn.__version__}}
+    last = previous(args.results, scale)
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    if last is not None:
+        print('\ncompared with {} (commit {}):'.format(last['date'], last['commit']))
+        for name, entry in stages.items():
+            before = last['stages'].get(name, {})
+            if 'seconds' not in entry or 'seconds' not in before or 'error' in entry or 'error' in before:
+                continue
+            print('{:<18} {:>8.2f}x time {:>8}'.format(name, entry['seconds']/max(before['seconds'], 1e-9),
+                  '' if 'peak_mb' not in entry or 'peak_mb' not in before else '{:+.1f} MB'.format(entry['peak_mb']-before['peak_mb'])))
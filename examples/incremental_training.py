@@ -0,0 +1,73 @@
+"""
+Simulates a nightly training job on a synthetic dataset (see sensingbee.synthetic):
+the models are trained on the first days of features, then every night a day more
+of them arrives, and the models are either trained again on the whole history
+(Bee.train) or updated with it (Bee.update, with a sliding window and a full CV
+fit every --cv-every nights). The seconds each night takes and the r2 of the
+models on the next day's features are printed for both. At the end, the update is
+run again on the same features, which has nothing new to fold in and must leave
+the model as it is.
+Usage: python incremental_training.py [--sensors 100] [--days 60] [--initial 30]
+       [--window 14] [--cv-every 7]
+"""
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import GradientBoostingRegressor
+from sklearn.metrics import r2_score
+
+import sensingbee.source as sb
+import sensingbee.utils as utils
+from sensingbee import synthetic
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sensors', type=int, default=100)
+parser.add_argument('--days', type=int, default=60)
+parser.add_argument('--initial', type=int, default=30)
+parser.add_argument('--window', type=int, default=14)
+parser.add_argument('--cv-every', type=int, default=7)
+parser.add_argument('--variable', default='NO2')
+args = parser.parse_args()
+
+configuration__ = synthetic.make_dataset(tempfile.mkdtemp(prefix='sensingbee_'), n_sensors=args.sensors, days=args.days)
+full, incremental = sb.Bee(configuration__).fit(mode='make'), sb.Bee(configuration__)
+incremental.features = full.features
+train = full.features.get_train_features(args.variable)
+days = train['X'].index.get_level_values('Timestamp').unique().sort_values()
+regressor = GradientBoostingRegressor(n_estimators=100, max_depth=5, max_features=0.5)
+
+def until(day):
+    rows = np.asarray(train['X'].index.get_level_values('Timestamp') <= day)
+    return train['X'][rows], train['y'][rows]
+
+X, y = until(days[args.initial-1])
+full.train([args.variable], regressor, X=X, y=y, random_state=0)
+incremental.train([args.variable], regressor, X=X, y=y, random_state=0)
+results = []
+for night in range(args.initial, len(days)-1):
+    X, y = until(days[night])
+    rows = utils.recent_rows(train['X'].index, 1, days[night])
+    X_next, y_next = train['X'][rows], train['y'][rows]
+    t0 = time.perf_counter()
+    full.train([args.variable], regressor, X=X, y=y, random_state=0)
+    t1 = time.perf_counter()
+    incremental.update([args.variable], window=args.window, cv_every=args.cv_every, tolerance=0.2, X=X, y=y, random_state=0)
+    t2 = time.perf_counter()
+    model = incremental.models[args.variable]
+    results.append({'night': str(days[night].date()), 'rows': len(X), 'full_s': t1-t0, 'update_s': t2-t1,
+                    'full_r2': r2_score(y_next.values.ravel(), full.models[args.variable].regressor.predict(full.models[args.variable].transform(X_next))),
+                    'update_r2': r2_score(y_next.values.ravel(), model.regressor.predict(model.transform(X_next))),
+                    'holdout_r2': model.holdout_r2, 'updates': model.updates})
+results = pd.DataFrame(results).set_index('night')
+print(results.round(3).to_string())
+print(results[['full_s','update_s','full_r2','update_r2']].mean().round(3).to_string())
+
+model = incremental.models[args.variable]
+state = (model.regressor, model.updates, model.timestamp, model.holdout_r2)
+incremental.update([args.variable], window=args.window, tolerance=0.2, X=X, y=y, random_state=0)
+model.update(X.iloc[:0], y.iloc[:0])
+assert incremental.models[args.variable] is model and (model.regressor, model.updates, model.timestamp, model.holdout_r2) == state, \
+    'an update without new features changed the model'
+print('an update without new features leaves the model as it is')
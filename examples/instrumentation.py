@@ -0,0 +1,32 @@
+"""
+Runs the pipeline on a synthetic dataset with the instrumentation enabled: the
+spans of each stage are logged, indented by their depth, and appended to a JSON
+lines file, then the slowest stages are listed.
+Usage: python instrumentation.py [spans.jsonl]
+"""
+import sys
+import logging
+import tempfile
+import pandas as pd
+from sklearn.ensemble import GradientBoostingRegressor
+
+import sensingbee.source as sb
+from sensingbee import synthetic
+from sensingbee import instrumentation
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+configuration__ = synthetic.make_dataset(tempfile.mkdtemp(prefix='sensingbee_'), n_sensors=50, days=14)
+records = []
+with instrumentation.instrumented(records.append, instrumentation.LoggerSink(),
+                                  instrumentation.JSONLinesSink(sys.argv[1] if len(sys.argv) > 1 else 'spans.jsonl'), memory=True):
+    bee = sb.Bee(configuration__).fit(mode='make')
+    # the model is fitted on the features that the meshgrid also has
+    X_mesh = bee.features.mesh_ingestion(bee.sensors, bee.geography, ['NO2'])
+    train = bee.features.get_train_features('NO2')
+    names = [c for c in pd.unique(pd.Series(X_mesh.columns)) if c in train['X'].columns]
+    bee.train(['NO2'], GradientBoostingRegressor(n_estimators=100), X=train['X'][names], y=train['y'])
+    bee.interpolate(['NO2'], timestamp='*')
+
+spans = pd.DataFrame([r for r in records if not r.get('event')])
+print(spans.groupby('path')[['seconds', 'peak_mb']].agg(['count', 'sum', 'max']).sort_values(('seconds', 'sum'), ascending=False).head(10))
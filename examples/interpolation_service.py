@@ -0,0 +1,64 @@
+"""
+Local run of service.InterpolationService with a stand-in data source: synthetic
+sensors (see benchmark_ingestion.SyntheticSensors) over a regular meshgrid and a
+model trained on them. The same surfaces are requested in-process and through the
+HTTP endpoint, then new data arrives and the cache is evicted for its timestamps.
+"""
+import json
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from urllib.request import urlopen
+from sklearn.ensemble import GradientBoostingRegressor
+
+import sensingbee.source as sb
+import sensingbee.utils as utils
+from sensingbee.service import InterpolationService
+from benchmark_ingestion import SyntheticSensors
+
+
+class StandInGeography(object):
+    def __init__(self, n=40):
+        lon, lat = np.meshgrid(np.linspace(-1.8, -1.51, n), np.linspace(54.96, 55.05, n))
+        self.meshgrid = gpd.GeoDataFrame({'lon': lon.ravel(), 'lat': lat.ravel()},
+                                         geometry=[shapely.geometry.Point(xy) for xy in zip(lon.ravel(), lat.ravel())])
+
+
+class StandInSource(object):
+    def __init__(self, n_sensors=50, n_times=30):
+        self.n_sensors, self.n_times, self.seed = n_sensors, n_times, 0
+
+    def __call__(self):
+        self.seed += 1
+        return SyntheticSensors(self.n_sensors, self.n_times, ['NO2','Temperature'], seed=self.seed)
+
+
+if __name__ == '__main__':
+    variables = ['NO2','Temperature']
+    source = StandInSource()
+    sensors = source()
+    zx, zi = utils.knn_ingestion(sensors, variables, k=5, freq=None)
+    bee = sb.Bee({'Sensors__variables': variables})
+    bee.geography, bee.sensors, bee.multiregressors = StandInGeography(), sensors, False
+    bee.models = {'NO2': sb.Model(GradientBoostingRegressor(n_estimators=50), random_state=0).fit(zx.loc[zi.loc['NO2'].index], zi.loc['NO2'])}
+
+    service = InterpolationService(bee, source=source, cache_size=64)
+    timestamps = sensors.data.index.get_level_values(2).unique()[:10]
+    for repeat in range(20):
+        for t in timestamps:
+            service.interpolate('NO2', t)
+    print('in-process', service.stats())
+
+    server = service.serve(port=0, block=False)
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    t0 = time.time()
+    surface = json.loads(urlopen('{}/interpolate?variable=NO2&timestamp={}'.format(url, timestamps[0].date())).read())
+    print('http', len(surface['pred']), 'cells in', round(time.time()-t0, 4), 's')
+
+    service.refresh()
+    print('after refresh', service.stats())
+    service.interpolate('NO2', timestamps[0])
+    print('http stats', json.loads(urlopen(url+'/stats').read()))
+    server.shutdown()
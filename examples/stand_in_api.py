@@ -0,0 +1,88 @@
+"""
+Local stand-in for the Urban Observatory raw csv API, for running Sensors(mode='get')
+without network access. It serves synthetic readings of a few sensors filtered by the
+start_time, end_time and variable query parameters. Responses take `latency` seconds plus
+`row_latency` per row served (as the real API, long windows are slow), and a share of
+requests fail with 503, to exercise the retries of utils.fetch_csv.
+Run as a script, it compares the chunked concurrent fetch with a single request.
+"""
+import time
+import threading
+import numpy as np
+import pandas as pd
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import sensingbee.source as sb
+import sensingbee.utils as utils
+
+
+class StandInAPI(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, n_sensors=20, start='2018-05-01', end='2018-06-01', freq='15min',
+                 variables=('NO2','Temperature','PM2.5'), latency=0.0, row_latency=0.0, failure_rate=0.0, seed=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        rng = np.random.RandomState(seed)
+        self.rng = rng
+        self.latency, self.row_latency, self.failure_rate = latency, row_latency, failure_rate
+        self.requests = 0
+        sensors = pd.DataFrame({'name': ['sensor_{}'.format(i) for i in range(n_sensors)],
+                                'type': 'Air Quality', 'active': True,
+                                'lon': rng.uniform(-1.8, -1.51, n_sensors), 'lat': rng.uniform(54.96, 55.05, n_sensors)})
+        times = pd.date_range(start, end, freq=freq)
+        rows = pd.MultiIndex.from_product([list(variables), sensors['name'], times], names=['Variable','name','Timestamp']).to_frame(index=False)
+        rows['Value'] = rng.gamma(4., 10., len(rows)).round(2)
+        self.table = rows.merge(sensors, on='name')
+        self.url = 'http://127.0.0.1:{}/api/v1/sensors/data/raw.csv'.format(self.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        if server.rng.uniform() < server.failure_rate:
+            self.send_response(503)
+            self.end_headers()
+            return
+        query = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        variables = query['variable'].split('-and-')
+        table = server.table
+        rows = table.loc[table['Variable'].str.lower().isin(variables) &
+                         (table['Timestamp'] >= pd.to_datetime(query['start_time'], format='%Y%m%d%H%M%S')) &
+                         (table['Timestamp'] <= pd.to_datetime(query['end_time'], format='%Y%m%d%H%M%S'))]
+        body = rows.to_csv(index=False).encode() if len(rows) else b''
+        time.sleep(server.latency + server.row_latency*len(rows))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+if __name__ == '__main__':
+    api = StandInAPI(latency=0.05, row_latency=2e-5, failure_rate=0.1).start()
+    variables = ['NO2','Temperature','PM2.5']
+    t0 = time.time()
+    single = utils.fetch_csv(api.url, '2018-05-01', '2018-05-31', variables, chunk_days=31, by_variable=False, n_jobs=1, retries=10, backoff=0.01)
+    print('single request: {:.2f} s, {} rows'.format(time.time()-t0, len(single)))
+    t0 = time.time()
+    chunked = utils.fetch_csv(api.url, '2018-05-01', '2018-05-31', variables, chunk_days=1, n_jobs=8, retries=10, backoff=0.01)
+    print('chunked: {:.2f} s, {} rows'.format(time.time()-t0, len(chunked)))
+    key = ['Variable','name','Timestamp']
+    print('same rows:', single.sort_values(key).reset_index(drop=True).equals(chunked.sort_values(key).reset_index(drop=True)))
+
+    configuration__ = {'Sensors__frequency': 'D', 'Sensors__variables': variables,
+                       'Sensors__threshold_callibration': {'Temperature':60, 'NO2':80, 'PM2.5':60}}
+    sensors = sb.Sensors(configuration__, mode='get', path={'start_time':'2018-05-01', 'end_time':'2018-05-07', 'url': api.url},
+                         delimit_quantiles=False)
+    print(sensors.sensors.shape, sensors.data.shape, '- requests served:', api.requests)
+    api.shutdown()
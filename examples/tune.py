@@ -0,0 +1,42 @@
+"""
+Searches the parameters of the gradient boosting regressor of Bee.train on a
+synthetic dataset (see sensingbee.synthetic) by successive halving (Bee.tune),
+then compares the 10-fold CV scores and training seconds of the default and the
+tuned regressors. The fold scores are cached in --cache, so running it again
+only fits what changed.
+Usage: python tune.py [--sensors 100] [--days 30] [--factor 3] [--budget 600]
+       [--n_jobs 4] [--cache tune_folds.jsonl]
+"""
+import time
+import argparse
+import tempfile
+from sklearn.ensemble import GradientBoostingRegressor
+
+import sensingbee.source as sb
+from sensingbee import synthetic
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sensors', type=int, default=100)
+parser.add_argument('--days', type=int, default=30)
+parser.add_argument('--factor', type=int, default=3)
+parser.add_argument('--budget', type=float, default=None)
+parser.add_argument('--n_jobs', type=int, default=4)
+parser.add_argument('--cache', default='tune_folds.jsonl')
+parser.add_argument('--variable', default='NO2')
+args = parser.parse_args()
+
+configuration__ = synthetic.make_dataset(tempfile.mkdtemp(prefix='sensingbee_'), n_sensors=args.sensors, days=args.days)
+bee = sb.Bee(configuration__).fit(mode='make')
+params = {'n_estimators': [50, 100, 200, 500], 'max_depth': [3, 5, 8], 'max_features': [0.5, 1.0], 'learning_rate': [0.05, 0.1]}
+results = bee.tune([args.variable], params, factor=args.factor, budget=args.budget, cache=args.cache,
+                   backend='processes', n_jobs=args.n_jobs, random_state=0)
+best, seconds = results[args.variable]
+search = bee.tuning[args.variable].search
+print(search.sort_values(['round', 'r2'], ascending=False).head(10).round(4).to_string(index=False))
+print('best {} found in {:.1f} seconds ({} fits)'.format(best, seconds, int((search['round'] >= 0).sum()*5)))
+
+for label, regressor in [('default', sb.default_regressor()), ('tuned', bee.tuning[args.variable].regressor)]:
+    t0 = time.time()
+    bee.train([args.variable], regressor, backend='processes', n_jobs=args.n_jobs, random_state=0)
+    print('{}: r2 {:.4f} +- {:.4f}, mse {:.4f}, trained in {:.1f} seconds'.format(
+            label, bee.models[args.variable].r2, bee.models[args.variable].r2_std, bee.models[args.variable].mse, time.time()-t0))
@@ -1,10 +1,27 @@
+import os
+import json
+import time
+import hashlib
+import concurrent.futures
 import numpy as np
 import pandas as pd
 from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
 
-import source as sb
+import sensingbee.source as sb
+import sensingbee.utils as utils
 
 class Experimentation(object):
+    """
+    Runs experiments on the regression of each variable with different feature configurations
+    ('p' for the variable's neighbours, 'u' for urban/OSM features, 's' for the other variables'
+    neighbours, 'd' for deprivation features, combined as e.g. 'pusd') and regression algorithms
+    ('rf' or 'gb'). Each (variable, configuration, regressor, iteration) cell is a 10-fold
+    Model.fit; cells run in a pool of workers that read the feature matrices from memory-mapped
+    files, and every finished cell is checkpointed, so an interrupted experiment resumes from
+    where it stopped when `initiate` is called again with the same results path. The checkpoint
+    records carry a hash of the run (see run_key), and those of a different run (other data,
+    regressor parameters or random_state) are run again instead of being reused.
+    """
     def __init__(self, variables, features_conf, regression_alg):
 
         self.variables = variables
@@ -18,43 +35,124 @@ class Experimentation(object):
         self.sensors = sb.Sensors(configuration__, mode, path=configuration__['DATA_FOLDER'], delimit_geography=self.geography)
         self.features = sb.Features(configuration__, mode, Sensors=self.sensors, Geography=self.geography)
 
-    def initiate(self, iterations, path_to_results):
+    # Names of the features used by a feature configuration for a variable, starting with
+    # the calendar channels of the features' frequency (see utils.calendar_columns).
+    def feature_names(self, var, fc):
+        features = list(utils.calendar_columns(getattr(self.features, 'frequency', self.configuration__['Sensors__frequency'])))
+        if 'p' in fc:
+            features += [var]
+        if 'u' in fc:
+            features += self.configuration__['osm_line_objs']+self.configuration__['osm_point_objs']
+        if 's' in fc:
+            features += [x for x in self.configuration__['Sensors__variables'] if x!= var]
+        if 'd' in fc:
+            features += utils.DEPRIVATION_COLUMNS
+        return features
+
+    # Writes each variable's training features as .npy files in `folder`, which the
+    # workers memory-map instead of receiving a copy of them. The features of a dense
+    # store (see Features.densify) are written as float32, straight from the store. Each file
+    # is written aside and moved over the old one, so workers still mapping it keep reading
+    # the old contents, and the files mapped by this process are dropped from the cache.
+    def share_features(self, folder):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        shared = {}
+        for var in self.variables:
+            f = self.features.get_train_features(var)
+            shared[var] = {'path': os.path.join(folder, var), 'columns': list(f['X'].columns)}
+            _shared_features.pop(shared[var]['path'], None)
+            _save_replacing(shared[var]['path']+'_X.npy', f['X'].values if f['X'].values.dtype == np.float32 else f['X'].values.astype(float))
+            _save_replacing(shared[var]['path']+'_y.npy', f['y'].values.astype(float).ravel())
+        return shared
+
+    # Hash of what the scores of a run depend on besides the cell: the regressors' parameters,
+    # the random_state and the shape and time range of each variable's training features.
+    def run_key(self, random_state=None):
+        features = {}
+        for var in self.variables:
+            f = self.features.get_train_features(var)
+            times = f['X'].index.get_level_values('Timestamp')
+            features[var] = [f['X'].shape, f['y'].shape, list(f['X'].columns), times.min(), times.max()]
+        regressors = {ra: sorted(make_regressor(ra).get_params().items()) for ra in self.regression_alg}
+        return hashlib.sha1(json.dumps([regressors, random_state, features], default=str).encode()).hexdigest()
+
+    def initiate(self, iterations, path_to_results, backend='processes', n_jobs=None, random_state=None):
+        checkpoint = path_to_results+'.cells.jsonl'
+        cells = [(var, fc, ra, i) for var in self.variables for fc in self.features_conf
+                 for ra in self.regression_alg for i in range(1,iterations+1)]
+        done, run, stale = {}, self.run_key(random_state), 0
+        if os.path.isfile(checkpoint):
+            with open(checkpoint) as f:
+                for line in f:
+                    cell = json.loads(line)
+                    if cell.get('run') != run:
+                        stale += 1
+                        continue
+                    done[(cell['variable'], cell['feature_configuration'], cell['regressor'], cell['iteration'])] = (cell['r2'], cell['mse'])
+        if stale > 0:
+            print('[Experimentation] {} checkpointed cells of another run in {} are run again'.format(stale, checkpoint))
+        todo = [c for c in cells if c not in done]
+        if len(todo) > 0:
+            shared = self.share_features(os.path.splitext(path_to_results)[0]+'_features')
+            t0, finished = time.time(), 0
+            seeds = {cell: n for n, cell in enumerate(cells)}
+            with utils.get_executor(backend, n_jobs) as executor, open(checkpoint, 'a') as f:
+                window = 1 if backend == 'serial' else 2*(n_jobs or os.cpu_count())
+                pending, queue = {}, list(todo)
+                while queue or pending:
+                    while queue and len(pending) < window:
+                        var, fc, ra, i = cell = queue.pop(0)
+                        columns = shared[var]['columns']
+                        positions = np.concatenate([np.flatnonzero(np.array(columns, dtype=object) == c) for c in self.feature_names(var, fc)])
+                        seed = None if random_state is None else random_state + seeds[cell]
+                        pending[executor.submit(_run_cell, shared[var]['path'], positions, ra, seed)] = cell
+                    completed, _ = concurrent.futures.wait(list(pending), return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in completed:
+                        cell = pending.pop(future)
+                        done[cell] = future.result()
+                        f.write(json.dumps({'variable': cell[0], 'feature_configuration': cell[1], 'regressor': cell[2],
+                                            'iteration': cell[3], 'r2': done[cell][0], 'mse': done[cell][1], 'run': run})+'\n')
+                        f.flush()
+                        finished += 1
+                        rate = finished/(time.time()-t0)
+                        print('[Experimentation] {}/{} cells - {:.2f} cells/min - ETA {:.1f} min'.format(
+                                len(done), len(cells), 60*rate, (len(cells)-len(done))/rate/60))
         self.scores = []
         for var in self.variables:
             for fc in self.features_conf:
                 for ra in self.regression_alg:
-                    features = ['dow','day','week']
-                    f = self.features.get_train_features(var)
-                    if 'p' in fc:
-                        features += [var]
-                    if 'u' in fc:
-                        features += self.configuration__['osm_line_objs']+self.configuration__['osm_point_objs']
-                    if 's' in fc:
-                        features += [x for x in self.configuration__['Sensors__variables'] if x!= var]
-                    if 'd' in fc:
-                        features += ['Index of Multiple Deprivation (IMD) Score', 'Income Score (rate)',
-                                       'Employment Score (rate)', 'Education, Skills and Training Score',
-                                       'Crime Score', 'Barriers to Housing and Services Score',
-                                       'Living Environment Score',
-                                       'Total population: mid 2012 (excluding prisoners)',
-                                       'Population aged 16-59: mid 2012 (excluding prisoners)']
-
-                    if ra == 'rf':
-                        regressor = RandomForestRegressor(n_estimators=200, max_depth=5, max_features=1)
-                    elif ra == 'gb':
-                        regressor = GradientBoostingRegressor(n_estimators=200, max_depth=5, max_features=1)
-
-                    r2,mse = [],[]
-                    for i in range(1,iterations+1):
-                        m = sb.Model(regressor).fit(f['X'][features], f['y'])
-                        r2.append(m.r2)
-                        mse.append(m.mse)
+                    r2 = [done[(var,fc,ra,i)][0] for i in range(1,iterations+1)]
+                    mse = [done[(var,fc,ra,i)][1] for i in range(1,iterations+1)]
                     self.scores.append([var,fc,ra,np.mean(r2),np.std(r2),np.mean(mse),np.std(mse)])
-                    # print('[{} - {} - {}] r2: {} ~ std: {} --- features: {}'.format(var, fc, ra, np.mean(r2), np.std(r2), f['X'][features].columns))
         self.scores = pd.DataFrame(self.scores, columns=['variable','feature_configuration','regressor','r2','r2_std','mse','mse_std'])
         self.scores.to_csv(path_to_results)
         return self
 
+def make_regressor(ra, random_state=None):
+    if ra == 'rf':
+        return RandomForestRegressor(n_estimators=200, max_depth=5, max_features=1, random_state=random_state)
+    elif ra == 'gb':
+        return GradientBoostingRegressor(n_estimators=200, max_depth=5, max_features=1, random_state=random_state)
+    raise ValueError('Unknown regression algorithm: {}'.format(ra))
+
+_shared_features = {}
+
+# np.save to a temporary file in the same folder, then moved to `path` in one step.
+def _save_replacing(path, array):
+    temporary = path+'.{}.tmp.npy'.format(os.getpid())
+    np.save(temporary, array)
+    os.replace(temporary, path)
+
+# Runs an experiment cell in a worker: a 10-fold Model.fit with the columns at `positions`
+# of the memory-mapped features in `path`. Returns the mean r2 and mse.
+def _run_cell(path, positions, ra, random_state=None):
+    if path not in _shared_features:
+        _shared_features[path] = (np.load(path+'_X.npy', mmap_mode='r'), np.load(path+'_y.npy', mmap_mode='r'))
+    X, y = _shared_features[path]
+    m = sb.Model(make_regressor(ra, random_state), random_state=random_state).fit(X[:,positions], pd.Series(y))
+    return m.r2, m.mse
+
 if __name__=='__main__':
     configuration__ = {
         'DATA_FOLDER':'/home/adelsondias/Repos/newcastle/air-quality/data_1week1/',
@@ -0,0 +1,163 @@
+"""
+Dense store of the training features, an alternative to the zx/zi frames of
+Features for training. The features are kept as a float32 (sample, channel)
+array, where a sample is a (variable, sensor, timestamp) target of zi, with
+its zx row. Samples are grouped by variable, so the training matrix of a
+variable is a range of rows, given without copying by get_train_features:
+
+    store = FeatureStore.from_frames(Features.zx, Features.zi)
+    train = store.get_train_features('NO2') # train['X'].values is a view of store.X
+
+A zx row is repeated for each variable with a target at it. The channels are
+named by a (variable, rank, kind) index, e.g. ('NO2', 2, 'value') for the
+value of the 3rd closest NO2 sensor, ('NO2', 2, 'distance') for its distance
+and ('dow', -1, 'calendar') or ('primary', -1, 'osm') for the other channels.
+Features(configuration__, ...) builds one with
+configuration__['Features__store'] = 'dense' (or Features.densify()), and keeps
+Features.zx as a frame export of it.
+"""
+
+import numpy as np
+import pandas as pd
+
+import sensingbee.utils as utils
+
+CALENDAR_CHANNELS = ['hour', 'dow', 'day', 'week']
+
+
+class FeatureStore(object):
+    """
+    Samples (`samples`, indexed by (Variable, Sensor Name, Timestamp)) by channels
+    (`names`, the zx columns, and `channels`, their (variable, rank, kind) index) as the
+    float32 `X` array, with the float32 targets `y`. The samples of variables[v] are the
+    rows offsets[v]:offsets[v+1]; the rows after offsets[-1] are the zx rows that are not
+    a target of any variable (kept for the export), with NaN targets.
+    """
+    def __init__(self, names, X, y, samples, variables, offsets):
+        self.names = list(names)
+        self.variables = pd.Index(variables, name='Variable')
+        self.channels = channel_index(self.names, self.variables)
+        self.X = np.ascontiguousarray(X, dtype=np.float32)
+        self.y = np.asarray(y, dtype=np.float32)
+        self.samples = samples
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self._frame = None
+
+    # Builds the store from the zx frame, indexed by (Sensor Name, Timestamp), and the zi
+    # one, indexed by (Variable, Sensor Name, Timestamp). The targets with no zx row are
+    # left out, as get_train_features does.
+    @classmethod
+    def from_frames(cls, zx, zi):
+        position = zx.index.get_indexer(zi.index.droplevel(0))
+        v, variables = pd.factorize(zi.index.get_level_values(0), sort=True)
+        keep = position >= 0
+        order = np.flatnonzero(keep)[np.argsort(v[keep], kind='mergesort')]
+        untargeted = np.ones(len(zx), dtype=bool)
+        untargeted[position[keep]] = False
+        rows = np.concatenate([position[order], np.flatnonzero(untargeted)])
+        codes = np.concatenate([v[order], np.full(untargeted.sum(), -1)])
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(v[order], minlength=len(variables)))])
+        samples = pd.MultiIndex(levels=[pd.Index(variables)]+list(zx.index.levels),
+                                codes=[codes]+[np.asarray(c)[rows] for c in zx.index.codes],
+                                names=['Variable','Sensor Name','Timestamp'], verify_integrity=False)
+        y = np.concatenate([np.asarray(zi.iloc[:,0].values, dtype=np.float32)[order], np.full(untargeted.sum(), np.nan, dtype=np.float32)])
+        X = np.asarray(zx.values, dtype=np.float32)[rows]
+        return cls(zx.columns, X, y, samples, variables, offsets)
+
+    # A store with the samples of the zx and zi frames of new timestamps (e.g. the ones
+    # Features.update ingests) appended, each variable's after its samples in this store.
+    # Only the new frames are indexed; the rows of this store are copied in blocks.
+    def append(self, zx, zi):
+        new = FeatureStore.from_frames(zx, zi)
+        if new.names != self.names:
+            raise ValueError('The new features have a different layout from the stored ones: {}'.format(new.names))
+        variables = self.variables.union(new.variables)
+        blocks, offsets = [], [0]
+        for var in variables:
+            for base, store in ((0, self), (len(self), new)):
+                if var in store.variables:
+                    rows = store.rows(var)
+                    blocks.append((base, store, rows.start, rows.stop))
+            offsets.append(sum(stop-start for _, _, start, stop in blocks))
+        blocks += [(0, self, self.offsets[-1], len(self)), (len(self), new, new.offsets[-1], len(new))]
+        order = np.concatenate([np.arange(start, stop) + base for base, _, start, stop in blocks])
+        levels, codes = [], []
+        for old_level, new_level, old_codes, new_codes in zip(self.samples.levels, new.samples.levels,
+                                                              self.samples.codes, new.samples.codes):
+            level = old_level.append(new_level.difference(old_level))
+            recode, new_codes = level.get_indexer(new_level), np.asarray(new_codes)
+            levels.append(level)
+            codes.append(np.concatenate([np.asarray(old_codes), np.append(recode, -1)[new_codes]])[order]) # -1: no variable
+        samples = pd.MultiIndex(levels=levels, codes=codes, names=self.samples.names, verify_integrity=False)
+        X = np.concatenate([store.X[start:stop] for _, store, start, stop in blocks])
+        y = np.concatenate([store.y[start:stop] for _, store, start, stop in blocks])
+        return FeatureStore(self.names, X, y, samples, variables, offsets)
+
+    def __len__(self):
+        return len(self.X)
+
+    # Memory taken by the arrays, in bytes.
+    def nbytes(self):
+        return self.X.nbytes + self.y.nbytes + self.offsets.nbytes
+
+    # Range of the rows of a variable's samples.
+    def rows(self, variable):
+        v = self.variables.get_loc(variable)
+        return slice(self.offsets[v], self.offsets[v+1])
+
+    # The training features of a variable as Features.get_train_features gives them, i.e.
+    # X and y frames indexed by (Sensor Name, Timestamp), whose values are views of the store.
+    def get_train_features(self, variable):
+        rows = self.rows(variable)
+        index = self.samples[rows].droplevel(0)
+        X = pd.DataFrame(self.X[rows], index=index, columns=self.names, copy=False)
+        y = pd.DataFrame(self.y[rows,None], index=index, columns=['Value'], copy=False)
+        return {'X': X, 'y': y}
+
+    # Positions of the channels with the given names, in the order of the names (all the
+    # channels of a repeated name, in rank order).
+    def positions(self, names):
+        columns = np.array(self.names, dtype=object)
+        return np.concatenate([np.flatnonzero(columns == name) for name in names]).astype(np.int64)
+
+    # The X array of a variable's samples with the channels of the given names only (see
+    # positions). It is a view of the store when those channels are contiguous (and in
+    # order), and a float32 copy otherwise.
+    def select(self, variable, names):
+        rows, positions = self.rows(variable), self.positions(names)
+        if len(positions) > 0 and np.array_equal(positions, np.arange(positions[0], positions[0]+len(positions))):
+            return self.X[rows, positions[0]:positions[0]+len(positions)]
+        return self.X[rows][:, positions]
+
+    # The pandas export of the store: the zx frame indexed by (Sensor Name, Timestamp), with
+    # float32 values, sorted. It is built on the first call and kept, unless `cache` is False.
+    def frame(self, cache=True):
+        if self._frame is not None:
+            return self._frame
+        index = self.samples.droplevel(0)
+        first = ~index.duplicated()
+        frame = pd.DataFrame(self.X[first], index=index[first], columns=self.names, copy=False).sort_index()
+        if cache:
+            self._frame = frame
+        return frame
+
+
+# The (variable, rank, kind) index of zx channels named as knn_ingestion names them:
+# the repeated names of `variables` (and 'd_' of them) are the neighbours' values (and
+# distances) by rank, the others calendar, deprivation or (the remaining) OSM channels.
+def channel_index(names, variables):
+    seen, tuples = {}, []
+    bases = {var.split('.')[0]: var for var in variables}
+    for name in names:
+        base = name[2:] if name.startswith('d_') else name
+        if base in variables or base in bases:
+            variable, kind = bases.get(base, base), 'distance' if name.startswith('d_') else 'value'
+            rank = seen[(variable, kind)] = seen.get((variable, kind), -1) + 1
+            tuples.append((variable, rank, kind))
+        elif name in CALENDAR_CHANNELS:
+            tuples.append((name, -1, 'calendar'))
+        elif name in utils.DEPRIVATION_COLUMNS:
+            tuples.append((name, -1, 'deprivation'))
+        else:
+            tuples.append((name, -1, 'osm'))
+    return pd.MultiIndex.from_tuples(tuples, names=['variable','rank','kind'])
@@ -0,0 +1,82 @@
+"""
+Training-free interpolation by inverse distance weighting (IDW) of the neighbours'
+channels that the features already hold: for a variable, zx (and the meshgrid
+features) have the values of its k nearest sensors (the `var` columns, by rank)
+and their distances (the `d_var` columns), so a prediction is the average of those
+values weighted by 1/distance**power, computed for all the rows (e.g. all the
+cells and timestamps of a meshgrid) in one vectorized expression:
+
+    model = Model(IDWRegressor('NO2', power=2)).fit(X, y) # 10-fold CV scores, no training
+    bee.idw(['NO2']) # or straight into Bee.models, without fit
+
+With power=0 it is the mean of the neighbours, and with k=1 the nearest neighbour.
+It needs no training history, so it serves variables without one and predictions
+where latency matters more than accuracy (see examples/benchmark_idw.py).
+"""
+
+import numpy as np
+from sklearn.base import BaseEstimator, RegressorMixin
+
+# Distances below this are taken as this one, so a sensor at a point dominates the
+# prediction there instead of dividing by zero.
+MIN_DISTANCE = 1e-9
+
+
+# The IDW predictions of (n, k) arrays of the neighbours' values and distances, ignoring
+# the neighbours with NaN value or distance (NaN where there are none).
+def idw(values, distances, power=2):
+    valid = ~(np.isnan(values) | np.isnan(distances))
+    weights = np.where(valid, np.maximum(np.where(valid, distances, 1), MIN_DISTANCE)**-float(power), 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (weights*np.where(valid, values, 0)).sum(axis=1) / weights.sum(axis=1)
+
+
+class IDWRegressor(BaseEstimator, RegressorMixin):
+    """
+    Regressor (in the sklearn sense, so Model, clone and Model.tune take it as any other)
+    predicting a variable by the IDW of the `k` nearest (all, with None) of its neighbours'
+    channels, found by name in `columns` (which Model gives it from the training features),
+    or in the columns of X when predicting a frame; the names of csv-loaded features, without
+    the variable's decimals (e.g. 'PM2' for 'PM2.5'), are accepted too. It reads the features
+    unscaled (scale_features), and fit learns nothing but the mean target, predicted where no
+    neighbour is available.
+    """
+    scale_features = False
+
+    def __init__(self, variable, power=2, k=None, columns=None):
+        self.variable = variable
+        self.power = power
+        self.k = k
+        self.columns = columns
+
+    def fit(self, X, y=None):
+        if self.columns is None:
+            raise ValueError('IDWRegressor needs the names of the columns of the features')
+        self.values_, self.distances_ = self.channels(self.columns)
+        self.fallback_ = np.nan if y is None or len(y) == 0 else float(np.nanmean(y))
+        return self
+
+    # Positions of the variable's value and distance channels among `columns`, the k
+    # nearest of each. Raises a ValueError when they are missing or don't pair up.
+    def channels(self, columns):
+        columns = np.array(list(columns), dtype=object)
+        for name in dict.fromkeys([self.variable, self.variable.split('.')[0]]):
+            values = np.flatnonzero(columns == name)[:self.k]
+            distances = np.flatnonzero(columns == 'd_'+name)[:self.k]
+            if len(values) > 0 or len(distances) > 0:
+                if len(values) != len(distances):
+                    raise ValueError('{} {} and {} d_{} channels in the features'.format(
+                            len(values), name, len(distances), name))
+                return values, distances
+        raise ValueError('No {0} and d_{0} channels in the features'.format(self.variable))
+
+    def predict(self, X):
+        if hasattr(X, 'columns'):
+            values, distances = self.channels(X.columns)
+        elif np.shape(X)[1] != len(self.columns):
+            raise ValueError('The features have {} columns, not the {} of {}'.format(np.shape(X)[1], len(self.columns), self.columns))
+        else:
+            values, distances = self.values_, self.distances_
+        X = np.asarray(X, dtype=float)
+        y = idw(X[:, values], X[:, distances], self.power)
+        return np.where(np.isnan(y), self.fallback_, y)
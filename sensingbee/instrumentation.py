@@ -0,0 +1,219 @@
+"""
+Timing and memory instrumentation of the pipeline stages. The stages of Geography,
+Sensors, Features, Model and Bee run in (nested) spans, and when instrumentation is
+enabled, a record of each span is sent to the sinks as it ends: its name, path
+(e.g. "Bee.fit/Geography/load_osm"), depth, start time, seconds, row counts or other
+attributes set by the stage and, with memory=True, the peak of memory allocated
+during the span (tracemalloc). A sink is any callable taking the record (a dict),
+such as LoggerSink, JSONLinesSink or a list's append:
+
+    records = []
+    with instrumentation.instrumented(records.append, JSONLinesSink('spans.jsonl'), memory=True):
+        bee = Bee(configuration__).fit(mode='make')
+
+While disabled (the default), span() returns a shared no-op span, so instrumented
+code costs about a function call per span.
+"""
+
+import json
+import time
+import logging
+import threading
+import contextlib
+import functools
+import tracemalloc
+
+_enabled = False
+_memory = False
+_started_tracing = False
+_sinks = []
+_local = threading.local()
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def set(self, **attrs):
+        return self
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    """
+    A timed block of a stage, nested in the span that is open in the same thread
+    when it starts. Attributes (e.g. rows=...) are given at creation or with set.
+    """
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.peak = 0
+
+    def __enter__(self):
+        stack = _stack()
+        self.parent = stack[-1] if stack else None
+        self.path = self.name if self.parent is None else self.parent.path+'/'+self.name
+        self.depth = len(stack)
+        stack.append(self)
+        if _memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if self.parent is not None:
+                self.parent.peak = max(self.parent.peak, peak)
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            self.start_memory = current
+        self.start = time.time()
+        self.t0 = time.perf_counter()
+        return self
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        seconds = time.perf_counter() - self.t0
+        stack = _stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        record = {'name': self.name, 'path': self.path, 'depth': self.depth, 'start': self.start, 'seconds': seconds}
+        if _memory and tracemalloc.is_tracing() and hasattr(self, 'start_memory'):
+            peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            record['peak_mb'] = (peak - self.start_memory)/2**20
+            if self.parent is not None:
+                self.parent.peak = max(self.parent.peak, peak)
+        if error is not None:
+            record['error'] = '{}: {}'.format(kind.__name__, error)
+        record.update(self.attrs)
+        _emit(record)
+        return False
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def _emit(record):
+    for sink in _sinks:
+        sink(record)
+
+# Returns a span for the block of a stage, to be used as `with span('name', rows=n) as s:`.
+def span(name, **attrs):
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(name, attrs)
+
+# Decorator running each call of a function (or method) in a span. The keyword arguments
+# are attributes computed when the call ends, by functions of its first argument (self,
+# for methods) and its result, e.g. @timed('resample', rows=lambda self, result: len(self.data)).
+def timed(name, **attributes):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with Span(name, {}) as s:
+                result = function(*args, **kwargs)
+                for key, attribute in attributes.items():
+                    s.attrs[key] = attribute(args[0] if args else None, result)
+            return result
+        return wrapper
+    return decorator
+
+# Sends the record of a block that was timed elsewhere (e.g. a CV fold run by a worker
+# process) as a child of the current span.
+def record(name, seconds, **attrs):
+    if not _enabled:
+        return
+    stack = _stack()
+    parent = stack[-1] if stack else None
+    entry = {'name': name, 'path': name if parent is None else parent.path+'/'+name,
+             'depth': len(stack), 'start': time.time() - seconds, 'seconds': seconds}
+    entry.update(attrs)
+    _emit(entry)
+
+# Sends a record of something that happened in the current span, without duration
+# (e.g. timestamps skipped for lacking sensors).
+def event(name, **attrs):
+    if not _enabled:
+        return
+    stack = _stack()
+    parent = stack[-1] if stack else None
+    entry = {'name': name, 'path': name if parent is None else parent.path+'/'+name,
+             'depth': len(stack), 'start': time.time(), 'event': True}
+    entry.update(attrs)
+    _emit(entry)
+
+def enabled():
+    return _enabled
+
+# Enables the instrumentation with the given sinks. With memory=True, the memory
+# allocated in each span is traced too (tracemalloc, which slows the code down).
+def enable(*sinks, **options):
+    global _enabled, _memory, _started_tracing
+    _sinks[:] = sinks
+    _memory = options.get('memory', False)
+    if _memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracing = True
+    _enabled = True
+
+def disable():
+    global _enabled, _memory, _started_tracing
+    _enabled = False
+    if _started_tracing:
+        tracemalloc.stop()
+        _started_tracing = False
+    _memory = False
+    for sink in _sinks:
+        if hasattr(sink, 'close'):
+            sink.close()
+    _sinks[:] = []
+
+# Enables the instrumentation (see enable) within a `with` block.
+@contextlib.contextmanager
+def instrumented(*sinks, **options):
+    enable(*sinks, **options)
+    try:
+        yield
+    finally:
+        disable()
+
+
+class LoggerSink(object):
+    """
+    Logs each record as a line, indented by its depth, in the `logger` (default: the
+    "sensingbee" logger).
+    """
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger if logger is not None else logging.getLogger('sensingbee')
+        self.level = level
+
+    def __call__(self, record):
+        details = ' '.join('{}={}'.format(k, v) for k, v in record.items()
+                           if k not in ('name', 'path', 'depth', 'start', 'seconds', 'event'))
+        if record.get('event'):
+            self.logger.log(self.level, '%s%s %s', '  '*record['depth'], record['name'], details)
+        else:
+            self.logger.log(self.level, '%s%s %.3f s %s', '  '*record['depth'], record['name'], record['seconds'], details)
+
+
+class JSONLinesSink(object):
+    """
+    Appends each record as a JSON line to the file at `path`.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record, default=str) + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,161 @@
+"""
+Compact in-memory store of the sensors' samples, an alternative to the
+(Variable, Sensor Name, Timestamp) frame of Sensors.data for the stages that
+slice it by variable and timestamp many times (ingestion of zx/zi and of the
+meshgrid). Variables and sensors are kept as integer codes into their (sorted)
+names, timestamps as int64 nanoseconds and values as float32, and the samples
+are sorted by (variable, timestamp, sensor), so that the samples of a variable
+at a timestamp are a contiguous range whose bounds are read from a CSR-like
+(variable, timestamp) offsets table:
+
+    store = SensorStore.from_frame(Sensors.data)
+    sensors, values = store.samples('NO2', '2018-01-01') # views, no copy
+
+Sensors(configuration__, ..., ) builds one with configuration__['Sensors__store'] =
+'compact' (or Sensors.compact()), and keeps Sensors.data as a frame view of it.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class SensorStore(object):
+    """
+    Samples of `variables` (Index) by `sensors` (Index) at `timestamps` (sorted unique
+    int64 ns), as the `sensor_codes` and `values` arrays sorted by (variable, timestamp,
+    sensor), where the samples of variable v at timestamps[i] are the range
+    offsets[v,i]:offsets[v,i+1].
+    """
+    def __init__(self, variables, sensors, timestamps, offsets, sensor_codes, values):
+        self.variables = pd.Index(variables, name='Variable')
+        self.sensors = pd.Index(sensors, name='Sensor Name')
+        self.timestamps = np.asarray(timestamps, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.sensor_codes = np.asarray(sensor_codes, dtype=np.int32)
+        self.values = np.asarray(values, dtype=np.float32)
+        self._frame = None
+
+    # Builds the store from a frame indexed by (Variable, Sensor Name, Timestamp), such
+    # as Sensors.data, with a Value column.
+    @classmethod
+    def from_frame(cls, data):
+        index = data.index
+        variables, v = _factorize(index.get_level_values(0))
+        sensors, s = _factorize(index.get_level_values(1))
+        times = np.asarray(pd.DatetimeIndex(index.get_level_values(2)).asi8)
+        timestamps, t = np.unique(times, return_inverse=True)
+        t = np.asarray(t).ravel()
+        order = np.lexsort((s, t, v))
+        key = v[order].astype(np.int64)*len(timestamps) + t[order]
+        counts = np.bincount(key, minlength=len(variables)*len(timestamps)).reshape(len(variables), len(timestamps))
+        offsets = np.zeros((len(variables), len(timestamps)+1), dtype=np.int64)
+        offsets[:,1:] = np.cumsum(counts, axis=1)
+        offsets += np.concatenate([[0], np.cumsum(counts.sum(axis=1))[:-1]])[:,None]
+        return cls(variables, sensors, timestamps, offsets, s[order], data['Value'].values[order])
+
+    def __len__(self):
+        return len(self.values)
+
+    # Memory taken by the arrays, in bytes.
+    def nbytes(self):
+        return self.timestamps.nbytes + self.offsets.nbytes + self.sensor_codes.nbytes + self.values.nbytes
+
+    # The timestamps as a DatetimeIndex.
+    def times(self):
+        return pd.DatetimeIndex(self.timestamps, name='Timestamp')
+
+    # The sensors with at least one sample, in their order in the store.
+    def sensors_in_data(self):
+        return self.sensors[np.bincount(self.sensor_codes, minlength=len(self.sensors)) > 0]
+
+    # Positions of the given timestamps in the store's timestamps, -1 for the ones not in it.
+    def positions(self, timestamps):
+        times = np.asarray(pd.DatetimeIndex(pd.to_datetime(timestamps)).asi8)
+        if len(self.timestamps) == 0:
+            return np.full(len(times), -1, dtype=np.int64)
+        i = np.minimum(np.searchsorted(self.timestamps, times), len(self.timestamps)-1)
+        return np.where(self.timestamps[i] == times, i, -1)
+
+    # The sensors' codes and the values of a variable at a timestamp, as views of the
+    # store's arrays (empty ones if there are no samples).
+    def samples(self, var, timestamp):
+        i = self.positions([timestamp])[0]
+        if var not in self.variables or i < 0:
+            return self.sensor_codes[:0], self.values[:0]
+        v = self.variables.get_loc(var)
+        start, end = self.offsets[v,i], self.offsets[v,i+1]
+        return self.sensor_codes[start:end], self.values[start:end]
+
+    # Rows (into sensor_codes/values) of the samples of a variable at the given timestamp
+    # positions, and the position in `positions` each row belongs to.
+    def rows(self, var, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        if var not in self.variables:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        v = self.variables.get_loc(var)
+        found = np.flatnonzero(positions >= 0)
+        starts, ends = self.offsets[v, positions[found]], self.offsets[v, positions[found]+1]
+        lengths = ends - starts
+        owner = np.repeat(found, lengths)
+        rows = np.arange(lengths.sum()) + np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        return rows, owner
+
+    # Lays out the samples of a variable in a dense (timestamp, sensor) matrix for the given
+    # sensors' names and timestamps, as utils.samples_matrix does for a frame. Only the
+    # samples at those timestamps are read.
+    def matrix(self, var, sensors, timestamps):
+        values = np.full((len(timestamps), len(sensors)), np.nan)
+        available = np.zeros((len(timestamps), len(sensors)), dtype=bool)
+        rows, owner = self.rows(var, self.positions(timestamps))
+        column = pd.Index(sensors).get_indexer(self.sensors)[self.sensor_codes[rows]]
+        keep = column >= 0
+        values[owner[keep], column[keep]] = self.values[rows[keep]]
+        available[owner[keep], column[keep]] = True
+        return values, available
+
+    # A new store with the samples at the given timestamps only.
+    def subset(self, timestamps):
+        positions = self.positions(timestamps)
+        positions = np.unique(positions[positions >= 0])
+        parts, offsets = [], np.zeros((len(self.variables), len(positions)+1), dtype=np.int64)
+        for v, var in enumerate(self.variables):
+            rows, owner = self.rows(var, positions)
+            offsets[v,1:] = np.cumsum(np.bincount(owner, minlength=len(positions)))
+            parts.append(rows)
+        offsets += np.concatenate([[0], np.cumsum(offsets[:,-1])[:-1]])[:,None]
+        rows = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+        return SensorStore(self.variables, self.sensors, self.timestamps[positions], offsets,
+                           self.sensor_codes[rows], self.values[rows])
+
+    # The samples of a variable at a timestamp as the frame that Sensors.data.loc[idx[var,:,t]]
+    # gives, i.e. still indexed by (Variable, Sensor Name, Timestamp).
+    def frame_at(self, var, timestamp):
+        codes, values = self.samples(var, timestamp)
+        index = pd.MultiIndex.from_arrays([np.repeat(var, len(codes)), self.sensors[codes],
+                                           pd.DatetimeIndex(np.repeat(pd.Timestamp(timestamp), len(codes)))],
+                                          names=['Variable','Sensor Name','Timestamp'])
+        return pd.DataFrame({'Value': values}, index=index)
+
+    # The pandas-compatible view of the store: the frame indexed by (Variable, Sensor Name,
+    # Timestamp), sorted, with a float32 Value column, as Sensors.data. It is built on the
+    # first call and kept, unless `cache` is False.
+    def frame(self, cache=True):
+        if self._frame is not None:
+            return self._frame
+        counts = np.diff(self.offsets, axis=1)
+        v = np.repeat(np.arange(len(self.variables), dtype=np.int32), counts.sum(axis=1))
+        t = np.repeat(np.tile(np.arange(len(self.timestamps), dtype=np.int32), len(self.variables)), counts.ravel())
+        order = np.lexsort((t, self.sensor_codes, v))
+        index = pd.MultiIndex(levels=[self.variables, self.sensors, self.times()],
+                              codes=[v[order], self.sensor_codes[order], t[order]],
+                              names=['Variable','Sensor Name','Timestamp'], verify_integrity=False)
+        frame = pd.DataFrame({'Value': self.values[order]}, index=index)
+        if cache:
+            self._frame = frame
+        return frame
+
+
+# Sorted unique labels of an Index and the codes of its values into them.
+def _factorize(labels):
+    codes, uniques = pd.factorize(labels, sort=True)
+    return pd.Index(uniques), np.asarray(codes, dtype=np.int32)
@@ -0,0 +1,207 @@
+"""
+Long-lived interpolation service around a fitted and trained Bee. It keeps the
+Geography, the sensors' data and the models loaded, and holds an LRU cache of
+the meshgrid features (per timestamp) and of the prediction grids (per variable
+and timestamp), so repeated requests for the same surface are served from
+memory. It can be used in-process or through a local HTTP endpoint:
+
+    service = InterpolationService(bee)
+    service.interpolate('NO2', '2018-09-01')
+    service.serve(port=8000) # GET /interpolate?variable=NO2&timestamp=2018-09-01, GET /stats
+
+With a tiles.TiledMesh, the map tiles are also served (GET /tile?variable=NO2&
+timestamp=2018-09-01&z=14&x=8107&y=5107).
+"""
+
+import json
+import time
+import threading
+import collections
+import concurrent.futures
+import numpy as np
+import pandas as pd
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import sensingbee.utils as utils
+
+
+class InterpolationService(object):
+    """
+    `bee` must have its geography and models (from Bee.fit/Bee.train or Bee.load_models).
+    The sensors' data defaults to bee.sensors; `source` is an optional callable returning
+    a new Sensors object (or any object with the same `data`/`sensors` attributes), used
+    by `refresh`. When new data arrives, the cached entries of its timestamps are evicted.
+    `tiles` is an optional tiles.TiledMesh of the same bee, for `tile` requests.
+    """
+    def __init__(self, bee, data=None, source=None, cache_size=256, latency_window=10000, tiles=None):
+        self.bee = bee
+        self.tiles = tiles
+        self.source = source
+        self.cache_size = cache_size
+        self.variables = bee.configuration__['Sensors__variables']
+        self.features_cache = collections.OrderedDict()
+        self.predictions_cache = collections.OrderedDict()
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.hits, self.misses = 0, 0
+        self.lock = threading.RLock()
+        self.pending = {}
+        self.generation = 0
+        self.data = data if data is not None else (bee.sensors if hasattr(bee, 'sensors') else source())
+        if tiles is not None:
+            tiles.update_data(self.data)
+
+    # In-process API: the prediction grid (pred, lat and lon by meshgrid cell) of a
+    # variable at a timestamp, from the cache when available. The lock is only held to
+    # look up and insert cache entries, so a slow miss doesn't block the other requests.
+    def interpolate(self, variable, timestamp, regressor=None):
+        t0 = time.time()
+        timestamp = pd.to_datetime(timestamp)
+        model = self.bee.models[regressor][variable] if regressor is not None else self.bee.models[variable]
+        y_pred = self._cached(self.predictions_cache, (regressor, variable, timestamp),
+                              lambda data: model.predict(self._features(timestamp), self.bee.geography), count=True)
+        self.latencies.append(time.time()-t0)
+        return y_pred
+
+    # The meshgrid features at a timestamp, from the cache when available.
+    def _features(self, timestamp):
+        return self._cached(self.features_cache, timestamp,
+                            lambda data: utils.mesh_ingestion(data, self.bee.geography.meshgrid, self.variables, timestamp,
+                                                              self.bee.configuration__.get('Sensors__frequency', 'D')))
+
+    # The entry of a cache for a key, computed by `compute(data)` outside the lock on a miss.
+    # Concurrent misses of the same key wait for the first one's result (a future in
+    # `pending`) instead of computing it again. A result computed from data that update_data
+    # replaced meanwhile is returned but not cached.
+    def _cached(self, cache, key, compute, count=False):
+        with self.lock:
+            value = self._get(cache, key)
+            if count:
+                self.hits, self.misses = self.hits + (value is not None), self.misses + (value is None)
+            if value is not None:
+                return value
+            generation, data = self.generation, self.data
+            future = self.pending.get((id(cache), generation, key))
+            owner = future is None
+            if owner:
+                future = self.pending[(id(cache), generation, key)] = concurrent.futures.Future()
+        if not owner:
+            return future.result()
+        try:
+            value = compute(data)
+        except Exception as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self.lock:
+                del self.pending[(id(cache), generation, key)]
+                if not future.done() and self.generation == generation:
+                    self._put(cache, key, value)
+        future.set_result(value)
+        return value
+
+    # In-process API: the (tile_size, tile_size) predictions of a variable at a timestamp
+    # in the map tile z/x/y (see tiles.TiledMesh.tile, which locks its own caches, so a
+    # tile being predicted doesn't block the other requests either).
+    def tile(self, variable, timestamp, z, x, y):
+        t0 = time.time()
+        values = self.tiles.tile(variable, timestamp, int(z), int(x), int(y))
+        self.latencies.append(time.time()-t0)
+        return values
+
+    # Replaces the sensors' data, evicting the cached entries of the timestamps in the
+    # new data (or every entry, with evict_all).
+    def update_data(self, data, evict_all=False):
+        with self.lock:
+            self.data = data
+            self.generation += 1
+            if self.tiles is not None:
+                self.tiles.update_data(data)
+            if evict_all:
+                self.features_cache.clear()
+                self.predictions_cache.clear()
+            else:
+                timestamps = set(utils.data_sensors_times(data)[1])
+                for t in [t for t in self.features_cache if t in timestamps]:
+                    del self.features_cache[t]
+                for key in [key for key in self.predictions_cache if key[2] in timestamps]:
+                    del self.predictions_cache[key]
+        return self
+
+    # Pulls new data from the source and updates the service with it.
+    def refresh(self):
+        return self.update_data(self.source())
+
+    # Latency percentiles (in seconds) of the last requests and cache statistics.
+    def stats(self):
+        latencies = np.array(self.latencies)
+        return {'requests': self.hits+self.misses, 'hits': self.hits, 'misses': self.misses,
+                'p50': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'p99': float(np.percentile(latencies, 99)) if len(latencies) else None,
+                'cached_features': len(self.features_cache), 'cached_predictions': len(self.predictions_cache)}
+
+    # Local HTTP endpoint. It blocks serving requests unless `block` is False, in which
+    # case the server runs in a background thread and is returned (call its shutdown()).
+    def serve(self, host='127.0.0.1', port=8000, block=True):
+        server = _ThreadingHTTPServer((host, port), _Handler)
+        server.service = self
+        if block:
+            server.serve_forever()
+        else:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def _get(self, cache, key):
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        return None
+
+    def _put(self, cache, key, value):
+        cache[key] = value
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        try:
+            if url.path == '/interpolate':
+                y_pred = self.server.service.interpolate(query['variable'], query['timestamp'], query.get('regressor'))
+                body = {'variable': query['variable'], 'timestamp': str(pd.to_datetime(query['timestamp'])),
+                        'lat': y_pred['lat'].astype(float).tolist(), 'lon': y_pred['lon'].astype(float).tolist(),
+                        'pred': y_pred['pred'].astype(float).tolist()}
+            elif url.path == '/tile' and self.server.service.tiles is not None:
+                values = self.server.service.tile(query['variable'], query['timestamp'], query['z'], query['x'], query['y'])
+                body = {'variable': query['variable'], 'timestamp': str(pd.to_datetime(query['timestamp'])),
+                        'z': int(query['z']), 'x': int(query['x']), 'y': int(query['y']),
+                        'values': [[None if np.isnan(v) else float(v) for v in row] for row in values]}
+            elif url.path == '/stats':
+                body = self.server.service.stats()
+            else:
+                return self._send(404, {'error': 'not found'})
+        except KeyError as e:
+            return self._send(400, {'error': 'missing or unknown {}'.format(e)})
+        except (ValueError, TypeError) as e: # e.g. a timestamp or tile coordinates that don't parse
+            return self._send(400, {'error': str(e)})
+        except Exception as e:
+            return self._send(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+        self._send(200, body)
+
+    def _send(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
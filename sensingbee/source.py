@@ -3,19 +3,36 @@ sensingbee
 Author: Adelson Araujo Jr (adelsondias@gmail.com)
 """
 
+import os
 import time
+import copy
+import json
+import hashlib
+import shutil
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import geopandas as gpd
 import fiona
 import shapely
+import shapely.ops
+import shapely.prepared
 from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
-from sklearn.model_selection import RandomizedSearchCV, RepeatedKFold, learning_curve
-from sklearn.preprocessing import MinMaxScaler
+from sklearn.model_selection import KFold, ParameterGrid, ParameterSampler, RepeatedKFold, learning_curve
+from sklearn.preprocessing import MinMaxScaler, FunctionTransformer
+from sklearn.base import clone
+try:
+    import joblib
+except ImportError:
+    from sklearn.externals import joblib
 from sklearn.metrics import r2_score, mean_squared_error
 
 import sensingbee.utils as utils
+import sensingbee.storage as storage
+import sensingbee.instrumentation as instrumentation
+from sensingbee.sensorstore import SensorStore
+from sensingbee.featurestore import FeatureStore
+from sensingbee.idw import IDWRegressor
 
 
 class Sensors(object):
@@ -27,18 +44,23 @@ class Sensors(object):
     uncallibrated sensors (it will cut sensors with samples mean upper than the threshold).
     Besides the configuration, the instantiation parameter `mode` is required. It has the options
     of "make" a new object based on two csv files (data.csv and sensors.csv, containing the
-    sensors samples and metainformation respectively), "load" for loading pre-maked data, but
+    sensors samples and metainformation respectively; data.csv is read and resampled in chunks
+    of `configuration__['Sensors__chunksize']` rows, see utils.read_resampled_csv, and the bins of multi-day
+    frequencies such as '2D' are counted from `configuration__['Sensors__origin']`, 'epoch' by default), "load" for loading pre-maked data, but
     also "get", that can pull data from API, such as Urban Observatory open sensors API, that
-    should use information on parameter `path` to make the request.
+    should use information on parameter `path` to make the request (url, start_time and end_time;
+    the window is fetched concurrently in chunks, see utils.fetch_csv).
+    With `configuration__['Sensors__store'] = 'compact'`, the data is then kept in a compact
+    store (see compact and sensorstore.SensorStore) and Sensors.data is a frame view of it.
     """
+    @instrumentation.timed('Sensors', rows=lambda self, result: len(utils.data_source(self)), sensors=lambda self, result: len(self.sensors))
     def __init__(self, configuration__, mode, path, delimit_geography=None, delimit_quantiles=True, delimit_data_by_threshold=True):
         idx = pd.IndexSlice
         if mode=='get':
-            path['start_time'] = path['start_time'].replace('-','')
-            path['end_time'] = path['end_time'].replace('-','')
-            path['variable'] = '-and-'.join(configuration__['Sensors__variables']).lower()
-            data = pd.read_csv('{}?start_time={}000000&end_time={}005959&variable={}'.format(
-                                    path['url'], path['start_time'], path['end_time'], path['variable']))
+            data = utils.fetch_csv(path['url'], path['start_time'], path['end_time'], configuration__['Sensors__variables'],
+                                    chunk_days=configuration__.get('Sensors__fetch_days', 1),
+                                    n_jobs=configuration__.get('Sensors__fetch_jobs', 8),
+                                    retries=configuration__.get('Sensors__fetch_retries', 3))
             data['Timestamp'] = pd.to_datetime(data['Timestamp'])
             self.sensors = data.loc[:,['type','active','lon','lat','name']].set_index('name')
             self.sensors = gpd.GeoDataFrame(self.sensors,
@@ -48,10 +70,10 @@ class Sensors(object):
             self.data = self.data.loc[idx[configuration__['Sensors__variables']],:]
             self.sensors = self.sensors.loc[self.data.index.get_level_values(1).unique()]
             self.sensors.drop_duplicates(['lon','lat'], inplace=True)
-            self.data, self.sensors = self.resample_by_frequency(configuration__['Sensors__frequency'])
+            self.data, self.sensors = self.resample_by_frequency(configuration__['Sensors__frequency'], configuration__.get('Sensors__origin', 'epoch'))
             self.data.index.names = ['Variable','Sensor Name','Timestamp']
             if delimit_geography is not None:
-                self.delimit_sensors_by_geography(delimit_geography.city)
+                self.delimit_sensors_by_geography(delimit_geography.city, delimit_geography.prepared_city)
             if delimit_quantiles:
                 self.delimit_sensors_by_osm_quantile(osm_args={
                     'Geography': delimit_geography,
@@ -64,15 +86,16 @@ class Sensors(object):
             self.sensors = gpd.GeoDataFrame(self.sensors[['type','active','lon','lat']],
                                     geometry=[shapely.geometry.Point(xy) for xy in zip(self.sensors['lon'], self.sensors['lat'])],
                                     crs={'init': 'epsg:4326'}).to_crs(fiona.crs.from_epsg(4326))
-            self.data = pd.read_csv(path+'data.csv')
-            self.data['Timestamp'] = pd.to_datetime(self.data['Timestamp'])
-            self.data = self.data.set_index(['Variable','Sensor Name','Timestamp'])
-            self.data = self.data.loc[idx[configuration__['Sensors__variables']],:]
-            self.sensors = self.sensors.loc[self.data.index.get_level_values(1).unique()]
+            self.data, sensors_in_data = utils.read_resampled_csv(path+'data.csv',
+                                    configuration__['Sensors__variables'], self.sensors.index,
+                                    configuration__['Sensors__frequency'], configuration__.get('Sensors__chunksize', 1000000),
+                                    configuration__.get('Sensors__origin', 'epoch'))
+            self.sensors = self.sensors.loc[sensors_in_data]
             self.sensors.drop_duplicates(['lon','lat'], inplace=True)
-            self.data, self.sensors = self.resample_by_frequency(configuration__['Sensors__frequency'])
+            self.data = self.data.loc[idx[:,self.sensors.index,:],:]
+            self.sensors = self.sensors.loc[self.data.index.get_level_values(1).unique()]
             if delimit_geography is not None:
-                self.delimit_sensors_by_geography(delimit_geography.city)
+                self.delimit_sensors_by_geography(delimit_geography.city, delimit_geography.prepared_city)
             if delimit_quantiles:
                 self.delimit_sensors_by_osm_quantile(osm_args={
                     'Geography': delimit_geography,
@@ -81,63 +104,135 @@ class Sensors(object):
                 })
             if delimit_data_by_threshold:
                 self.delimit_data_by_threshold(configuration__['Sensors__threshold_callibration'])
-            self.data.to_csv(configuration__['DATA_FOLDER']+'data__.csv')
-            self.sensors.to_csv(configuration__['DATA_FOLDER']+'sensors__.csv')
+            self.save(configuration__['DATA_FOLDER'])
         elif mode=='load':
-            self.sensors = pd.read_csv(path+'sensors__.csv', index_col=0)
-            self.sensors = gpd.GeoDataFrame(self.sensors, geometry=[shapely.geometry.Point(xy) for xy in zip(self.sensors['lon'], self.sensors['lat'])])
-            self.data = pd.read_csv(path+'data__.csv')
-            self.data['Timestamp'] = pd.to_datetime(self.data['Timestamp'])
-            self.data = self.data.set_index(['Variable','Sensor Name','Timestamp'])
-
-    # Used for drop sensors outside a Geography object.
-    def delimit_sensors_by_geography(self, geography_city):
-        idx = pd.IndexSlice
+            if storage.exists(storage.artifact_path(path, 'data__')):
+                self.load(path)
+            else:
+                self.load_csv(path)
+        if configuration__.get('Sensors__store') == 'compact':
+            self.compact()
+
+    # The samples, indexed by (Variable, Sensor Name, Timestamp). With a compact store, this
+    # is the store's frame view, and assigning a frame replaces the store by one made of it.
+    @property
+    def data(self):
+        store = self.__dict__.get('store')
+        return store.frame() if store is not None else self.__dict__.get('_data')
+
+    @data.setter
+    def data(self, data):
+        if self.__dict__.get('store') is not None:
+            self.store = SensorStore.from_frame(data)
+        else:
+            self._data = data
+
+    # Keeps the data in a compact store (variables and sensors as codes, float32 values,
+    # indexed by (variable, timestamp), see sensorstore.SensorStore) instead of the frame.
+    # The features' ingestion reads the samples from the store, slicing it by timestamp.
+    def compact(self):
+        if self.__dict__.get('store') is None:
+            self.store = SensorStore.from_frame(self._data)
+            self._data = None
+        return self
+
+    # Used for storing the sensors and their data, both as binary artifacts (see the storage
+    # module), which are the ones read by mode="load", and as csv files.
+    def save(self, DATA_FOLDER):
+        storage.save_frame(self.data, storage.artifact_path(DATA_FOLDER, 'data__'))
+        storage.save_frame(self.sensors, storage.artifact_path(DATA_FOLDER, 'sensors__'))
+        self.data.to_csv(DATA_FOLDER+'data__.csv')
+        self.sensors.to_csv(DATA_FOLDER+'sensors__.csv')
+        return self
+
+    # Used for loading the binary artifacts written by save.
+    def load(self, DATA_FOLDER, mmap=True):
+        self.sensors = storage.load_frame(storage.artifact_path(DATA_FOLDER, 'sensors__'), mmap)
+        self.data = storage.load_frame(storage.artifact_path(DATA_FOLDER, 'data__'), mmap)
+        return self
+
+    # Used for loading the csv files written by save, when there are no binary artifacts.
+    def load_csv(self, DATA_FOLDER):
+        self.sensors = pd.read_csv(DATA_FOLDER+'sensors__.csv', index_col=0)
+        self.sensors = gpd.GeoDataFrame(self.sensors, geometry=[shapely.geometry.Point(xy) for xy in zip(self.sensors['lon'], self.sensors['lat'])])
+        self.data = pd.read_csv(DATA_FOLDER+'data__.csv')
+        self.data['Timestamp'] = pd.to_datetime(self.data['Timestamp'])
+        self.data = self.data.set_index(['Variable','Sensor Name','Timestamp'])
+        return self
+
+    # Used for drop sensors outside a Geography object. The prepared city geometry
+    # (Geography.prepared_city) is used if given.
+    @instrumentation.timed('delimit_sensors_by_geography', rows=lambda self, result: len(self.data))
+    def delimit_sensors_by_geography(self, geography_city, prepared_city=None):
         self.sensors.crs = geography_city.crs
-        self.sensors = gpd.sjoin(self.sensors, geography_city, how='inner' ,op='intersects')[self.sensors.columns]
-        self.data = self.data.loc[idx[:,self.sensors.index,:],:]
+        if prepared_city is None:
+            prepared_city = shapely.prepared.prep(shapely.ops.unary_union(geography_city['geometry']))
+        self.sensors = self.sensors.loc[utils.intersects(self.sensors, prepared_city)]
+        self.data = self.data.loc[utils.level_isin(self.data.index, 1, self.sensors.index)]
         return self
 
     # Used for drop sensors outside the reasonable area delimited by OpenStreetMaps features.
     # This is made to avoid bias on predicting/interpolating for zones which the urban configuration
     # is not properly similar to where data is collected.
+    @instrumentation.timed('delimit_sensors_by_osm_quantile', rows=lambda self, result: len(self.data))
     def delimit_sensors_by_osm_quantile(self, osm_args):
-        idx = pd.IndexSlice
         osm_args['input_pointdf'] = self.sensors
         osm_df = Features({},mode=None).make_osm_features(**osm_args)
         quantiles = osm_df.quantile(0.5)
-        osm_df = osm_df.loc[osm_df.apply(lambda x: True if np.any(x>quantiles) else False, axis=1)]
+        osm_df = osm_df.loc[(osm_df > quantiles).any(axis=1)]
         self.sensors = self.sensors.loc[osm_df.index]
-        self.data = self.data.loc[idx[:,osm_df.index,:],:]
+        self.data = self.data.loc[utils.level_isin(self.data.index, 1, osm_df.index)]
         return self
 
     # Used for drop sensors considered uncallibrated due to their samples average
     # is beyond an reasonable threshold. A t_dict parameter should have as keys
-    # the variables' names and as values the corresponding thresold.
+    # the variables' names and as values the corresponding thresold. The means of all
+    # (variable, sensor) pairs are computed at once from the index codes, and the share
+    # of sensors and of samples dropped per variable are kept in dropped_sensors and
+    # dropped_data.
+    @instrumentation.timed('delimit_data_by_threshold', rows=lambda self, result: len(self.data))
     def delimit_data_by_threshold(self, t_dict):
-        off, self.dropped_sensors, self.dropped_data = {}, {}, {}
+        self.dropped_sensors, self.dropped_data = {}, {}
+        index = self.data.index
+        variables, n_sensors = index.levels[0], len(index.levels[1])
+        pair = np.asarray(index.codes[0], dtype=np.int64)*n_sensors + np.asarray(index.codes[1])
+        values = self.data['Value'].values.astype(float)
+        valid = ~np.isnan(values)
+        shape = (len(variables), n_sensors)
+        rows = np.bincount(pair, minlength=shape[0]*shape[1]).reshape(shape)
+        counts = np.bincount(pair[valid], minlength=shape[0]*shape[1]).reshape(shape)
+        sums = np.bincount(pair[valid], weights=values[valid], minlength=shape[0]*shape[1]).reshape(shape)
+        off = np.zeros(shape, dtype=bool)
         for var, threshold in t_dict.items():
-            D = self.data.loc[var]['Value']
-            off[var] = []
-            for i,si in enumerate(D.index.get_level_values(0).unique()):
-                if D.loc[si].mean() > threshold:
-                    off[var].append((var,si))
-            self.dropped_sensors[var] = len(off[var])/i
-            self.dropped_data[var] = 1 - (self.data.drop(off[var]).loc[var].shape[0]/self.data.loc[var].shape[0])
-            self.data = self.data.drop(off[var])
+            if var not in variables:
+                continue
+            v = variables.get_loc(var)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                off[v] = sums[v]/counts[v] > threshold
+            self.dropped_sensors[var] = off[v].sum()/max((rows[v] > 0).sum(), 1)
+            self.dropped_data[var] = rows[v][off[v]].sum()/max(rows[v].sum(), 1)
+        self.data = self.data.loc[~off.ravel()[pair]]
         return self
 
     # Used for resampling the data by a frequency parameter, i.e. 'D' for daily,
-    # 'W' for weekly etc.
-    def resample_by_frequency(self, frequency):
+    # 'W' for weekly etc, with the bins counted from `origin` as utils.read_resampled_csv does.
+    @instrumentation.timed('resample', rows=lambda self, result: len(result[0]))
+    def resample_by_frequency(self, frequency, origin='epoch'):
         idx = pd.IndexSlice
         level_values = self.data.index.get_level_values
         self.data = (self.data.groupby([level_values(i) for i in [0,1]]
-                           +[pd.Grouper(freq=frequency, level=-1)]).median())
+                           +[pd.Grouper(freq=frequency, level=-1, origin=origin)]).median())
         self.data = self.data.loc[idx[:,self.sensors.index,:],:]
         self.sensors = self.sensors.loc[self.data.index.get_level_values(1).unique()]
         return self.data, self.sensors
 
+    # Used for getting a copy of the sensors with the data aggregated (by the median) to a
+    # coarser frequency, e.g. the daily data of hourly Sensors, keeping the original one.
+    def aggregate(self, frequency, origin='epoch'):
+        aggregated = copy.copy(self)
+        aggregated.resample_by_frequency(frequency, origin)
+        return aggregated
+
 
 class Geography(object):
     """
@@ -147,24 +242,17 @@ class Geography(object):
     (and optionally a filter label to delimit the shapefile subobjects considered, e.g. if you are using a
     shapefile from a whole country but only want to work with a single city within it), the (2) OSM features
     parameters such as the bounding box, highway-line (primary, trunk ...) and highway-point (traffic_signals, ...)
-    type names. Also, this class implements the creation of the meshgrid that the interpolation will be applied,
+    type names (these are cached locally after the first pull, and can also be read from a local OSM extract,
+    see `load_osm`). Also, this class implements the creation of the meshgrid that the interpolation will be applied,
     and this meshgrid should be configured in `configuration__` dictionary with the (3) meshgrid's dimensions,
     and latitude/longitude ranges for rectangular boundaries, so that a file will be created with the meshgrid
     geometries in a (4) data folder. All those enumerate itens are required in `configuration__`. If it's the
     first time that Geography is instantiated, you have to call it with `mode`="make".
     """
+    @instrumentation.timed('Geography', rows=lambda self, result: len(self.meshgrid))
     def __init__(self, configuration__, mode='load'):
-        self.city = gpd.read_file(configuration__['SHAPE_PATH']+'')
-        try:
-            self.city = self.filter_by_label(configuration__['Geography__filter_column'],configuration__['Geography__filter_label'])
-        except:
-            pass
-        self.city = self.city.to_crs(fiona.crs.from_epsg(4326))
-        self.city.crs = {'init': 'epsg:4326', 'no_defs': True}
-        self.city = gpd.GeoDataFrame(geometry=gpd.GeoSeries(shapely.ops.cascaded_union(self.city['geometry'])))
-        self.lines, self.points = utils.pull_osm_objects(configuration__['osm_bbox'],
-                            configuration__['osm_line_objs'], configuration__['osm_point_objs']) # OSM api
-        self.delimit_osm_by_city()
+        self.load_city(configuration__)
+        self.load_osm(configuration__)
         self.make_meshgrid(**configuration__['Geography__meshgrid'])
         if mode=='make':
             self.delimit_meshgrid_by_quantiles({
@@ -172,26 +260,88 @@ class Geography(object):
                 'input_pointdf': self.meshgrid,
                 'line_objs': configuration__['osm_line_objs'],
                 'point_objs': configuration__['osm_point_objs']
-            }).to_csv(configuration__['DATA_FOLDER']+'meshgrid.csv')
+            })
+            storage.save_frame(self.meshgrid, storage.artifact_path(configuration__['DATA_FOLDER'], 'meshgrid'))
+            self.meshgrid.to_csv(configuration__['DATA_FOLDER']+'meshgrid.csv')
         elif mode=='load':
-            self.load_meshgrid_csv(configuration__['DATA_FOLDER']+'meshgrid.csv')
+            if storage.exists(storage.artifact_path(configuration__['DATA_FOLDER'], 'meshgrid')):
+                self.meshgrid = storage.load_frame(storage.artifact_path(configuration__['DATA_FOLDER'], 'meshgrid'))
+            else:
+                self.load_meshgrid_csv(configuration__['DATA_FOLDER']+'meshgrid.csv')
 
-    # Used for filtering shapefile with a column and a label. Example: your shapefile is for
-    # the whole UK, but you just want the geometries that have "name"=="London".
-    def filter_by_label(self, column, label):
-        return self.city[self.city[column].str.contains(label)]
+    # Used for getting the city geometry, i.e. the union of the shapefile objects (filtered by label, if
+    # configured), simplified with `configuration__['Geography__simplify_tolerance']` (default 1e-5 degrees).
+    # Only the shapefile objects within `configuration__['Geography__read_bbox']` (default: the osm_bbox,
+    # None reads the whole file) are read, and the result is cached in the data folder, keyed by the
+    # shapefile (with the mtime and size of its files, so an edited shapefile is read again) and those
+    # parameters. A prepared version of the geometry is kept for the point-in-city tests.
+    @instrumentation.timed('load_city')
+    def load_city(self, configuration__):
+        read_bbox = configuration__.get('Geography__read_bbox', configuration__.get('osm_bbox'))
+        tolerance = configuration__.get('Geography__simplify_tolerance', 1e-5)
+        stem = os.path.splitext(configuration__['SHAPE_PATH'])[0]
+        files = sorted(set([configuration__['SHAPE_PATH']] + [stem+ext for ext in ['.shp','.shx','.dbf','.prj','.cpg']]))
+        stats = [(os.path.basename(f), os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in files if os.path.isfile(f)]
+        key = hashlib.sha1(json.dumps([os.path.abspath(configuration__['SHAPE_PATH']), stats,
+                                       configuration__.get('Geography__filter_column'), configuration__.get('Geography__filter_label'),
+                                       read_bbox, tolerance]).encode()).hexdigest()
+        cache_path = storage.artifact_path(configuration__['DATA_FOLDER'], 'city_{}'.format(key[:16]))
+        if storage.exists(cache_path):
+            self.city = storage.load_frame(cache_path)
+        else:
+            self.city = utils.read_shapefile(configuration__['SHAPE_PATH'], read_bbox,
+                                configuration__.get('Geography__filter_column'), configuration__.get('Geography__filter_label'))
+            self.city = self.city.to_crs(fiona.crs.from_epsg(4326))
+            city = shapely.ops.unary_union(self.city['geometry'])
+            if tolerance:
+                city = city.simplify(tolerance, preserve_topology=True)
+            self.city = gpd.GeoDataFrame(geometry=gpd.GeoSeries([city]))
+            storage.save_frame(self.city, cache_path)
+        self.city.crs = {'init': 'epsg:4326', 'no_defs': True}
+        self.prepared_city = shapely.prepared.prep(self.city['geometry'].iloc[0])
+        return self
+
+    # Used for getting the OpenStreetMaps objects delimited by the city. They are read from a
+    # local cache in `configuration__['osm_cache_folder']` (default: DATA_FOLDER/osm_cache/, None
+    # disables it) keyed by the bbox, objects' types and city geometry. Otherwise, they are read
+    # from a local extract in `configuration__['osm_file']` (GeoJSON or OSM XML) if given, or
+    # pulled from the Overpass API, and then cached.
+    @instrumentation.timed('load_osm', rows=lambda self, result: len(self.lines)+len(self.points))
+    def load_osm(self, configuration__):
+        cache_folder = configuration__.get('osm_cache_folder', configuration__.get('DATA_FOLDER','')+'osm_cache/')
+        if cache_folder is not None:
+            key = hashlib.sha1(json.dumps([configuration__['osm_bbox'], sorted(configuration__['osm_line_objs']),
+                                           sorted(configuration__['osm_point_objs'])]).encode()
+                               + self.city['geometry'].iloc[0].wkb).hexdigest()
+            cache_path = os.path.join(cache_folder, key)
+            if storage.exists(os.path.join(cache_path, 'lines.frame')) and storage.exists(os.path.join(cache_path, 'points.frame')):
+                self.lines = storage.load_frame(os.path.join(cache_path, 'lines.frame'))
+                self.points = storage.load_frame(os.path.join(cache_path, 'points.frame'))
+                return self
+        if configuration__.get('osm_file') is not None:
+            self.lines, self.points = utils.read_osm_file(configuration__['osm_file'], configuration__['osm_bbox'],
+                                configuration__['osm_line_objs'], configuration__['osm_point_objs'])
+        else:
+            self.lines, self.points = utils.pull_osm_objects(configuration__['osm_bbox'],
+                                configuration__['osm_line_objs'], configuration__['osm_point_objs']) # OSM api
+        self.delimit_osm_by_city()
+        if cache_folder is not None:
+            storage.save_frame(self.lines, os.path.join(cache_path, 'lines.frame'))
+            storage.save_frame(self.points, os.path.join(cache_path, 'points.frame'))
+        return self
 
     # Used for delimit the OpenStreetMaps geometries that are inside Geography.city,
     # corresponding to the shapefile object.
     def delimit_osm_by_city(self):
         self.lines.crs = self.city.crs
-        self.lines = gpd.sjoin(self.lines, self.city, how='inner', op='intersects')[self.lines.columns]
+        self.lines = self.lines.loc[utils.intersects(self.lines, self.prepared_city)]
         self.points.crs = self.city.crs
-        self.points = gpd.sjoin(self.points, self.city, how='inner', op='intersects')[self.points.columns]
+        self.points = self.points.loc[utils.intersects(self.points, self.prepared_city)]
         return self
 
     # Used to produce the geospatial dataframe for the meshgrid collection of dimension[0]*dimension[1]
     # points, given the boundaries imposed by longitude_range and latitude_range.
+    @instrumentation.timed('make_meshgrid', rows=lambda self, result: len(self.meshgrid))
     def make_meshgrid(self, dimensions, longitude_range, latitude_range, delimit=False):
         self.meshdimensions = dimensions
         self.longitude_range = longitude_range
@@ -202,7 +352,7 @@ class Geography(object):
         self.meshgrid = gpd.GeoDataFrame(self.meshgrid, geometry=[shapely.geometry.Point(xy) for xy in self.meshgrid],crs={'init': 'epsg:4326'})
         self.meshgrid.rename(columns={0:'lon',1:'lat'}, inplace=True)
         self.meshgrid.crs = self.city.crs
-        self.meshgrid = gpd.sjoin(self.meshgrid, self.city, how='inner', op='intersects')[self.meshgrid.columns]
+        self.meshgrid = self.meshgrid.loc[utils.intersects(self.meshgrid, self.prepared_city)]
         # if delimit:
         #     self.meshgrid = delimit_meshgrid_by_quantiles()
         return self
@@ -210,11 +360,11 @@ class Geography(object):
     # Used to filter the points in the meshgrid that are proper to have predictions/interpolation
     # in order to avoid regions with the urban configuration critically different from where
     # data is collected.
+    @instrumentation.timed('delimit_meshgrid_by_quantiles', rows=lambda self, result: len(result))
     def delimit_meshgrid_by_quantiles(self, osm_args):
-        idx = pd.IndexSlice
         osm_df = Features({},mode=None).make_osm_features(**osm_args)
         quantiles = osm_df.quantile(0.5)
-        osm_df = osm_df.loc[osm_df.apply(lambda x: True if np.any(x>quantiles) else False, axis=1)]
+        osm_df = osm_df.loc[(osm_df > quantiles).any(axis=1)]
         self.meshgrid = self.meshgrid.loc[osm_df.index].join(osm_df)
         return self.meshgrid
 
@@ -244,43 +394,206 @@ class Features(object):
     to the prediction, it will be necessary to ingest features for the meshgrid, and the Feature object
     also returns a feature matrix for the meshgrid.
 
-    *The ingestion method when making new features are a very slow method, so for reuse already
-    made features, you can use the `mode`="load".
+    *The ingestion (utils.knn_ingestion) is still the most expensive step when making new features,
+    so for reuse already made features, you can use the `mode`="load".
 
     Examples:
         - to instantiate by making new features
             features = Features(configuration__, mode='make', Sensors, Geography)
         - to instantiate by loading pre-made zx and zi
             features = Features(configuration__, mode='load')
+        - to append features for new data to the pre-made zx and zi
+            features = Features(configuration__, mode='update', Sensors, Geography)
         - having zx and zi, to get train features for a particular variable*
             no2_X, no2_y = features.get_train_features('NO2')
             t_X, t_y = features.get_train_features('Temperature')
         *these X and y are the matrixes used by Model
+
+    With `configuration__['Features__store'] = 'dense'`, the features are then kept in a dense
+    float32 store (see densify and featurestore.FeatureStore), from which get_train_features
+    gives views, and Features.zx is a frame export of it.
     """
     def __init__(self, configuration__, mode='load', Sensors=None, Geography=None, save=True):
-        if mode == 'load':
-            self.zx, self.zi = self.load_csv(configuration__['DATA_FOLDER'], configuration__['Sensors__frequency'])
+        if mode not in ('load', 'make', 'update'):
+            return
+        with instrumentation.span('Features', mode=mode) as s:
+            if mode == 'load':
+                self.restore(configuration__['DATA_FOLDER'], configuration__['Sensors__frequency'])
+            elif mode == 'make':
+                t0 = time.time()
+                self.ingest(configuration__, Sensors, Geography)
+                if save:
+                    self.save(configuration__['DATA_FOLDER'], self.frequency)
+                print('Features ingested and saved in {} seconds'.format(time.time()-t0))
+            elif mode == 'update':
+                self.restore(configuration__['DATA_FOLDER'], configuration__['Sensors__frequency'])
+                self.update(configuration__, Sensors, Geography, save)
+            if configuration__.get('Features__store') == 'dense':
+                self.densify()
+            s.set(rows=len(self.zi))
+
+    # The feature matrix, indexed by (Sensor Name, Timestamp). With a dense store, this is
+    # the store's frame export, and assigning a frame replaces the store by one made of it
+    # and of zi (so zi is to be assigned first).
+    @property
+    def zx(self):
+        store = self.__dict__.get('store')
+        return store.frame() if store is not None else self.__dict__.get('_zx')
+
+    @zx.setter
+    def zx(self, zx):
+        if self.__dict__.get('store') is not None:
+            self.store = FeatureStore.from_frames(zx, self.zi)
+        else:
+            self._zx = zx
+
+    # Keeps the features in a dense float32 store (samples of each variable by channels, see
+    # featurestore.FeatureStore) instead of the zx frame, so that get_train_features gives
+    # views of it instead of joining zx and zi.
+    def densify(self):
+        if self.__dict__.get('store') is None:
+            self.store = FeatureStore.from_frames(self._zx, self.zi)
+            self._zx = None
+        return self
+
+    # Used for ingesting zx and zi from the data of a Sensors object at `frequency` (default:
+    # configuration__['Sensors__frequency']), which sets the calendar channels of zx. The
+    # static features can be given as (osm_features, deprivation_features), so that they
+    # are not made again for each frequency (see MultiFrequencyFeatures).
+    def ingest(self, configuration__, Sensors, Geography, frequency=None, static_features=None):
+        self.frequency = frequency if frequency is not None else configuration__['Sensors__frequency']
+        if static_features is None:
+            static_features = self.make_static_features(configuration__, Sensors, Geography)
+        osm_features, deprivation_features = static_features
+        zx, self.zi = utils.knn_ingestion(Sensors, configuration__['Sensors__variables'], k=5, osmf=osm_features,
+                                    deprf=deprivation_features, freq=self.frequency)
+        self.zx = zx.dropna(axis=0)
+        self.static = static_frame(osm_features, deprivation_features, configuration__['osm_line_objs']+configuration__['osm_point_objs'])
+        return self
+
+    # Used for loading the already-made zx and zi, from the binary artifacts when
+    # they exist or from the csv files otherwise.
+    def restore(self, DATA_FOLDER, frequency):
+        self.frequency, self.static = frequency, None
+        if storage.exists(storage.artifact_path(DATA_FOLDER, 'zx_{}'.format(frequency))):
+            self.load(DATA_FOLDER, frequency)
+        else:
+            self.zx, self.zi = self.load_csv(DATA_FOLDER, frequency)
             self.zx.rename({'PM2':'PM2.5','d_PM2':'d_PM2.5','PM1':'PM1.0','d_PM1':'d_PM1.0'},axis='columns',inplace=True)
-            self.zx.dropna(axis=0,inplace=True)
             self.zi = self.zi.set_index('Variable',append=True).swaplevel(1,2).swaplevel(0,1)
-        elif mode == 'make':
-            t0 = time.time()
-            osm_features = self.make_osm_features(Geography, Sensors.sensors,
-                                        configuration__['osm_line_objs'],
-                                        configuration__['osm_point_objs'])
-            # try:
-            deprivation_features = utils.pull_depr_sensors(Sensors)
-            # except:
-                # print('Deprivation features not extracted')
-                # deprivation_features = None
-            self.zx, self.zi = utils.ingestion3(Sensors, configuration__['Sensors__variables'], k=5, osmf=osm_features, deprf=deprivation_features, freq='D')
-            self.zx.dropna(axis=0,inplace=True)
-            if save:
-                self.zx.to_csv(configuration__['DATA_FOLDER']+'zx_{}.csv'.format(configuration__['Sensors__frequency']))
-                self.zi.to_csv(configuration__['DATA_FOLDER']+'zi_{}.csv'.format(configuration__['Sensors__frequency']))
-            print('Features ingested and saved in {} seconds'.format(time.time()-t0))
-
-    # Used for load already-made feature matrixes zx and zi
+        self.zx = self.zx.dropna(axis=0)
+        return self
+
+    # Used for extracting the features that only depend on the sensors' location, i.e.
+    # OpenStreetMaps and deprivation features, for the sensors in a Sensors object. The LSOA
+    # shapefile and deprivation csv can be set in configuration__['LSOA_PATH'] and
+    # configuration__['DEPRIVATION_PATH'].
+    @instrumentation.timed('make_static_features')
+    def make_static_features(self, configuration__, Sensors, Geography):
+        osm_features = self.make_osm_features(Geography, Sensors.sensors,
+                                    configuration__['osm_line_objs'],
+                                    configuration__['osm_point_objs'])
+        # try:
+        deprivation_features = utils.pull_depr_sensors(Sensors, configuration__.get('LSOA_PATH'), configuration__.get('DEPRIVATION_PATH'))
+        # except:
+            # print('Deprivation features not extracted')
+            # deprivation_features = None
+        return osm_features, deprivation_features
+
+    # Used for appending the features of new data to the already-made zx and zi. Only
+    # the timestamps of Sensors.data that are not in zi yet are ingested, the static features
+    # of the sensors already known are reused (from `static`, see static_frame) and only the
+    # new rows are written (see save_partition) and, with a dense store, indexed (see
+    # FeatureStore.append), so the cost depends on the size of the new data and not on the
+    # size of the history (but for copying the arrays or frames they are appended to).
+    @instrumentation.timed('update', rows=lambda self, result: len(self.zi))
+    def update(self, configuration__, Sensors, Geography, save=True):
+        t0 = time.time()
+        known_times = self.zi.index.get_level_values(2).unique()
+        sens_times = utils.data_sensors_times(Sensors)[1]
+        new_times = sens_times[~sens_times.isin(known_times)]
+        if len(new_times) == 0:
+            print('Features already up to date')
+            return self
+        new = copy.copy(Sensors)
+        if isinstance(utils.data_source(Sensors), SensorStore):
+            new.store = Sensors.store.subset(new_times)
+        else:
+            new.data = Sensors.data.loc[utils.level_isin(Sensors.data.index, 2, new_times)]
+        new.sensors = Sensors.sensors.loc[utils.data_sensors_times(new)[0]]
+        osm_columns = configuration__['osm_line_objs'] + configuration__['osm_point_objs']
+        if getattr(self, 'static', None) is None: # features made before the static ones were kept
+            self.static = self.zx.groupby(level=0).first().reindex(columns=[c for c in osm_columns+utils.DEPRIVATION_COLUMNS if c in self.zx.columns])
+        unseen = copy.copy(new)
+        unseen.sensors = new.sensors.loc[~new.sensors.index.isin(self.static.index)]
+        if unseen.sensors.shape[0] > 0:
+            unseen_static = static_frame(*self.make_static_features(configuration__, unseen, Geography), osm_columns=osm_columns)
+            self.static = pd.concat([self.static, unseen_static[self.static.columns]])
+        osm_features = self.static[osm_columns] if set(osm_columns).issubset(self.static.columns) else None
+        deprivation_features = self.static[utils.DEPRIVATION_COLUMNS] if set(utils.DEPRIVATION_COLUMNS).issubset(self.static.columns) else None
+        frequency = getattr(self, 'frequency', configuration__['Sensors__frequency'])
+        zx, zi = utils.knn_ingestion(new, configuration__['Sensors__variables'], k=5, osmf=osm_features, deprf=deprivation_features, freq=frequency)
+        zx.dropna(axis=0,inplace=True)
+        columns = self.store.names if self.__dict__.get('store') is not None else list(self.zx.columns)
+        if list(zx.columns) != list(columns):
+            raise ValueError('The new features have a different layout from the stored ones: {}'.format(list(zx.columns)))
+        self.zi = pd.concat([self.zi, zi])
+        if self.__dict__.get('store') is not None:
+            self.store = self.store.append(zx, zi)
+        else:
+            self.zx = pd.concat([self.zx, zx])
+        if save:
+            if storage.exists(storage.artifact_path(configuration__['DATA_FOLDER'], 'zx_{}'.format(frequency))):
+                self.save_partition(configuration__['DATA_FOLDER'], frequency, zx, zi)
+            else: # restored from the csv files
+                self.save(configuration__['DATA_FOLDER'], frequency)
+        print('Features updated with {} new timestamps in {} seconds'.format(
+                zi.index.get_level_values(2).nunique(), time.time()-t0))
+        return self
+
+    # Used for storing the feature matrixes zx and zi, both as binary artifacts (see
+    # the storage module), which keep the repeated channel names as they are, and as csv files,
+    # with the static features of the sensors. The partitions written by update are merged in.
+    def save(self, DATA_FOLDER, frequency):
+        storage.save_frame(self.zx, storage.artifact_path(DATA_FOLDER, 'zx_{}'.format(frequency)))
+        storage.save_frame(self.zi, storage.artifact_path(DATA_FOLDER, 'zi_{}'.format(frequency)))
+        if getattr(self, 'static', None) is not None:
+            storage.save_frame(self.static, storage.artifact_path(DATA_FOLDER, 'static_{}'.format(frequency)))
+        for paths in partitions(DATA_FOLDER, frequency):
+            for path in paths:
+                shutil.rmtree(path)
+        self.zx.to_csv(DATA_FOLDER+'zx_{}.csv'.format(frequency))
+        self.zi.to_csv(DATA_FOLDER+'zi_{}.csv'.format(frequency))
+        return self
+
+    # Used for storing the rows appended by update as a new partition of the binary artifacts,
+    # which load merges, instead of writing the whole history again. The rows are appended to
+    # the csv files too, so that they stay a copy of the features.
+    def save_partition(self, DATA_FOLDER, frequency, zx, zi):
+        n = len(partitions(DATA_FOLDER, frequency))
+        storage.save_frame(zx, storage.artifact_path(DATA_FOLDER, 'zx_{}__part{}'.format(frequency, n)))
+        storage.save_frame(zi, storage.artifact_path(DATA_FOLDER, 'zi_{}__part{}'.format(frequency, n)))
+        storage.save_frame(self.static, storage.artifact_path(DATA_FOLDER, 'static_{}'.format(frequency)))
+        for frame, name in [(zx, 'zx'), (zi, 'zi')]:
+            if os.path.isfile(DATA_FOLDER+'{}_{}.csv'.format(name, frequency)):
+                frame.to_csv(DATA_FOLDER+'{}_{}.csv'.format(name, frequency), mode='a', header=False)
+        return self
+
+    # Used for load already-made feature matrixes zx and zi from the binary artifacts, with
+    # the partitions appended by update (which are read into memory), and the static features.
+    def load(self, DATA_FOLDER, frequency, mmap=True):
+        zi = [storage.load_frame(storage.artifact_path(DATA_FOLDER, 'zi_{}'.format(frequency)), mmap)]
+        zx = [storage.load_frame(storage.artifact_path(DATA_FOLDER, 'zx_{}'.format(frequency)), mmap)]
+        for zx_path, zi_path in partitions(DATA_FOLDER, frequency):
+            zi.append(storage.load_frame(zi_path, mmap))
+            zx.append(storage.load_frame(zx_path, mmap))
+        self.zi = zi[0] if len(zi) == 1 else pd.concat(zi)
+        self.zx = zx[0] if len(zx) == 1 else pd.concat(zx)
+        static_path = storage.artifact_path(DATA_FOLDER, 'static_{}'.format(frequency))
+        self.static = storage.load_frame(static_path, mmap=False) if storage.exists(static_path) else None
+        return self.zx, self.zi
+
+    # Used for load already-made feature matrixes zx and zi from csv files
     def load_csv(self, DATA_FOLDER, frequency):
         self.zx = pd.read_csv(DATA_FOLDER+'zx_{}.csv'.format(frequency))
         if 'Sensor Name' not in self.zx.columns:
@@ -294,54 +607,217 @@ class Features(object):
         return self.zx, self.zi
 
     # Used to resample feature matrix if wanted to train models in another frequency
-    # different from the Sensors' frequency.
+    # different from the Sensors' frequency. The neighbours' channels are medians of the
+    # finer ones; MultiFrequencyFeatures ingests them from the aggregated data instead.
     def resample_by_frequency(self, frequency):
         idx = pd.IndexSlice
         level_values_zx = self.zx.index.get_level_values
         level_values_zi = self.zi.index.get_level_values
-        self.zx = (self.zx.groupby([level_values_zx(i) for i in [0]]
-                           +[pd.Grouper(freq=frequency, level=-1)]).median())
         self.zi = (self.zi.groupby([level_values_zi(i) for i in [0]]
                            +[pd.Grouper(freq=frequency, level=-1)]).median())
+        self.zx = (self.zx.groupby([level_values_zx(i) for i in [0]]
+                           +[pd.Grouper(freq=frequency, level=-1)]).median())
         return self
 
     # Used in other classes to produce the urban feature matrixes using
-    # the OpenStreetMaps objects in Geography.
-    def make_osm_features(self, Geography, input_pointdf, line_objs, point_objs):
-        osmf = pd.DataFrame(columns=line_objs+point_objs)
-        for m in range(input_pointdf.shape[0]):
-            i = input_pointdf.iloc[m]
-            d = {}
+    # the OpenStreetMaps objects in Geography. The features are the inverse of the
+    # distance to the closest object of each type, queried for all the points at
+    # once through a spatial index built for each type (utils.NearestGeometryIndex).
+    # With an `indexes` dict, the spatial index of each OSM object is kept there and reused
+    # by later calls with the same dict (see Bee.interpolate_points).
+    @instrumentation.timed('make_osm_features', rows=lambda self, result: len(result))
+    def make_osm_features(self, Geography, input_pointdf, line_objs, point_objs, indexes=None):
+        coords = utils.sensors_coordinates(input_pointdf)
+        osmf = pd.DataFrame(index=input_pointdf.index, columns=line_objs+point_objs, dtype=float)
+        indexes = {} if indexes is None else indexes
+        with np.errstate(divide='ignore'):
             for key in line_objs:
-                d[key] = 1/Geography.lines.loc[(Geography.lines['highway']==key) | (Geography.lines['highway']=='{}_link'.format(key)),'geometry'].apply(lambda x: x.distance(i['geometry'])).min()
+                if ('line', key) not in indexes:
+                    lines = Geography.lines.loc[(Geography.lines['highway']==key) | (Geography.lines['highway']=='{}_link'.format(key)),'geometry']
+                    indexes[('line', key)] = utils.NearestGeometryIndex(lines)
+                osmf[key] = 1/indexes[('line', key)].distance(coords)
             for key in point_objs:
-                d[key] = 1/Geography.points.loc[(Geography.points['highway']==key),'geometry'].apply(lambda x: x.distance(i['geometry'])).min()
-            osmf.loc[i.name] = d
+                if ('point', key) not in indexes:
+                    points = Geography.points.loc[(Geography.points['highway']==key),'geometry']
+                    indexes[('point', key)] = utils.NearestGeometryIndex(points)
+                osmf[key] = 1/indexes[('point', key)].distance(coords)
         return osmf
 
-    # Used for pull features for a particular variable from the zx and zi
+    # Used for pull features for a particular variable from the zx and zi (or the views
+    # of them in the dense store)
     def get_train_features(self, variable):
+        if self.__dict__.get('store') is not None:
+            return self.store.get_train_features(variable)
         var_y = self.zi.loc[variable]
         var_x = self.zx.loc[var_y.index]
         return {'X':var_x, 'y': var_y}
 
     # Used for get feature matrixes to feed a trained model in order
-    # to predict/interpolate for the meshgrid
+    # to predict/interpolate for the meshgrid. All the timestamps are ingested
+    # at once, and the result is indexed by (Timestamp, meshgrid cell).
     def mesh_ingestion(self, Sensors, Geography, variables, timestamp=None):
         if timestamp is None or timestamp=='*': #'take all period of Sensors.data'
-            X_mesh = pd.DataFrame()
-            for t in Sensors.data.index.get_level_values(2).unique():
-                zmesh = utils.mesh_ingestion(Sensors, Geography.meshgrid, variables, t)
-                zmesh['Timestamp'] = t
-                zmesh = zmesh.set_index('Timestamp',append=True).swaplevel(0,1)
-                X_mesh = X_mesh.append(zmesh)
+            timestamps = None
         else:
-            timestamp = pd.to_datetime(timestamp)
-            zmesh = utils.mesh_ingestion(Sensors, Geography.meshgrid, variables, timestamp)
-            zmesh['Timestamp'] = timestamp
-            zmesh = zmesh.set_index('Timestamp',append=True).swaplevel(0,1)
-            X_mesh = zmesh
-        return X_mesh
+            timestamps = [pd.to_datetime(timestamp)]
+        zmesh, timestamps, columns = utils.batch_mesh_ingestion(Sensors, Geography.meshgrid, variables, timestamps,
+                                                                freq=getattr(self, 'frequency', 'D'))
+        return utils.mesh_frame(zmesh, timestamps, Geography.meshgrid.index, columns)
+
+
+# The static features of sensors (OSM and deprivation ones) as a single frame indexed by
+# sensor, which Features keeps (as `static`) for update to reuse.
+def static_frame(osm_features, deprivation_features, osm_columns):
+    parts = []
+    if osm_features is not None:
+        parts.append(osm_features[[c for c in osm_columns if c in osm_features.columns]])
+    if deprivation_features is not None:
+        parts.append(pd.DataFrame(deprivation_features[utils.DEPRIVATION_COLUMNS]))
+    parts = [part[~part.index.duplicated()] for part in parts]
+    return pd.concat(parts, axis=1) if parts else pd.DataFrame(index=pd.Index([], name='Sensor Name'))
+
+
+# The (zx, zi) paths of the partitions that Features.update appended, in order.
+def partitions(DATA_FOLDER, frequency):
+    paths, n = [], 0
+    while storage.exists(storage.artifact_path(DATA_FOLDER, 'zx_{}__part{}'.format(frequency, n))):
+        paths.append((storage.artifact_path(DATA_FOLDER, 'zx_{}__part{}'.format(frequency, n)),
+                      storage.artifact_path(DATA_FOLDER, 'zi_{}__part{}'.format(frequency, n))))
+        n += 1
+    return paths
+
+
+class MultiFrequencyFeatures(object):
+    """
+    Features of the same Sensors at several frequencies (e.g. ['H','D','W']), built from the
+    sensors' data at the finest one, `configuration__['Sensors__frequency']`. For each coarser
+    frequency, the data is aggregated (by the median, see Sensors.aggregate) and the neighbours'
+    channels are ingested from the aggregated samples, instead of resampling the finest zx
+    (see Features.resample_by_frequency). The calendar channels are the ones of each frequency
+    (see utils.calendar_columns), and the static (OSM and deprivation) features are made only
+    once for all of them. The Features of each frequency are cached in the data folder as
+    zx_<frequency>/zi_<frequency>, and are made when first needed unless they are cached
+    already (mode="load") or made for all the frequencies at once (mode="make").
+
+    Example:
+        features = MultiFrequencyFeatures(configuration__, ['H','D','W'], Sensors, Geography)
+        weekly = features['W'].get_train_features('NO2')
+    """
+    def __init__(self, configuration__, frequencies, Sensors=None, Geography=None, mode='load', save=True):
+        self.configuration__ = configuration__
+        self.frequencies = list(frequencies)
+        self.sensors, self.geography = Sensors, Geography
+        self.save = save
+        self.features, self.static_features = {}, None
+        if mode == 'make':
+            for frequency in self.frequencies:
+                self.make(frequency)
+
+    # The Features at a frequency, loaded from the data folder if cached there, or made.
+    def __getitem__(self, frequency):
+        if frequency not in self.features:
+            folder = self.configuration__['DATA_FOLDER']
+            if storage.exists(storage.artifact_path(folder, 'zx_{}'.format(frequency))) or os.path.isfile(folder+'zx_{}.csv'.format(frequency)):
+                self.features[frequency] = Features({}, mode=None).restore(folder, frequency)
+                if self.configuration__.get('Features__store') == 'dense':
+                    self.features[frequency].densify()
+            else:
+                self.make(frequency)
+        return self.features[frequency]
+
+    # Used for making (and caching) the Features at a frequency from the Sensors' data,
+    # aggregated to it if it's not the Sensors' frequency.
+    @instrumentation.timed('MultiFrequencyFeatures.make', rows=lambda self, result: len(result.zi))
+    def make(self, frequency):
+        if self.sensors is None:
+            raise ValueError('Sensors are needed for making the features at frequency {}'.format(frequency))
+        t0 = time.time()
+        if self.static_features is None:
+            self.static_features = Features({}, mode=None).make_static_features(self.configuration__, self.sensors, self.geography)
+        sensors = self.sensors
+        if frequency != self.configuration__['Sensors__frequency']:
+            sensors = self.sensors.aggregate(frequency, self.configuration__.get('Sensors__origin', 'epoch'))
+        features = Features({}, mode=None).ingest(self.configuration__, sensors, self.geography, frequency, self.static_features)
+        if self.configuration__.get('Features__store') == 'dense':
+            features.densify()
+        if self.save:
+            features.save(self.configuration__['DATA_FOLDER'], frequency)
+        self.features[frequency] = features
+        print('Features at frequency {} ingested in {} seconds'.format(frequency, time.time()-t0))
+        return features
+
+
+# Fits a copy of the regressor on a CV fold, returning its r2, mse, the fitted copy and
+# the seconds it took (as the fold may run in another process, see Model.collect).
+def _fit_fold(regressor, X, y, train, test, random_state=None):
+    t0 = time.perf_counter()
+    regressor = clone(regressor)
+    if random_state is not None and 'random_state' in regressor.get_params():
+        regressor.set_params(random_state=random_state)
+    regressor.fit(X[train],y[train])
+    X_pred = regressor.predict(X[test])
+    return r2_score(y[test],X_pred), mean_squared_error(y[test],X_pred), regressor, time.perf_counter()-t0
+
+
+# Scores a copy of the regressor with the given parameters on a CV fold, returning its r2,
+# mse and the seconds it took (see Model.tune).
+def _score_fold(regressor, params, X, y, train, test, random_state=None):
+    r2, mse, _, seconds = _fit_fold(clone(regressor).set_params(**params), X, y, train, test, random_state)
+    return r2, mse, seconds
+
+
+# The scaler of the features of a regressor, fitted on X: min-max, or none (identity) for
+# the regressors that read them unscaled (scale_features = False, as idw.IDWRegressor).
+def _fit_scaler(regressor, X):
+    return (MinMaxScaler() if getattr(regressor, 'scale_features', True) else FunctionTransformer()).fit(X)
+
+
+# Regressors that read the features by name (with a `columns` parameter, as
+# idw.IDWRegressor) are given the names of the columns of X.
+def _with_columns(regressor, X):
+    if isinstance(X, pd.DataFrame) and 'columns' in regressor.get_params():
+        regressor.set_params(columns=list(X.columns))
+    return regressor
+
+
+# The regressor of Bee.train when none is given.
+def default_regressor():
+    return GradientBoostingRegressor(n_estimators=200, max_depth=5, max_features=0.5)
+
+
+# Folds the rows X, y into a fitted regressor instead of fitting it again: with partial_fit
+# when it has one, otherwise, for ensembles with warm_start, by adding `n_estimators` more
+# estimators (a tenth of the template's by default) fitted on the rows, to the residuals of
+# the current ones for boosting. Bagged ensembles (a list of estimators_, e.g. random forests)
+# then drop their oldest estimators to keep the template's size. Other regressors are fitted
+# again on the rows only.
+def _fold_in(regressor, template, X, y, n_estimators=None):
+    if hasattr(regressor, 'partial_fit'):
+        return regressor.partial_fit(X, y)
+    params = regressor.get_params()
+    size = 'n_estimators' if 'n_estimators' in params else 'max_iter'
+    if 'warm_start' not in params or size not in params:
+        return regressor.fit(X, y)
+    base = template.get_params()[size]
+    regressor.set_params(warm_start=True, **{size: params[size] + (n_estimators or max(1, base//10))})
+    regressor.fit(X, y)
+    regressor.set_params(warm_start=params['warm_start'])
+    if isinstance(getattr(regressor, 'estimators_', None), list) and len(regressor.estimators_) > base:
+        regressor.estimators_ = regressor.estimators_[-base:]
+        regressor.set_params(**{size: base})
+    return regressor
+
+
+# Latest timestamp of the rows of X, when it is indexed by a Timestamp level (as the
+# training features are), None otherwise.
+def _latest_timestamp(X):
+    if isinstance(X, (pd.DataFrame, pd.Series)) and 'Timestamp' in X.index.names and len(X) > 0:
+        return X.index.get_level_values('Timestamp').max()
+    return None
+
+
+MODEL_ATTRIBUTES = ['regressor','scaler','columns','r2','r2_std','mse','mse_std',
+                    'template','timestamp','updates','holdout_r2','holdout_mse']
 
 
 class Model(object):
@@ -353,45 +829,208 @@ class Model(object):
     to visualize the interpolation. At last, in order to give more information on
     training process, it has a visualization on the learning curve of the regressor.
     """
-    def __init__(self, regressor):
+    def __init__(self, regressor, backend='serial', n_jobs=None, random_state=None):
         self.regressor = regressor
+        self.backend = backend
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.template = None
+        self.scaler = self.columns = None
+        self.r2 = self.r2_std = self.mse = self.mse_std = None
+        self.timestamp = None
+        self.updates = 0
+        self.holdout_r2 = self.holdout_mse = None
 
-    # To reuse pretrained models
-    def load_model(self, MODEL_FILEPATH):
-        return joblib.load(MODEL_FILEPATH)
+    # To reuse pretrained models. It restores the regressor, the scaler fitted on the training
+    # features and their columns from a file written by save_model, with the state of its
+    # incremental updates (see update). With mmap_mode='r', the arrays of the regressor (e.g.
+    # the nodes of tree ensembles) are memory-mapped instead of read.
+    def load_model(self, MODEL_FILEPATH, mmap_mode=None):
+        artifact = joblib.load(MODEL_FILEPATH, mmap_mode=mmap_mode)
+        for key in MODEL_ATTRIBUTES:
+            setattr(self, key, artifact.get(key, 0 if key == 'updates' else None))
+        return self
 
-    # To save models for reusing
+    # To save models for reusing, as a single (uncompressed, so it can be memory-mapped) file
     def save_model(self, MODEL_FILEPATH):
-        joblib.dump(self.regressor, OUTPUT_FILE)
+        joblib.dump({key: getattr(self, key, None) for key in MODEL_ATTRIBUTES},
+                    MODEL_FILEPATH)
+        return MODEL_FILEPATH
 
     # It fits the regressor by scaling features and through a 10-fold CV training process
-    # the results are stored in metrics attributes
+    # the results are stored in metrics attributes. The folds run on the Model's backend
+    # ('serial', 'threads' or 'processes', with n_jobs workers), each one on its own copy
+    # of the regressor. With a random_state, the splits and the regressors' seeds are fixed,
+    # so the scores are reproducible whatever the backend.
+    @instrumentation.timed('Model.fit')
     def fit(self, X, y):
-        X = MinMaxScaler().fit_transform(X)
+        with utils.get_executor(self.backend, self.n_jobs) as executor:
+            return self.collect(self.submit(X, y, executor))
+
+    # Used for scheduling the CV folds of fit in an executor shared with other
+    # models (see Bee.train); `collect` gathers their results. The folds fit copies of
+    # the regressor as it was configured (`template`), whatever update added to it.
+    def submit(self, X, y, executor):
+        if self.template is None:
+            self.template = clone(self.regressor)
+        _with_columns(self.template, X)
+        self.timestamp, self.updates, self.holdout_r2, self.holdout_mse = _latest_timestamp(X), 0, None, None
+        self.columns = list(X.columns) if isinstance(X, pd.DataFrame) else None
+        X = np.asarray(X)
+        X = X if X.dtype == np.float32 else np.asarray(X, dtype=float) # float32 features (see FeatureStore) are kept as they are
+        self.scaler = _fit_scaler(self.template, X)
+        X = self.scaler.transform(X)
         y = y.values.ravel()
-        cv_r2, cv_mse = [], []
-        for train, test in RepeatedKFold(n_splits=10, n_repeats=1).split(X):
-            self.regressor.fit(X[train],y[train])
-            X_pred = self.regressor.predict(X[test])
-            cv_r2.append(r2_score(y[test],X_pred))
-            cv_mse.append(mean_squared_error(y[test],X_pred))
+        folds = RepeatedKFold(n_splits=10, n_repeats=1, random_state=self.random_state).split(X)
+        return [executor.submit(_fit_fold, self.template, X, y, train, test,
+                                None if self.random_state is None else self.random_state+i)
+                for i, (train, test) in enumerate(folds)]
+
+    def collect(self, futures):
+        results = [f.result() for f in futures]
+        for i, r in enumerate(results):
+            instrumentation.record('cv_fold', r[3], fold=i, r2=r[0])
+        cv_r2, cv_mse = [r[0] for r in results], [r[1] for r in results]
+        self.regressor = results[-1][2]
         self.r2, self.r2_std = np.mean(cv_r2), np.std(cv_r2)
         self.mse, self.mse_std = np.mean(cv_mse), np.std(cv_mse)
         return self
 
+    # Incremental counterpart of fit, for adding new training features (e.g. a day more of
+    # them) to a fitted model without the 10-fold CV on the whole history. The rows of X
+    # newer than the latest timestamp the model was trained on are scored first, as a
+    # holdout (holdout_r2 and holdout_mse, NaN with less than 2 of them), then all the rows
+    # are folded into the regressor (see _fold_in), with the scaler and columns of fit. When
+    # the holdout r2 is below the CV one by more than `tolerance`, or the model was never
+    # fitted (it has no scaler), fit runs instead. With no rows, the model is left as it is.
+    @instrumentation.timed('Model.update')
+    def update(self, X, y, n_estimators=None, tolerance=None):
+        if len(X) == 0:
+            return self
+        if self.scaler is None:
+            print('[Model] not fitted yet, fitting instead of updating')
+            return self.fit(X, y)
+        if self.template is None:
+            self.template = clone(self.regressor)
+        X_scaled, y_values = self.transform(X), np.asarray(y.values, dtype=float).ravel()
+        latest, unseen = _latest_timestamp(X), np.ones(len(X_scaled), dtype=bool)
+        if self.timestamp is not None and latest is not None:
+            unseen = np.asarray(X.index.get_level_values('Timestamp') > self.timestamp)
+        self.holdout_r2, self.holdout_mse = np.nan, np.nan
+        if unseen.sum() > 1:
+            y_pred = self.regressor.predict(X_scaled[unseen])
+            self.holdout_r2 = r2_score(y_values[unseen], y_pred)
+            self.holdout_mse = mean_squared_error(y_values[unseen], y_pred)
+        instrumentation.event('holdout', rows=int(unseen.sum()), r2=self.holdout_r2, mse=self.holdout_mse)
+        if tolerance is not None and self.r2 is not None and self.holdout_r2 < self.r2 - tolerance:
+            print('[Model] holdout r2 {:.3f} below the CV r2 {:.3f}, fitting again'.format(self.holdout_r2, self.r2))
+            return self.fit(X, y)
+        self.regressor = _fold_in(self.regressor, self.template, X_scaled, y_values, n_estimators)
+        self.timestamp = self.timestamp if latest is None else latest
+        self.updates += 1
+        return self
+
+    # Budgeted search of the regressor's parameters by successive halving: the candidates
+    # (the grid of `params`, a dict of lists, or `n_candidates` sampled from it, which may
+    # hold scipy distributions) are scored by an n_splits-fold CV on a random subset of the
+    # rows, and the best 1/factor of them go on to a subset `factor` times larger, until the
+    # last round, on all the rows, so the bad candidates stop on few rows. The folds of a round
+    # run on the Model's backend, and their scores are cached (in `cache`, a JSON lines file,
+    # when given) by data, parameters, rows and fold, so a search run again (e.g. with more
+    # candidates) only fits the new ones. When the search has taken more than `budget`
+    # seconds, it stops after the current round. The regressor (and template) become the
+    # best candidate, unfitted, and the rounds' scores are kept in `search`; the best
+    # parameters and the seconds the search took are returned.
+    @instrumentation.timed('Model.tune')
+    def tune(self, X, y, params, n_candidates=None, factor=3, n_splits=5, budget=None, cache=None):
+        t0 = time.time()
+        template = _with_columns(self.template if self.template is not None else clone(self.regressor), X)
+        if n_candidates is None:
+            candidates = list(ParameterGrid(params))
+        else:
+            candidates = list(ParameterSampler(params, n_candidates, random_state=self.random_state))
+        X = np.asarray(X)
+        X = _fit_scaler(template, X).transform(X if X.dtype == np.float32 else np.asarray(X, dtype=float))
+        y = np.asarray(y.values, dtype=float).ravel()
+        seed = 0 if self.random_state is None else self.random_state
+        order = np.random.RandomState(seed).permutation(len(X))
+        data = hashlib.sha1(X.tobytes() + y.tobytes()).hexdigest()
+        scores = {}
+        if cache is not None and os.path.isfile(cache):
+            with open(cache) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    scores[entry['key']] = tuple(entry['scores'])
+        rounds = max(1, int(np.ceil(np.log(len(candidates))/np.log(factor) - 1e-9)))
+        alive, self.search = list(range(len(candidates))), []
+        with utils.get_executor(self.backend, self.n_jobs) as executor:
+            for r in range(rounds):
+                rows = order[:max(2*n_splits, len(X)//factor**(rounds-1-r))]
+                folds = list(KFold(n_splits, shuffle=True, random_state=seed).split(rows))
+                keys, pending = {}, {}
+                for c in alive:
+                    for i, (train, test) in enumerate(folds):
+                        key = keys[(c,i)] = hashlib.sha1(json.dumps([data, repr(template), sorted(candidates[c].items()), len(rows), n_splits, seed, i],
+                                                                    default=str).encode()).hexdigest()
+                        if key not in scores and key not in pending.values():
+                            pending[executor.submit(_score_fold, template, candidates[c], X[rows], y[rows], train, test,
+                                                    None if self.random_state is None else self.random_state+i)] = key
+                for future, key in pending.items():
+                    scores[key] = future.result()
+                if cache is not None:
+                    with open(cache, 'a') as f:
+                        f.writelines(json.dumps({'key': key, 'scores': scores[key]})+'\n' for key in pending.values())
+                for c in alive:
+                    r2, mse, seconds = np.array([scores[keys[(c,i)]] for i in range(len(folds))]).T
+                    self.search.append(dict(candidates[c], round=r, rows=len(rows), r2=np.mean(r2), r2_std=np.std(r2),
+                                            mse=np.mean(mse), fit_seconds=np.mean(seconds)))
+                ranked = sorted(alive, key=lambda c: -np.mean([scores[keys[(c,i)]][0] for i in range(len(folds))]))
+                instrumentation.event('tune_round', round=r, rows=len(rows), candidates=len(alive), fits=len(pending))
+                best, alive = candidates[ranked[0]], ranked[:max(1, len(ranked)//factor)]
+                if budget is not None and time.time()-t0 > budget:
+                    print('[Model] tuning budget of {} seconds spent after round {} of {}'.format(budget, r+1, rounds))
+                    break
+        self.search = pd.DataFrame(self.search)
+        self.regressor = self.template = clone(template).set_params(**best)
+        return best, time.time()-t0
+
+    # Used for preparing features for the regressor as in training: the columns of a frame
+    # are taken by name in the training order (the others are left out) and scaled by the
+    # scaler fitted on the training features. A frame without some of the training columns,
+    # or with a different number of channels of a name, raises a ValueError.
+    def transform(self, X):
+        if self.columns is not None and isinstance(X, pd.DataFrame) and list(X.columns) != self.columns:
+            names = list(pd.unique(pd.Series(self.columns)))
+            missing = [c for c in names if c not in X.columns]
+            if len(missing):
+                raise ValueError('The features miss the training columns {} (and have the extra {})'.format(
+                        missing, [c for c in pd.unique(pd.Series(X.columns)) if c not in names]))
+            X = X[names]
+            if list(X.columns) != self.columns:
+                trained, given = pd.Series(self.columns).value_counts(), pd.Series(X.columns).value_counts()
+                raise ValueError('The features have a different number of channels than in training: {}'.format(
+                        {c: (int(given[c]), int(trained[c])) for c in names if given[c] != trained[c]}))
+        return self.scaler.transform(np.asarray(X, dtype=float))
+
     # Used for the prediction in a meshgrid of a Geography object after the mesh_ingestion
     # process. It also could be setted to plot the interpolation result
     def predict(self, X_mesh, Geography, plot=False):
-        y_pred = pd.DataFrame(self.regressor.predict(MinMaxScaler().fit_transform(X_mesh)),
-                              index=Geography.meshgrid.index, columns=['pred'])
-        y_pred['lat'] = Geography.meshgrid['lat']
-        y_pred['lon'] = Geography.meshgrid['lon']
+        y_pred = self.predict_points(X_mesh, Geography.meshgrid)
         if plot:
             if plot is True:
                 plot = {'vmin':0, 'vmax':100}
             self.plot_interpolation(y_pred, Geography, plot['vmin'], plot['vmax'])
         return y_pred
 
+    # Used for the prediction in any set of points (with lat and lon columns) from
+    # their features, in the same order.
+    def predict_points(self, X, points):
+        y_pred = pd.DataFrame(self.regressor.predict(self.transform(X)),
+                              index=points.index, columns=['pred'])
+        y_pred['lat'] = points['lat']
+        y_pred['lon'] = points['lon']
+        return y_pred
+
     # Used for generate a contour plot with the meshgrid and the predicted values.
     def plot_interpolation(self, y_pred, Geography, vmin=0, vmax=100):
         Z = np.zeros(Geography.meshlonv.shape[0]*Geography.meshlonv.shape[1]) - 9999
@@ -446,6 +1085,7 @@ class Bee(object):
         self.configuration__ = configuration__
 
     # It loads/makes its Geography, Sensors and Features objects for further usage
+    @instrumentation.timed('Bee.fit')
     def fit(self, mode, verbose=False):
         t0 = time.time()
         self.geography = Geography(self.configuration__, mode)
@@ -462,11 +1102,15 @@ class Bee(object):
             t0 = time.time()
         return self
 
-    # Wrapper for Model. Can fit multiple regressor given a list of tuples ("label", Regressor)
-    def train(self, variables, regressor=None, X=None, y=None):
+    # Wrapper for Model. Can fit multiple regressor given a list of tuples ("label", Regressor).
+    # The CV folds of all the variables and regressors are scheduled in the same pool of n_jobs
+    # workers of the `backend` ('serial', 'threads' or 'processes', see Model.fit).
+    @instrumentation.timed('Bee.train')
+    def train(self, variables, regressor=None, X=None, y=None, backend='serial', n_jobs=None, random_state=None):
         self.models = {}
         self.scores = {}
         self.multiregressors = False
+        jobs = []
         if type(regressor)==list: # tuples with label as [('rf', RandomForest(params)), ('gb', GradiendBoost(params))]
             self.multiregressors = []
             for ri in regressor:
@@ -474,47 +1118,269 @@ class Bee(object):
                 self.models[ri[0]] = {}
                 self.scores[ri[0]] = {}
                 for var in variables:
-                    if X is None and y is None:
-                        self.models[ri[0]][var] = Model(ri[1]).fit(**self.features.get_train_features(var))
-                    else:
-                        self.models[ri[0]][var] = Model(ri[1]).fit(X, y)
-                    self.scores[ri[0]][var] = (self.models[ri[0]][var].r2, self.models[ri[0]][var].mse)
+                    jobs.append((self.models[ri[0]], self.scores[ri[0]], var, ri[1]))
         else:
             for var in variables:
                 if regressor is None:
-                    r = GradientBoostingRegressor(n_estimators=200, max_depth=5, max_features=0.5)
+                    r = default_regressor()
                 else:
                     r = regressor
+                jobs.append((self.models, self.scores, var, r))
+        with utils.get_executor(backend, n_jobs) as executor:
+            submitted = []
+            for models, scores, var, r in jobs:
+                model = Model(r, backend, n_jobs, random_state)
                 if X is None and y is None:
-                    self.models[var] = Model(r).fit(**self.features.get_train_features(var))
+                    futures = model.submit(executor=executor, **self.features.get_train_features(var))
                 else:
-                    self.models[var] = Model(r).fit(X, y)
-                self.scores[var] = (self.models[var].r2, self.models[var].mse)
+                    futures = model.submit(X, y, executor)
+                submitted.append((models, scores, var, model, futures))
+            for models, scores, var, model, futures in submitted:
+                models[var] = model.collect(futures)
+                scores[var] = (models[var].r2, models[var].mse)
+        return self
+
+    # Incremental counterpart of train, e.g. for a nightly job after Features.update: the
+    # models of the variables fold in their new training features (see Model.update) instead
+    # of being trained again on the whole history. With a `window`, the rows of the last
+    # `window` periods (timestamps) are folded in and the older ones are left out of the
+    # full fits too, so the training time does not grow with the history; without it, only
+    # the rows newer than the model's latest timestamp are. The full 10-fold CV fit runs only
+    # every `cv_every` updates, for variables without a model yet (trained as train does
+    # with no regressor) and when a model's holdout r2 falls below its CV r2 by more than
+    # `tolerance`. The variables with no features newer than their model's latest timestamp
+    # are skipped, keeping the model and its scores, so running it again without new data
+    # does nothing. X and y, when given, replace the features of every variable.
+    @instrumentation.timed('Bee.update')
+    def update(self, variables, window=None, cv_every=None, tolerance=None, n_estimators=None,
+               X=None, y=None, backend='serial', n_jobs=None, random_state=None):
+        if not hasattr(self, 'models'):
+            self.models, self.scores, self.multiregressors = {}, {}, False
+        groups = [(self.models[label], self.scores[label]) for label in self.multiregressors] \
+                 if self.multiregressors else [(self.models, self.scores)]
+        with utils.get_executor(backend, n_jobs) as executor:
+            submitted = []
+            for models, scores in groups:
+                for var in variables:
+                    f = self.features.get_train_features(var) if X is None and y is None else {'X': X, 'y': y}
+                    model = models.get(var)
+                    full = model is None or (cv_every is not None and model.updates+1 >= cv_every)
+                    if not full and not utils.recent_rows(f['X'].index, since=model.timestamp).any():
+                        continue
+                    rows = utils.recent_rows(f['X'].index, window, None if full or window is not None else model.timestamp)
+                    if full:
+                        if model is None:
+                            model = Model(default_regressor(), backend, n_jobs, random_state)
+                        submitted.append((models, scores, var, model, model.submit(f['X'][rows], f['y'][rows], executor)))
+                    else:
+                        models[var] = model.update(f['X'][rows], f['y'][rows], n_estimators, tolerance)
+                        scores[var] = (model.r2, model.mse)
+            for models, scores, var, model, futures in submitted:
+                models[var] = model.collect(futures)
+                scores[var] = (model.r2, model.mse)
         return self
 
-    # Wrapper for Model prediction applied to the Geography.meshgrid
+    # Wrapper for Model.tune, searching the parameters of a regressor (the one of train when
+    # none is given) for each variable on its training features (or X and y, when given). The
+    # tuned models are kept in `tuning`, whose regressors (unfitted) can be given to train,
+    # and the best parameters and the seconds the search took (each within the `budget`)
+    # are returned by variable.
+    @instrumentation.timed('Bee.tune')
+    def tune(self, variables, params, regressor=None, X=None, y=None, n_candidates=None, factor=3, n_splits=5,
+             budget=None, cache=None, backend='serial', n_jobs=None, random_state=None):
+        self.tuning, results = {}, {}
+        for var in variables:
+            f = self.features.get_train_features(var) if X is None and y is None else {'X': X, 'y': y}
+            self.tuning[var] = Model(default_regressor() if regressor is None else regressor, backend, n_jobs, random_state)
+            results[var] = self.tuning[var].tune(f['X'], f['y'], params, n_candidates, factor, n_splits, budget, cache)
+        return results
+
+    # Used for saving the trained models (see Model.save_model) in a folder, which load_models
+    # restores without training again.
+    def save_models(self, MODELS_FOLDER):
+        if not os.path.isdir(MODELS_FOLDER):
+            os.makedirs(MODELS_FOLDER)
+        index = {'multiregressors': self.multiregressors, 'models': []}
+        models = self.models.items() if self.multiregressors else [(None, self.models)]
+        for label, var_models in models:
+            for var, model in var_models.items():
+                filename = '{}{}.model'.format('' if label is None else label+'__', var)
+                model.save_model(os.path.join(MODELS_FOLDER, filename))
+                index['models'].append({'regressor': label, 'variable': var, 'file': filename})
+        with open(os.path.join(MODELS_FOLDER, 'models.json'), 'w') as f:
+            json.dump(index, f)
+        return self
+
+    # Used for restoring the models saved by save_models. With mmap_mode='r', their
+    # arrays are memory-mapped (see Model.load_model).
+    def load_models(self, MODELS_FOLDER, mmap_mode=None):
+        with open(os.path.join(MODELS_FOLDER, 'models.json')) as f:
+            index = json.load(f)
+        self.multiregressors = index['multiregressors']
+        self.models, self.scores = {}, {}
+        for entry in index['models']:
+            model = Model(None).load_model(os.path.join(MODELS_FOLDER, entry['file']), mmap_mode)
+            models, scores = self.models, self.scores
+            if entry['regressor'] is not None:
+                models, scores = models.setdefault(entry['regressor'], {}), scores.setdefault(entry['regressor'], {})
+            models[entry['variable']] = model
+            scores[entry['variable']] = (model.r2, model.mse)
+        return self
+
+    # Wrapper for Model prediction applied to the Geography.meshgrid. The (timestamp, cell)
+    # features of all the timestamps are predicted by each model in a single call. For
+    # repeated requests of the same surfaces, see service.InterpolationService.
+    @instrumentation.timed('Bee.interpolate')
     def interpolate(self, variables, data=None, timestamp=None):
         if data is None:
             data = self.sensors
         if timestamp is not None and timestamp!='*':
             timestamp = pd.to_datetime(timestamp)
         X_mesh = self.features.mesh_ingestion(data, self.geography, self.configuration__['Sensors__variables'], timestamp=timestamp)
+        cells = self.geography.meshgrid.loc[X_mesh.index.get_level_values(1)]
+        points = pd.DataFrame({'lat': cells['lat'].values, 'lon': cells['lon'].values}, index=X_mesh.index)
         self.z = {}
         for var in variables:
-            y_pred = pd.DataFrame(index=X_mesh.index, columns=['pred','lat','lon'])
-            if self.multiregressors:
-                for ri in self.multiregressors:
-                    self.z[ri] = {}
-                    for t in X_mesh.index.get_level_values(0).unique():
-                            y_pred.loc[t] = self.models[ri][var].predict(X_mesh.loc[t], self.geography).values
-                    self.z[ri][var] = y_pred
-            else:
-                for t in X_mesh.index.get_level_values(0).unique():
-                    print('bee.interpolate - ',t)
-                    y_pred.loc[t] = self.models[var].predict(X_mesh.loc[t], self.geography).values
-                self.z[var] = y_pred
+            for ri in (self.multiregressors if self.multiregressors else [None]):
+                model = self.models[var] if ri is None else self.models[ri][var]
+                with instrumentation.span('predict', variable=var, regressor=ri, timestamps=len(X_mesh.index.levels[0])):
+                    y_pred = model.predict_points(X_mesh, points)
+                if ri is None:
+                    self.z[var] = y_pred
+                else:
+                    self.z.setdefault(ri, {})[var] = y_pred
         return self
 
+    # Training-free models for the variables, predicting by inverse distance weighting of
+    # their neighbours' channels (see idw.IDWRegressor), e.g. for variables with no training
+    # history or for predictions where latency matters. They are put in `models` as the
+    # trained ones (under the `label` regressor, 'idw' by default, for multiple regressors),
+    # with no scores, and interpolate and the other methods use them alike.
+    def idw(self, variables, power=2, k=None, label=None):
+        if not hasattr(self, 'models'):
+            self.models, self.scores, self.multiregressors = {}, {}, False
+        models, scores = self.models, self.scores
+        if self.multiregressors:
+            label = 'idw' if label is None else label
+            if label not in self.multiregressors:
+                self.multiregressors.append(label)
+            models, scores = self.models.setdefault(label, {}), self.scores.setdefault(label, {})
+        columns = list(self.features.zx.columns)
+        for var in variables:
+            model = Model(IDWRegressor(var, power, k))
+            names = {var, var.split('.')[0]}
+            model.columns = [c for c in columns if c in names or (c.startswith('d_') and c[2:] in names)]
+            model.template = _with_columns(clone(model.regressor), pd.DataFrame(columns=model.columns))
+            model.regressor = clone(model.template).fit(None)
+            model.scaler = _fit_scaler(model.regressor, np.zeros((1, len(model.columns))))
+            model.r2 = model.r2_std = model.mse = model.mse_std = None
+            models[var], scores[var] = model, (None, None)
+        return self
+
+    # Generator version of interpolate: yields, for each timestamp, the timestamp and a dict of
+    # the variables' predictions as float32 (lat, lon) grids of Geography.meshlonv's shape (NaN
+    # out of the meshgrid), in a dict per regressor label for multiple regressors. The meshgrid
+    # features are ingested for `chunk` timestamps at a time, so memory doesn't grow with the
+    # number of timestamps (default: all of them in data).
+    def iter_interpolate(self, variables, data=None, timestamps=None, chunk=24):
+        if data is None:
+            data = self.sensors
+        compact = isinstance(utils.data_source(data), SensorStore)
+        if timestamps is None:
+            timestamps = utils.data_sensors_times(data)[1].sort_values()
+        timestamps = pd.DatetimeIndex(pd.to_datetime(timestamps)).unique()
+        if not compact: # the store reads the chunk's timestamps only, the frame is split
+            positions = timestamps.get_indexer(data.data.index.get_level_values(2))
+            order = np.argsort(positions, kind='mergesort')
+            bounds = np.searchsorted(positions[order], np.arange(0, len(timestamps)+chunk, chunk))
+        meshgrid, shape = self.geography.meshgrid, self.geography.meshlonv.shape
+        labels = self.multiregressors if self.multiregressors else [None]
+        for c, i in enumerate(range(0, len(timestamps), chunk)):
+            subset = data
+            if not compact:
+                subset = copy.copy(data)
+                subset.data = data.data.iloc[order[bounds[c]:bounds[c+1]]]
+            zmesh, times, columns = utils.batch_mesh_ingestion(subset, meshgrid, self.configuration__['Sensors__variables'],
+                                                               timestamps[i:i+chunk], freq=self.configuration__['Sensors__frequency'])
+            for j, t in enumerate(times):
+                X = pd.DataFrame(zmesh[j], index=meshgrid.index, columns=columns)
+                grids = {}
+                for label in labels:
+                    models = self.models if label is None else self.models[label]
+                    grids[label] = {}
+                    for var in variables:
+                        grid = np.full(shape[0]*shape[1], np.nan, dtype=np.float32)
+                        grid[meshgrid.index.values] = models[var].predict_points(X, meshgrid)['pred'].values
+                        grids[label][var] = grid.reshape(shape)
+                yield t, (grids[None] if not self.multiregressors else grids)
+
+    # Writes the interpolation of each variable (and regressor) for the given timestamps to a
+    # grid store (see storage.GridWriter) in `folder`, named as the models in save_models,
+    # in a single pass of iter_interpolate. Returns the stores' paths, which
+    # storage.load_grids opens.
+    @instrumentation.timed('Bee.interpolate_to_store')
+    def interpolate_to_store(self, variables, folder, data=None, timestamps=None, chunk=24):
+        lat, lon = self.geography.meshlatv[:,0], self.geography.meshlonv[0]
+        writers = {}
+        for label in (self.multiregressors if self.multiregressors else [None]):
+            for var in variables:
+                name = '{}{}'.format('' if label is None else label+'__', var)
+                writers[(label, var)] = storage.GridWriter(storage.grid_path(folder, name), lat, lon, chunk,
+                                                           variable=var, regressor=label)
+        for t, grids in self.iter_interpolate(variables, data, timestamps, chunk):
+            for (label, var), writer in writers.items():
+                writer.write(t, grids[var] if label is None else grids[label][var])
+        return {os.path.basename(w.path)[:-len('.grid')]: w.close() for w in writers.values()}
+
+    # Wrapper for Model prediction applied to any batch of points at a timestamp, given as
+    # a GeoDataFrame of points, a DataFrame with lat and lon columns or an array of (lat, lon)
+    # pairs. Their neighbours and OSM features are built for those points only, as the static
+    # features of the meshgrid, so the cost depends on the number of points and not on the
+    # meshgrid size. Returns a frame with lat, lon and the predictions of each variable (one
+    # such frame per regressor label in a dict, for multiple regressors).
+    @instrumentation.timed('Bee.interpolate_points')
+    def interpolate_points(self, points, variables, timestamp, data=None):
+        return self.interpolate_pointgrid(self.make_pointgrid(points), variables, timestamp, data)
+
+    # Used for building the points' frame as the meshgrid: lon, lat, geometry and the same
+    # static (OSM) features. It doesn't depend on the timestamp, so it can be kept for
+    # later interpolate_pointgrid calls (see tiles.TiledMesh).
+    def make_pointgrid(self, points):
+        if isinstance(points, gpd.GeoDataFrame):
+            lon, lat = points.geometry.x.values, points.geometry.y.values
+            index = points.index
+        elif isinstance(points, pd.DataFrame):
+            lon, lat = points['lon'].values, points['lat'].values
+            index = points.index
+        else:
+            lat, lon = np.asarray(points, dtype=float).reshape(-1, 2).T
+            index = pd.RangeIndex(len(lat))
+        pointgrid = gpd.GeoDataFrame({'lon': lon, 'lat': lat}, index=index,
+                                     geometry=[shapely.geometry.Point(xy) for xy in zip(lon, lat)])
+        static = list(self.geography.meshgrid.columns[~self.geography.meshgrid.columns.isin(['lat','lon','geometry'])])
+        if len(static):
+            if not hasattr(self, 'osm_indexes'):
+                self.osm_indexes = {}
+            osmf = Features({}, mode=None).make_osm_features(self.geography, pointgrid,
+                                    [o for o in self.configuration__['osm_line_objs'] if o in static],
+                                    [o for o in self.configuration__['osm_point_objs'] if o in static],
+                                    self.osm_indexes)
+            pointgrid = pointgrid.join(osmf[static])
+        return pointgrid
+
+    def interpolate_pointgrid(self, pointgrid, variables, timestamp, data=None):
+        if data is None:
+            data = self.sensors
+        X = utils.mesh_ingestion(data, pointgrid, self.configuration__['Sensors__variables'], timestamp,
+                                 self.configuration__['Sensors__frequency'])
+        z = {}
+        for label in (self.multiregressors if self.multiregressors else [None]):
+            models = self.models if label is None else self.models[label]
+            z[label] = pointgrid[['lat','lon']].copy()
+            for var in variables:
+                z[label][var] = models[var].predict_points(X, pointgrid)['pred']
+        return z[None] if not self.multiregressors else z
+
     # Wrapper for contour plot of predicted values of a specific variable. You can
     # configure the color range for the contour plot with vmin and vmax parameters.
     def plot(self, variable, timestamp, vmin=0, vmax=100, regressor=None):
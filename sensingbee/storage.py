@@ -0,0 +1,224 @@
+"""
+Binary storage for the artifacts cached by Sensors, Geography and Features.
+A frame is written as a folder with one .npy file per index level and column
+plus a meta.json describing them, so that names (even repeated ones, such as
+the zx channels), index levels and dtypes are kept as they are, and numeric
+columns can be memory-mapped when read. Point geometries are stored as x/y
+coordinate arrays, other geometries as WKB. Datetimes are stored as int64
+nanoseconds (since the epoch, in UTC, with their timezone in meta.json). Columns
+of other objects (neither numbers nor strings) are pickled, so only artifacts
+written by this package should be read.
+
+Interpolated grids are stored in a similar folder (a .grid one): the (time, lat,
+lon) float32 array is split in chunks of timestamps, one .npy file each, that are
+written as the grids come and memory-mapped when read, so that writing and
+reading any time window take memory for one chunk at most.
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+FORMAT_VERSION = 1
+
+
+def artifact_path(DATA_FOLDER, name):
+    return os.path.join(DATA_FOLDER, '{}.frame'.format(name))
+
+def grid_path(folder, name):
+    return os.path.join(folder, '{}.grid'.format(name))
+
+def exists(path):
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+# Writes a (Geo)DataFrame to the folder `path`.
+def save_frame(df, path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    geometry = df._geometry_column_name if isinstance(df, gpd.GeoDataFrame) else None
+    geometry = geometry if geometry in df.columns else None
+    meta = {'version': FORMAT_VERSION, 'length': len(df), 'index': [], 'columns': [], 'geometry': geometry}
+    for i in range(df.index.nlevels):
+        meta['index'].append(dict(name=df.index.names[i],
+                                  **_save_array(df.index.get_level_values(i), os.path.join(path, 'i{}'.format(i)))))
+    for j, name in enumerate(df.columns):
+        column = df.iloc[:,j]
+        if name == geometry:
+            entry = _save_geometry(column, os.path.join(path, 'c{}'.format(j)))
+        else:
+            entry = _save_array(column, os.path.join(path, 'c{}'.format(j)))
+        meta['columns'].append(dict(name=name, **entry))
+    if geometry is not None and df.crs is not None:
+        meta['crs'] = df.crs if isinstance(df.crs, dict) else str(df.crs)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, default=str)
+    return path
+
+# Reads a frame written by save_frame. With `mmap`, the numeric columns are
+# memory-mapped instead of read into memory (see load_arrays), and the frame is
+# built on them without copying (one block per column, not consolidated), so
+# only the parts of the files that are used are ever read.
+def load_frame(path, mmap=True):
+    meta, index, columns = load_arrays(path, mmap)
+    if len(index) == 1:
+        index = pd.Index(index[0], name=meta['index'][0]['name'])
+    else:
+        index = pd.MultiIndex.from_arrays(index, names=[i['name'] for i in meta['index']])
+    names = [c['name'] for c in meta['columns']]
+    df = pd.DataFrame(dict(enumerate(columns)), index=index, columns=range(len(columns)), copy=False)
+    df.columns = names
+    if meta.get('geometry') is not None:
+        df = gpd.GeoDataFrame(df, geometry=meta['geometry'], crs=meta.get('crs'))
+    return df
+
+# Reads the raw arrays of a frame written by save_frame, as (meta, index levels,
+# columns). Numeric arrays are memory-mapped with `mmap`, so slicing them only
+# touches the needed part of the file.
+def load_arrays(path, mmap=True):
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    index = [_load_array(entry, os.path.join(path, 'i{}'.format(i)), mmap)
+             for i, entry in enumerate(meta['index'])]
+    columns = [_load_array(entry, os.path.join(path, 'c{}'.format(j)), mmap)
+               for j, entry in enumerate(meta['columns'])]
+    return meta, index, columns
+
+# Writes the (timestamp, 2D grid) pairs yielded by `grids` to the folder `path` (see
+# GridWriter), returning the path.
+def save_grids(grids, path, lat, lon, chunk=24, **attrs):
+    writer = GridWriter(path, lat, lon, chunk, **attrs)
+    for t, grid in grids:
+        writer.write(t, grid)
+    return writer.close()
+
+
+class GridWriter(object):
+    """
+    Writes grids to the folder `path` as they come, `chunk` timestamps per file. `lat` and
+    `lon` are the grids' rows and columns coordinates and `attrs` any other metadata to keep.
+    The metadata is rewritten with each chunk, so what has been written can be read.
+    """
+    def __init__(self, path, lat, lon, chunk=24, **attrs):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.meta = dict(version=FORMAT_VERSION, shape=[0, len(lat), len(lon)], chunk=chunk, chunks=[], **attrs)
+        np.save(os.path.join(path, 'lat.npy'), np.asarray(lat, dtype=float))
+        np.save(os.path.join(path, 'lon.npy'), np.asarray(lon, dtype=float))
+        self.times = []
+        self.buffer = np.empty((chunk, len(lat), len(lon)), dtype=np.float32)
+
+    def write(self, timestamp, grid):
+        chunk = self.meta['chunk']
+        self.buffer[len(self.times) - chunk*len(self.meta['chunks'])] = grid
+        self.times.append(pd.Timestamp(timestamp).value)
+        if len(self.times) == chunk*(len(self.meta['chunks'])+1):
+            self._flush(self.buffer)
+        return self
+
+    def close(self):
+        pending = len(self.times) - self.meta['chunk']*len(self.meta['chunks'])
+        if pending > 0 or not self.meta['chunks']:
+            self._flush(self.buffer[:pending])
+        return self.path
+
+    def _flush(self, values):
+        name = 'chunk{:06d}.npy'.format(len(self.meta['chunks']))
+        np.save(os.path.join(self.path, name), values)
+        self.meta['chunks'].append(name)
+        self.meta['shape'][0] = len(self.times)
+        np.save(os.path.join(self.path, 'time.npy'), np.array(self.times, dtype='i8'))
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, default=str)
+
+
+# Opens a grid store written by save_grids.
+def load_grids(path):
+    return GridStore(path)
+
+
+class GridStore(object):
+    """
+    Reader of a grid store written by save_grids. `timestamps`, `lat` and `lon` label
+    the (time, lat, lon) axes, and `window` reads the grids of a time range touching
+    only the chunks in it.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.timestamps = pd.to_datetime(np.load(os.path.join(path, 'time.npy'))[:self.meta['shape'][0]])
+        self.lat = np.load(os.path.join(path, 'lat.npy'))
+        self.lon = np.load(os.path.join(path, 'lon.npy'))
+        self.shape = tuple(self.meta['shape'])
+
+    def __len__(self):
+        return self.shape[0]
+
+    # The grids from timestamp `start` to `end` (both included, as in pandas' slicing),
+    # as (timestamps, (time, lat, lon) array).
+    def window(self, start=None, end=None):
+        first = 0 if start is None else self.timestamps.searchsorted(pd.to_datetime(start), side='left')
+        last = len(self) if end is None else self.timestamps.searchsorted(pd.to_datetime(end), side='right')
+        return self.timestamps[first:last], self.read(first, last)
+
+    # The grids between positions first and last (excluded) along the time axis.
+    def read(self, first, last):
+        chunk = self.meta['chunk']
+        values = np.empty((max(last-first, 0),) + self.shape[1:], dtype=np.float32)
+        for c in range(first//chunk, (last-1)//chunk + 1 if last > first else first//chunk):
+            lo, hi = max(first, c*chunk), min(last, (c+1)*chunk)
+            block = np.load(os.path.join(self.path, self.meta['chunks'][c]), mmap_mode='r')
+            values[lo-first:hi-first] = block[lo-c*chunk:hi-c*chunk]
+        return values
+
+    def __getitem__(self, i):
+        return self.read(i, i+1)[0]
+
+
+def _save_array(values, path):
+    values = pd.Series(values) if not isinstance(values, pd.Series) else values
+    if str(values.dtype).startswith('datetime64'):
+        entry = {'kind': 'datetime'}
+        if values.dt.tz is not None:
+            entry['tz'] = str(values.dt.tz)
+            values = values.dt.tz_convert('UTC').dt.tz_localize(None)
+        np.save(path+'.npy', values.values.astype('datetime64[ns]').view('i8'))
+    elif isinstance(values.dtype, np.dtype) and values.dtype.kind in 'biufc':
+        entry = {'kind': 'numeric'}
+        np.save(path+'.npy', values.values)
+    elif values.map(lambda x: isinstance(x, str)).all():
+        entry = {'kind': 'string'}
+        np.save(path+'.npy', np.asarray(values.values, dtype=object).astype(str))
+    else:
+        entry = {'kind': 'object'}
+        np.save(path+'.npy', np.asarray(values.values, dtype=object), allow_pickle=True)
+    return entry
+
+def _save_geometry(geoseries, path):
+    geoseries = gpd.GeoSeries(geoseries)
+    if len(geoseries) > 0 and geoseries.notna().all() and (geoseries.geom_type == 'Point').all():
+        np.save(path+'.npy', np.column_stack([geoseries.x.values, geoseries.y.values]).astype(float))
+        return {'kind': 'points'}
+    np.save(path+'.npy', np.asarray(geoseries.to_wkb().values, dtype=object), allow_pickle=True)
+    return {'kind': 'wkb'}
+
+def _load_array(entry, path, mmap):
+    kind = entry['kind']
+    if kind == 'object' or kind == 'wkb':
+        values = np.load(path+'.npy', allow_pickle=True)
+    else:
+        values = np.load(path+'.npy', mmap_mode='r' if mmap and kind != 'string' else None)
+    if kind == 'datetime':
+        values = pd.to_datetime(np.asarray(values).view('datetime64[ns]'))
+        return values if entry.get('tz') is None else values.tz_localize('UTC').tz_convert(entry['tz'])
+    elif kind == 'string':
+        return values.astype(object)
+    elif kind == 'points':
+        values = np.asarray(values).reshape(-1, 2)
+        return gpd.points_from_xy(values[:,0], values[:,1])
+    elif kind == 'wkb':
+        return gpd.GeoSeries.from_wkb(values).values
+    return values
@@ -0,0 +1,155 @@
+"""
+Deterministic synthetic datasets for running the whole pipeline without the
+Urban Observatory, Overpass or the original data folders, e.g. for benchmarks.
+make_dataset writes, in a folder, everything a Bee needs: sensors.csv and
+data.csv, the city (MSOA) and LSOA shapefiles, the deprivation csv and the OSM
+highway objects (as a GeoJSON file, see Geography.load_osm), and returns the
+configuration__ dictionary pointing to them:
+
+    configuration__ = make_dataset('/tmp/synthetic/', n_sensors=200, days=60)
+    bee = Bee(configuration__).fit(mode='make')
+
+The same parameters (and seed) always give the same files.
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import fiona
+import shapely
+import shapely.geometry
+
+import sensingbee.utils as utils
+
+VARIABLES = {'NO2': (30., 10.), 'Temperature': (12., 4.), 'PM2.5': (8., 3.)} # mean and spatial amplitude
+LINE_OBJS = {'primary': 12, 'trunk': 6, 'motorway': 3, 'residential': 60}
+POINT_OBJS = {'traffic_signals': 150, 'crossing': 300}
+
+
+# Writes a synthetic dataset in `folder` and returns its configuration__. Samples of
+# `variables` are taken every `sampling` for `days` days by `n_sensors` sensors (most of
+# them in the city, each sample available with probability `availability`, and a share
+# `uncalibrated` of sensors with an offset beyond the thresholds), resampled to `frequency`.
+def make_dataset(folder, n_sensors=50, days=30, sampling='15min', frequency='D', mesh_dimensions=(50,50),
+                 variables=('NO2','Temperature','PM2.5'), availability=0.9, uncalibrated=0.05,
+                 bbox=(54.96,-1.8,55.05,-1.51), start='2018-01-01', seed=0):
+    folder = os.path.join(folder, '')
+    if not os.path.isdir(os.path.join(folder, 'shape')):
+        os.makedirs(os.path.join(folder, 'shape'))
+    rng = np.random.RandomState(seed)
+    south, west, north, east = bbox
+    centre, radii = ((west+east)/2, (south+north)/2), ((east-west)*0.42, (north-south)*0.42)
+    msoa = _areas(bbox, 8, centre, radii, '{:03d}')
+    lsoa = _areas(bbox, 16, centre, radii, '{:03d}A')
+    msoa.rename(columns={'name': 'msoa11nm'})[['msoa11nm','geometry']].to_file(folder+'shape/msoa.shp')
+    lsoa = lsoa.rename(columns={'name': 'lsoa11nm'})
+    lsoa['lsoa11cd'] = ['E01{:06d}'.format(i) for i in range(len(lsoa))]
+    lsoa['lsoa11nmw'] = lsoa['lsoa11nm']
+    lsoa[['lsoa11cd','lsoa11nm','lsoa11nmw','geometry']].to_file(folder+'shape/lsoa.shp')
+    deprivation = pd.DataFrame(rng.uniform(0, 1, (len(lsoa), len(utils.DEPRIVATION_COLUMNS))), columns=utils.DEPRIVATION_COLUMNS)
+    deprivation.iloc[:, 7:] = (deprivation.iloc[:, 7:]*3000).round()
+    deprivation.insert(0, 'LSOA name (2011)', lsoa['lsoa11nm'].values)
+    deprivation.insert(1, 'Local Authority District name (2013)', [n.rsplit(' ', 1)[0] for n in lsoa['lsoa11nm']])
+    deprivation.to_csv(folder+'deprivation.csv', index=False)
+    lines, points = _osm_objects(rng, bbox)
+    with open(folder+'osm.geojson', 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': lines + points}, f)
+
+    lon, lat = _sensors_positions(rng, n_sensors, bbox, centre, radii)
+    names = ['sensor_{:05d}'.format(i) for i in range(n_sensors)]
+    pd.DataFrame({'name': names, 'type': 'Air Quality', 'active': True, 'lon': lon, 'lat': lat}).to_csv(folder+'sensors.csv', index=False)
+    _write_samples(folder+'data.csv', rng, names, lon, lat, variables, pd.date_range(start, periods=days, freq='D'),
+                   sampling, availability, uncalibrated, centre, radii)
+    return {
+        'DATA_FOLDER': folder,
+        'SHAPE_PATH': folder+'shape/msoa.shp',
+        'LSOA_PATH': folder+'shape/lsoa.shp',
+        'DEPRIVATION_PATH': folder+'deprivation.csv',
+        'Sensors__frequency': frequency,
+        'Sensors__variables': list(variables),
+        'Sensors__threshold_callibration': {'Temperature': 25, 'NO2': 80, 'PM2.5': 15},
+        'Geography__filter_column': 'msoa11nm',
+        'Geography__filter_label': 'Newcastle upon Tyne',
+        'Geography__meshgrid': {'dimensions': list(mesh_dimensions), 'longitude_range': [west, east], 'latitude_range': [south, north]},
+        'osm_bbox': '({},{},{},{})'.format(south, west, north, east),
+        'osm_file': folder+'osm.geojson',
+        'osm_line_objs': list(LINE_OBJS),
+        'osm_point_objs': list(POINT_OBJS),
+    }
+
+# Grid of n x n rectangular areas over the bbox, named as Newcastle upon Tyne's ones when
+# their centre is in the city's ellipse and as Gateshead's otherwise.
+def _areas(bbox, n, centre, radii, suffix):
+    south, west, north, east = bbox
+    xs, ys = np.linspace(west, east, n+1), np.linspace(south, north, n+1)
+    names, geometries = [], []
+    for i in range(n):
+        for j in range(n):
+            box = shapely.geometry.box(xs[i], ys[j], xs[i+1], ys[j+1])
+            inside = _in_ellipse(box.centroid.x, box.centroid.y, centre, radii)
+            names.append('{} {}'.format('Newcastle upon Tyne' if inside else 'Gateshead', suffix.format(i*n+j)))
+            geometries.append(box)
+    return gpd.GeoDataFrame({'name': names}, geometry=geometries, crs=fiona.crs.from_epsg(4326))
+
+def _in_ellipse(x, y, centre, radii):
+    return ((x-centre[0])/radii[0])**2 + ((y-centre[1])/radii[1])**2 <= 1
+
+# Highway lines as random polylines (some of them of the "_link" type) and highway points
+# close to them, as GeoJSON features.
+def _osm_objects(rng, bbox):
+    south, west, north, east = bbox
+    lines, vertices = [], []
+    for highway, n in LINE_OBJS.items():
+        for i in range(n):
+            start = rng.uniform([west, south], [east, north])
+            steps = rng.normal(0, (east-west)/20, (rng.randint(2, 8), 2))
+            coords = np.clip(np.vstack([start, start + np.cumsum(steps, axis=0)]), [west, south], [east, north])
+            vertices.append(coords)
+            lines.append({'type': 'Feature', 'properties': {'highway': highway + ('_link' if i % 5 == 4 else '')},
+                          'geometry': {'type': 'LineString', 'coordinates': coords.tolist()}})
+    vertices = np.vstack(vertices)
+    points = []
+    for highway, n in POINT_OBJS.items():
+        near = vertices[rng.randint(0, len(vertices), n)] + rng.normal(0, 1e-4, (n, 2))
+        points += [{'type': 'Feature', 'properties': {'highway': highway},
+                    'geometry': {'type': 'Point', 'coordinates': xy.tolist()}} for xy in near]
+    return lines, points
+
+# 85% of the sensors in the city's ellipse, the others anywhere in the bbox.
+def _sensors_positions(rng, n_sensors, bbox, centre, radii):
+    south, west, north, east = bbox
+    lon, lat = rng.uniform(west, east, n_sensors), rng.uniform(south, north, n_sensors)
+    for i in range(int(n_sensors*0.85)):
+        while not _in_ellipse(lon[i], lat[i], centre, radii):
+            lon[i], lat[i] = rng.uniform(west, east), rng.uniform(south, north)
+    return lon, lat
+
+# Writes the samples in chronological order, a day at a time: a smooth spatial field per
+# variable, a daily cycle, a day-to-day random walk and noise, plus the sensors' offsets.
+def _write_samples(path, rng, names, lon, lat, variables, days, sampling, availability, uncalibrated, centre, radii):
+    x, y = (lon-centre[0])/radii[0], (lat-centre[1])/radii[1]
+    base, walk = {}, {}
+    for var in variables:
+        mean, amplitude = VARIABLES.get(var, (10., 3.))
+        phase = rng.uniform(0, 2*np.pi, 2)
+        offsets = np.where(rng.uniform(size=len(names)) < uncalibrated, mean*4, 0.)
+        base[var] = mean + amplitude*(np.sin(2*x + phase[0])*np.cos(2*y + phase[1])) + offsets
+        walk[var] = 0.
+    header = True
+    for day in days:
+        times = pd.date_range(day, periods=int(pd.Timedelta(days=1)/pd.Timedelta(sampling)), freq=sampling)
+        hours = (times.hour + times.minute/60.).values
+        frames = []
+        for var in variables:
+            mean, amplitude = VARIABLES.get(var, (10., 3.))
+            walk[var] = 0.8*walk[var] + rng.normal(0, amplitude/4)
+            values = (base[var][None,:] + walk[var] + amplitude/2*np.sin((hours[:,None]-8)/24*2*np.pi)
+                      + rng.normal(0, amplitude/5, (len(times), len(names))))
+            keep = rng.uniform(size=values.shape) < availability
+            t, s = np.nonzero(keep)
+            frames.append(pd.DataFrame({'Variable': var, 'Sensor Name': np.asarray(names)[s],
+                                        'Timestamp': times[t].strftime('%Y-%m-%d %H:%M:%S'), 'Value': values[t, s].round(3)}))
+        pd.concat(frames).sort_values('Timestamp', kind='mergesort').to_csv(path, index=False, header=header, mode='w' if header else 'a')
+        header = False
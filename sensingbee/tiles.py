@@ -0,0 +1,184 @@
+"""
+Tiled, multi-resolution meshgrid for map serving. Instead of the single grid of
+Geography.make_meshgrid, the interpolation is computed per web map tile (z/x/y,
+the usual Web Mercator tiling) on a `tile_size` x `tile_size` grid of cells,
+only when the tile is first requested:
+
+    tiles = TiledMesh(bee, tile_size=64)
+    tiles.tile('NO2', '2018-09-01', 14, 8107, 5107) # (64, 64) array, north row first
+
+The points of a tile (inside the city) and their static features are kept in an
+LRU cache, as are the predicted tiles. A tile whose four children (z+1) are all
+cached is derived from them, averaging each 2x2 block of child cells, without
+predicting again. Only the requested tiles are ever in memory. Tiles can be
+requested from several threads: the caches are locked only to look up and insert
+tiles, so a tile being predicted doesn't hold up the others.
+"""
+
+import warnings
+import threading
+import collections
+import numpy as np
+import pandas as pd
+
+import sensingbee.utils as utils
+import sensingbee.storage as storage
+
+
+# Web Mercator tile coordinates (z, x, y, as fractions of tiles) to lon/lat degrees.
+def tile_to_lonlat(z, x, y):
+    n = 2.0**z
+    lon = np.asarray(x, dtype=float)/n*360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi*(1 - 2*np.asarray(y, dtype=float)/n))))
+    return lon, lat
+
+# The tile (z, x, y) that contains a lon/lat point.
+def lonlat_to_tile(lon, lat, z):
+    n = 2**z
+    x = int((lon + 180.0)/360.0*n)
+    y = int((1 - np.arcsinh(np.tan(np.radians(lat)))/np.pi)/2*n)
+    return z, x, y
+
+# Centres of the tile_size x tile_size cells of a tile, as (tile_size, tile_size) lon/lat
+# arrays with the north row first. The cells are regular in the Mercator projection, so
+# the cells of a tile split exactly in 2x2 cells of its children.
+def tile_cells(z, x, y, tile_size):
+    offsets = (np.arange(tile_size) + 0.5)/tile_size
+    return tile_to_lonlat(z, x + offsets[None,:], y + offsets[:,None])
+
+
+class TiledMesh(object):
+    """
+    Lazily computed tiles of the interpolation of a fitted and trained Bee (see Bee.make_pointgrid
+    and Bee.interpolate_pointgrid). Cells out of the Geography's city are NaN. With `thresholds`
+    (a Series of OSM features' values, as the quantiles of Geography.delimit_meshgrid_by_quantiles),
+    cells with none of their features over them are also NaN. With `cache_folder`, the tiles' points
+    and static features are also stored on disk, to be reused across runs.
+    """
+    def __init__(self, bee, tile_size=64, max_zoom=18, cache_size=512, regressor=None, thresholds=None, cache_folder=None):
+        self.bee = bee
+        self.tile_size = tile_size
+        self.max_zoom = max_zoom
+        self.cache_size = cache_size
+        self.regressor = regressor
+        self.thresholds = thresholds
+        self.cache_folder = cache_folder
+        self.data = None
+        self.generation = 0
+        self.points_cache = collections.OrderedDict()
+        self.tiles_cache = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.computing = {}
+
+    # The (tile_size, tile_size) predictions of a variable at a timestamp in the tile z/x/y.
+    def tile(self, variable, timestamp, z, x, y):
+        timestamp = pd.to_datetime(timestamp)
+        with self.lock:
+            values = self._cached_or_derived(variable, timestamp, z, x, y)
+        if values is None:
+            values = self._cached(self.tiles_cache, (variable, timestamp, z, x, y),
+                                  lambda data: self._predict(variable, timestamp, z, x, y, data))
+        return values
+
+    # The cells of the tile z/x/y to be predicted (in the city and over the thresholds, if
+    # given) as a frame of their lon, lat, row, col, geometry and static features.
+    def tile_points(self, z, x, y):
+        return self._cached(self.points_cache, (z, x, y), lambda data: self._make_points(z, x, y))
+
+    # Replaces the sensors' data used for the predictions (default: Bee.sensors), evicting
+    # the predicted tiles. The tiles' points and static features are kept.
+    def update_data(self, data):
+        with self.lock:
+            self.data = data
+            self.generation += 1
+            self.tiles_cache.clear()
+        return self
+
+    # The predictions of a tile from the sensors' `data`, NaN out of its points.
+    def _predict(self, variable, timestamp, z, x, y, data):
+        values = np.full((self.tile_size, self.tile_size), np.nan, dtype=np.float32)
+        pointgrid = self.tile_points(z, x, y)
+        if len(pointgrid):
+            z_pred = self.bee.interpolate_pointgrid(pointgrid.drop(columns=['row','col']), [variable], timestamp, data)
+            z_pred = z_pred[self.regressor] if self.regressor is not None else z_pred
+            values[pointgrid['row'].values, pointgrid['col'].values] = z_pred[variable].values
+        return values
+
+    # The points of a tile (see tile_points), from the cache folder when stored there.
+    def _make_points(self, z, x, y):
+        path = None if self.cache_folder is None else storage.artifact_path(self.cache_folder, 'tile_{}_{}_{}'.format(z, x, y))
+        if path is not None and storage.exists(path):
+            pointgrid = storage.load_frame(path, mmap=False)
+        else:
+            lon, lat = tile_cells(z, x, y, self.tile_size)
+            rows, cols = np.indices(lon.shape)
+            cells = pd.DataFrame({'lon': lon.ravel(), 'lat': lat.ravel(), 'row': rows.ravel(), 'col': cols.ravel()})
+            cells = cells.loc[self._in_city_bounds(cells)]
+            pointgrid = self.bee.make_pointgrid(cells)
+            pointgrid = pointgrid.loc[utils.intersects(pointgrid, self.bee.geography.prepared_city)]
+            pointgrid[['row','col']] = cells.loc[pointgrid.index, ['row','col']]
+            if self.thresholds is not None and len(pointgrid):
+                pointgrid = pointgrid.loc[(pointgrid[self.thresholds.index] > self.thresholds).any(axis=1)]
+            if path is not None:
+                storage.save_frame(pointgrid, path)
+        return pointgrid
+
+    # The entry of a cache for a key, computed by `compute(data)` outside the lock on a miss.
+    # Concurrent misses of the same key wait on a lock of the key (in `computing`) and take
+    # the first one's result instead of computing it again. A tile predicted from data that
+    # update_data replaced meanwhile is returned but not cached.
+    def _cached(self, cache, key, compute):
+        with self.lock:
+            values = self._get(cache, key)
+            if values is not None:
+                return values
+            computing = self.computing.setdefault((id(cache), key), threading.Lock())
+        try:
+            with computing:
+                with self.lock:
+                    values, generation, data = self._get(cache, key), self.generation, self.data
+                if values is None:
+                    values = compute(data)
+                    with self.lock:
+                        if cache is not self.tiles_cache or self.generation == generation:
+                            self._put(cache, key, values)
+        finally:
+            with self.lock:
+                if self.computing.get((id(cache), key)) is computing:
+                    del self.computing[(id(cache), key)]
+        return values
+
+    def _in_city_bounds(self, cells):
+        minx, miny, maxx, maxy = self.bee.geography.city.total_bounds
+        return ((cells['lon'] >= minx) & (cells['lon'] <= maxx) & (cells['lat'] >= miny) & (cells['lat'] <= maxy)).values
+
+    # The cached tile or, when its four children are (recursively) available, the
+    # average of each 2x2 block of their cells.
+    def _cached_or_derived(self, variable, timestamp, z, x, y):
+        values = self._get(self.tiles_cache, (variable, timestamp, z, x, y))
+        if values is not None or z >= self.max_zoom:
+            return values
+        children = []
+        for dy in (0, 1):
+            for dx in (0, 1):
+                child = self._cached_or_derived(variable, timestamp, z+1, 2*x+dx, 2*y+dy)
+                if child is None:
+                    return None
+                children.append(child)
+        full = np.block([[children[0], children[1]], [children[2], children[3]]])
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning) # all-NaN blocks out of the city
+            values = np.nanmean(full.reshape(self.tile_size, 2, self.tile_size, 2), axis=(1, 3)).astype(np.float32)
+        self._put(self.tiles_cache, (variable, timestamp, z, x, y), values)
+        return values
+
+    def _get(self, cache, key):
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        return None
+
+    def _put(self, cache, key, value):
+        cache[key] = value
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
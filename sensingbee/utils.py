@@ -1,16 +1,41 @@
+import os
+import io
+import time
+import concurrent.futures
 import pandas as pd
 import numpy as np
 import urllib.request
+import urllib.error
 import json
 import geopandas as gpd
 import fiona
 import shapely
+from scipy.spatial import cKDTree
 
+import sensingbee.instrumentation as instrumentation
+from sensingbee.sensorstore import SensorStore
+
+
+DEPRIVATION_COLUMNS = ['Index of Multiple Deprivation (IMD) Score',
+                'Income Score (rate)',
+                'Employment Score (rate)',
+                'Education, Skills and Training Score',
+                'Crime Score',
+                'Barriers to Housing and Services Score',
+                'Living Environment Score',
+                'Total population: mid 2012 (excluding prisoners)',
+                'Population aged 16-59: mid 2012 (excluding prisoners)']
+
+# Calendar channels of the features at hourly (or finer), daily and weekly (or coarser)
+# frequencies, keyed by the lowercased alias, and the DatetimeIndex attribute each one is
+# read from ('week' is read from isocalendar(), as DatetimeIndex.week is gone in pandas 2).
+CALENDAR_COLUMNS = {'h': ['hour','dow','day'], 'd': ['dow','day','week'], 'w': ['week']}
+CALENDAR_ATTRIBUTES = {'hour': 'hour', 'dow': 'dayofweek', 'day': 'day'}
 
 def ingestion3(Sensors, variables, k=5, osmf=None, deprf=None ,freq='D'):
     idx = pd.IndexSlice
-    sens_names = Sensors.data.index.get_level_values(1).unique()
-    sens_times = Sensors.data.index.get_level_values(2).unique()
+    data = data_source(Sensors)
+    sens_names, sens_times = data_sensors_times(Sensors)
     zxcols = []
     for var in variables:
         [zxcols.append(var) for i in range(k)]
@@ -22,7 +47,7 @@ def ingestion3(Sensors, variables, k=5, osmf=None, deprf=None ,freq='D'):
         si = Sensors.sensors.loc[s]
         for t in sens_times:
             for var in variables:
-                sdf = Sensors.data.loc[idx[var,:,t]] # data of the var variable at  time t
+                sdf = data.frame_at(var,t) if isinstance(data, SensorStore) else data.xs((var,t), level=(0,2), drop_level=False) # data of the var variable at  time t
                 mdf = Sensors.sensors.loc[sdf.index.get_level_values(1).unique()] # sensors about them
                 #
                 dij = mdf['geometry'].apply(lambda x: si['geometry'].distance(x)).sort_values()
@@ -37,53 +62,426 @@ def ingestion3(Sensors, variables, k=5, osmf=None, deprf=None ,freq='D'):
                 dij = sdf.loc[idx[var,dij.index,t],:].join(dij, on="Sensor Name")
                 zx.loc[idx[si.name,t],'d_{}'.format(var)] = dij['geometry'].values
                 zx.loc[idx[si.name,t],var] = dij['Value'].values
-    if freq == 'H':
-        zx['hour'] = zx.index.get_level_values(1).hour
-        zx['dow'] = zx.index.get_level_values(1).dayofweek
-        zx['day'] = zx.index.get_level_values(1).day
-    elif freq == 'D':
-        zx['dow'] = zx.index.get_level_values(1).dayofweek
-        zx['day'] = zx.index.get_level_values(1).day
-        zx['week'] = zx.index.get_level_values(1).week
+    zx = join_static_features(zx, osmf, deprf, freq)
+    return zx, (data.frame(cache=False) if isinstance(data, SensorStore) else data).drop(times_without_enough_samples, level='Timestamp')
+
+# Vectorized replacement for ingestion3, producing the same zx/zi. The sensors'
+# coordinates are indexed once and, for each variable, the samples are laid out
+# in a (timestamp, sensor) matrix whose availability mask tells which sensors
+# have data at each time. Timestamps sharing the same availability mask share a
+# single KD-tree, and the k neighbours' values/distances are gathered for all of
+# them at once. Neighbours are ordered from the closest to the farthest.
+@instrumentation.timed('knn_ingestion', rows=lambda Sensors, result: len(result[0]))
+def knn_ingestion(Sensors, variables, k=5, osmf=None, deprf=None, freq='D'):
+    data = data_source(Sensors)
+    sens_names, sens_times = data_sensors_times(Sensors)
+    coords = sensors_coordinates(Sensors.sensors.loc[sens_names])
+    n_sens, n_times = len(sens_names), len(sens_times)
+    zxcols, channels = [], []
+    enough = np.ones(n_times, dtype=bool)
+    for var in variables:
+        [zxcols.append(var) for i in range(k)]
+        [zxcols.append('d_{}'.format(var)) for i in range(k)]
+        values, available = samples_matrix(data, var, sens_names, sens_times)
+        zv, zd, valid = knn_channels(coords, values, available, k, exclude_self=True)
+        enough &= valid.all(axis=1)
+        # (time, sensor, k) -> (sensor*time, k), as zx is indexed by (Sensor Name, Timestamp)
+        channels.append(zv.transpose(1,0,2).reshape(n_sens*n_times, k))
+        channels.append(zd.transpose(1,0,2).reshape(n_sens*n_times, k))
+    times_without_enough_samples = list(sens_times[~enough])
+    if times_without_enough_samples:
+        print('Warning: Not enough sensors for {} timestamps'.format(len(times_without_enough_samples)))
+        instrumentation.event('not_enough_sensors', timestamps=[str(t) for t in times_without_enough_samples])
+    zx = pd.DataFrame(np.hstack(channels) if channels else None,
+                      index=pd.MultiIndex.from_product([sens_names,sens_times],names=['Sensor Name','Timestamp']),
+                      columns=zxcols)
+    zx = join_static_features(zx, osmf, deprf, freq)
+    return zx, (data.frame(cache=False) if isinstance(data, SensorStore) else data).drop(times_without_enough_samples, level='Timestamp')
+
+# The samples of a Sensors object: its compact store if it has one (see Sensors.compact),
+# or else its data frame.
+def data_source(Sensors):
+    store = getattr(Sensors, 'store', None)
+    return store if store is not None else Sensors.data
+
+# The sensors' names and the timestamps with samples in a Sensors object, as Indexes. They
+# are read from the compact store's codes if there is one, without building the frame.
+def data_sensors_times(Sensors):
+    data = data_source(Sensors)
+    if isinstance(data, SensorStore):
+        return data.sensors_in_data(), data.times()
+    return data.index.get_level_values(1).unique(), data.index.get_level_values(2).unique()
+
+# Boolean mask of the rows of a MultiIndex whose value at `level` is in `values`,
+# computed on the level's codes instead of the (repeated) labels of every row.
+def level_isin(index, level, values):
+    return np.asarray(index.levels[level].isin(values))[np.asarray(index.codes[level])]
+
+# Boolean mask of the rows of an index with a Timestamp level (e.g. the training features)
+# at its last `periods` timestamps, or newer than `since`; all the rows if both are None.
+def recent_rows(index, periods=None, since=None):
+    times = pd.DatetimeIndex(index.get_level_values('Timestamp'))
+    mask = np.ones(len(index), dtype=bool)
+    if periods is not None:
+        mask &= np.asarray(times.isin(times.unique().sort_values()[-periods:]))
+    if since is not None:
+        mask &= np.asarray(times > since)
+    return mask
+
+# Returns a (n,2) array with the x/y (lon/lat) coordinates of a GeoDataFrame of points.
+def sensors_coordinates(pointdf):
+    return np.array([[p.x, p.y] for p in pointdf['geometry']], dtype=float).reshape(-1, 2)
+
+# Lays out the samples of a variable in a dense (timestamp, sensor) matrix.
+# Returns the values (NaN where missing) and the availability mask, i.e. whether
+# the sensor has a row in Sensors.data at that timestamp. `data` is the frame or
+# the compact store (see data_source), which only reads the samples at sens_times.
+def samples_matrix(data, var, sens_names, sens_times):
+    if isinstance(data, SensorStore):
+        return data.matrix(var, sens_names, sens_times)
+    values = np.full((len(sens_times), len(sens_names)), np.nan)
+    available = np.zeros((len(sens_times), len(sens_names)), dtype=bool)
+    if var not in data.index.get_level_values(0):
+        return values, available
+    vdata = data.xs(var, level=0)
+    s = sens_names.get_indexer(vdata.index.get_level_values(0))
+    t = sens_times.get_indexer(vdata.index.get_level_values(1))
+    keep = (s >= 0) & (t >= 0)
+    values[t[keep], s[keep]] = vdata['Value'].values[keep]
+    available[t[keep], s[keep]] = True
+    return values, available
+
+# Finds, for every query point and every timestamp, the k closest points among the
+# ones available at that timestamp. `coords` are the (n_sens,2) sensors coordinates,
+# `values`/`available` are (n_times, n_sens) matrixes as given by samples_matrix.
+# Query points default to the sensors themselves, in which case `exclude_self`
+# drops each sensor from its own neighbourhood. Returns the neighbours' values and
+# distances as (n_times, n_query, k) arrays, and a (n_times, n_query) mask telling
+# where at least k neighbours were found (channels are NaN elsewhere).
+def knn_channels(coords, values, available, k=5, query=None, exclude_self=False):
+    if query is None:
+        query = coords
+    n_times, n_query = available.shape[0], query.shape[0]
+    zv = np.full((n_times, n_query, k), np.nan)
+    zd = np.full((n_times, n_query, k), np.nan)
+    valid = np.zeros((n_times, n_query), dtype=bool)
+    if n_times == 0:
+        return zv, zd, valid
+    masks, mask_of_time = np.unique(available, axis=0, return_inverse=True)
+    mask_of_time = np.asarray(mask_of_time).ravel()
+    extra = 1 if exclude_self else 0
+    for m, mask in enumerate(masks):
+        members = np.flatnonzero(mask)
+        if len(members) == 0:
+            continue
+        times = np.flatnonzero(mask_of_time == m)
+        kq = min(k + extra, len(members))
+        dist, pos = cKDTree(coords[members]).query(query, k=kq)
+        dist, pos = dist.reshape(n_query, kq), pos.reshape(n_query, kq)
+        nbrs = members[pos]
+        if exclude_self:
+            is_self = nbrs == np.arange(n_query)[:,None]
+            order = np.argsort(is_self, axis=1, kind='mergesort') # self goes last
+            nbrs = nbrs[np.arange(n_query)[:,None], order]
+            dist = dist[np.arange(n_query)[:,None], order]
+            n_found = len(members) - mask
+        else:
+            n_found = np.full(n_query, len(members))
+        ok = n_found >= k
+        if not ok.any():
+            continue
+        rows = np.flatnonzero(ok)
+        zd[np.ix_(times, rows)] = dist[rows,:k]
+        zv[np.ix_(times, rows)] = values[times][:,nbrs[rows,:k]]
+        valid[np.ix_(times, rows)] = True
+    return zv, zd, valid
+
+# The calendar channels of features at a frequency (none for None): the hourly ones for
+# frequencies finer than a day, the daily ones up to a week and the weekly ones beyond.
+def calendar_columns(freq):
+    if freq is None:
+        return []
+    if isinstance(freq, str) and freq.lower() in CALENDAR_COLUMNS:
+        return CALENDAR_COLUMNS[freq.lower()]
+    try:
+        offset = pd.tseries.frequencies.to_offset(freq)
+    except ValueError: # aliases that recent pandas rejects in upper case, as 'H'
+        offset = pd.tseries.frequencies.to_offset(freq.lower())
+    if isinstance(offset, pd.tseries.offsets.Day):
+        period = pd.Timedelta(days=offset.n)
+    elif isinstance(offset, pd.tseries.offsets.Tick):
+        period = pd.Timedelta(offset.nanos)
+    else: # weeks, months etc
+        period = pd.Timedelta(days=7)
+    return CALENDAR_COLUMNS['h' if period < pd.Timedelta(days=1) else 'd' if period < pd.Timedelta(days=7) else 'w']
+
+# The values of a calendar channel (see CALENDAR_COLUMNS) for some timestamps.
+def calendar_values(timestamps, column):
+    timestamps = pd.DatetimeIndex(timestamps)
+    if column == 'week':
+        return np.asarray(timestamps.isocalendar()['week'], dtype=np.int64)
+    return np.asarray(getattr(timestamps, CALENDAR_ATTRIBUTES[column]))
+
+# Adds the calendar channels for the given frequency and joins the OSM and
+# deprivation features (indexed by sensor) to a (Sensor Name, Timestamp) matrix.
+def join_static_features(zx, osmf=None, deprf=None, freq='D'):
+    for column in calendar_columns(freq):
+        zx[column] = calendar_values(zx.index.get_level_values(1), column)
     if osmf is not None:
         zx = zx.reset_index(level=1).join(osmf).set_index('Timestamp', append=True)
     if deprf is not None:
-        zx = zx.reset_index(level=1).join(deprf[['Index of Multiple Deprivation (IMD) Score',
-                'Income Score (rate)',
-                'Employment Score (rate)',
-                'Education, Skills and Training Score',
-                'Crime Score',
-                'Barriers to Housing and Services Score',
-                'Living Environment Score',
-                'Total population: mid 2012 (excluding prisoners)',
-                'Population aged 16-59: mid 2012 (excluding prisoners)']]).set_index('Timestamp', append=True)
-    return zx, Sensors.data.drop(times_without_enough_samples, level='Timestamp')
+        zx = zx.reset_index(level=1).join(deprf[DEPRIVATION_COLUMNS]).set_index('Timestamp', append=True)
+    return zx
 
-def mesh_ingestion(Sensors, meshgrid, variables, timestamp):
-    idx = pd.IndexSlice
+def mesh_ingestion(Sensors, meshgrid, variables, timestamp, freq='D'):
     timestamp = pd.to_datetime(timestamp)
-    zxcols = []
+    zmesh, times, columns = batch_mesh_ingestion(Sensors, meshgrid, variables, [timestamp], freq=freq)
+    return pd.DataFrame(zmesh[0], index=meshgrid.index, columns=columns)
+
+# Ingests the meshgrid features for all the given timestamps (default: all
+# timestamps in Sensors.data) in one pass. For every timestamp and variable, the
+# k closest sensors with data are found for all the mesh cells at once (see
+# knn_channels). The calendar channels are the ones of zx at the frequency `freq`.
+# Returns a dense (timestamp, cell, channel) array, the timestamps and the
+# channels' names, that mesh_frame wraps as the (Timestamp, cell) frame.
+@instrumentation.timed('mesh_ingestion', rows=lambda Sensors, result: result[0].shape[0]*result[0].shape[1])
+def batch_mesh_ingestion(Sensors, meshgrid, variables, timestamps=None, k=5, freq='D'):
+    sens_names, sens_times = data_sensors_times(Sensors)
+    if timestamps is None:
+        timestamps = sens_times
+    timestamps = pd.DatetimeIndex(pd.to_datetime(timestamps)).unique()
+    coords = sensors_coordinates(Sensors.sensors.loc[sens_names])
+    query = sensors_coordinates(meshgrid)
+    columns, channels = [], []
     for var in variables:
-        [zxcols.append(var.split('.')[0]) for i in range(5)]
-        [zxcols.append('d_{}'.format(var.split('.')[0])) for i in range(5)]
-    zmesh = pd.DataFrame(index=meshgrid.index, columns=zxcols)
-    def loop_var(i):
-        values = []
-        for var in variables:
-            st = Sensors.data.loc[idx[var,:,timestamp]]
-            closest = Sensors.sensors.loc[st.index.get_level_values(1),'geometry'].apply(lambda x: x.distance(i['geometry'])).nsmallest(5)
-            closest = st.loc[idx[var,closest.index,timestamp],:].join(closest, on='Sensor Name')
-
-            values += list(closest['Value'].values)
-            values += list(closest['geometry'].values)
-        zmesh.loc[i.name] = values
-    meshgrid.apply(lambda x: loop_var(x), axis=1)
-
-    zmesh['dow'] = timestamp.dayofweek
-    zmesh['day'] = timestamp.day
-    zmesh = zmesh.join(meshgrid[meshgrid.columns[~meshgrid.columns.isin(['lat','lon','geometry'])]])
-    return zmesh
+        columns += [var]*k + ['d_{}'.format(var)]*k
+        values, available = samples_matrix(data_source(Sensors), var, sens_names, timestamps)
+        zv, zd, valid = knn_channels(coords, values, available, k, query=query)
+        channels += [zv, zd]
+    static = meshgrid.columns[~meshgrid.columns.isin(['lat','lon','geometry'])]
+    columns += calendar_columns(freq) + list(static)
+    shape = (len(timestamps), len(meshgrid), 1)
+    for column in calendar_columns(freq):
+        channels.append(np.broadcast_to(calendar_values(timestamps, column).astype(float)[:,None,None], shape))
+    channels.append(np.broadcast_to(meshgrid[static].values.astype(float)[None], shape[:2]+(len(static),)))
+    return np.concatenate(channels, axis=2), timestamps, columns
+
+# Wraps a (timestamp, cell, channel) array from batch_mesh_ingestion as the
+# frame indexed by (Timestamp, cell) that Features.mesh_ingestion returns.
+def mesh_frame(zmesh, timestamps, meshgrid_index, columns):
+    index = pd.MultiIndex.from_product([timestamps, meshgrid_index], names=['Timestamp', meshgrid_index.name])
+    return pd.DataFrame(zmesh.reshape(-1, zmesh.shape[2]), index=index, columns=columns)
+
+# Spatial index answering the distance from many points to the closest of a set of
+# geometries (points, lines or multi-parts of them). The geometries are broken into
+# segments (points as zero-length ones), long segments are split so that none is
+# longer than `max_segment`, and a KD-tree is built over the segments' midpoints.
+# The distance to the closest midpoint bounds the answer from above, so only the
+# segments whose midpoint is within that bound plus the largest half-length can
+# be the closest one, and the exact point-to-segment distance is computed for them.
+class NearestGeometryIndex(object):
+    def __init__(self, geometries, max_segment=None, candidates=16):
+        starts, ends = [], []
+        for g in geometries:
+            for part in getattr(g, 'geoms', [g]):
+                xy = np.asarray(part.exterior.coords if hasattr(part, 'exterior') else part.coords, dtype=float)
+                if len(xy) == 1:
+                    xy = np.vstack([xy, xy])
+                starts.append(xy[:-1])
+                ends.append(xy[1:])
+        self.size = len(starts)
+        if self.size == 0:
+            return
+        a, b = np.vstack(starts), np.vstack(ends)
+        length = np.hypot(*(b-a).T)
+        if max_segment is None:
+            max_segment = np.median(length[length>0]) if np.any(length>0) else 0
+        if max_segment > 0 and length.max() > max_segment:
+            pieces = np.maximum(np.ceil(length/max_segment).astype(int), 1)
+            seg = np.repeat(np.arange(len(a)), pieces)
+            first = np.repeat(np.cumsum(pieces)-pieces, pieces)
+            f0 = (np.arange(len(seg))-first)/pieces[seg]
+            f1 = (np.arange(len(seg))-first+1)/pieces[seg]
+            a, b = a[seg] + f0[:,None]*(b-a)[seg], a[seg] + f1[:,None]*(b-a)[seg]
+            length = np.hypot(*(b-a).T)
+        self.a, self.b = a, b
+        self.half = length.max()/2
+        self.candidates = min(candidates, len(a))
+        self.tree = cKDTree((a+b)/2)
+
+    # Exact distance from each of the (n,2) coordinates to the closest geometry
+    # (NaN for an empty index).
+    def distance(self, coords):
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        if self.size == 0:
+            return np.full(len(coords), np.nan)
+        d = np.full(len(coords), np.inf)
+        unsure, k = np.arange(len(coords)), self.candidates
+        while len(unsure):
+            dmid, cand = self.tree.query(coords[unsure], k=k)
+            dmid, cand = dmid.reshape(len(unsure), -1), cand.reshape(len(unsure), -1)
+            d[unsure] = self.segment_distance(coords[unsure][:,None,:], cand).min(axis=1)
+            if k == len(self.a):
+                break
+            # while the farthest candidate midpoint is not beyond the bound, a segment
+            # outside the candidates could still be closer: look at more of them
+            unsure = unsure[dmid[:,-1] <= d[unsure] + self.half]
+            k = min(4*k, len(self.a))
+        return d
+
+    def segment_distance(self, p, seg):
+        a, ab = self.a[seg], self.b[seg] - self.a[seg]
+        den = (ab**2).sum(axis=-1)
+        t = np.clip(((p-a)*ab).sum(axis=-1)/np.where(den>0, den, 1), 0, 1)
+        return np.hypot(*np.moveaxis(p - (a + t[...,None]*ab), -1, 0))
+
+# Labels timestamps with the bin they fall in when resampled by `frequency`, the same
+# way pd.Grouper(freq=frequency, origin=origin) labels them: fixed frequencies (H, D,
+# 15T ...) are labelled by the start of the bin, counted from the `origin` ('epoch',
+# 'start_day' for the day of the first timestamp, or a timestamp), and calendar ones
+# ending a period (W, M, Q, A) by that end.
+def frequency_bins(timestamps, frequency, origin='start_day'):
+    offset = pd.tseries.frequencies.to_offset(frequency)
+    timestamps = pd.DatetimeIndex(timestamps)
+    if isinstance(offset, (pd.tseries.offsets.Tick, pd.tseries.offsets.Day)):
+        period = offset.n*86400*10**9 if isinstance(offset, pd.tseries.offsets.Day) else offset.nanos
+        if origin is None or origin == 'start_day':
+            origin = timestamps.min().normalize()
+        else:
+            origin = pd.Timestamp(0) if origin == 'epoch' else pd.Timestamp(origin)
+        ns = timestamps.values.astype('datetime64[ns]').view('i8') - origin.value
+        return pd.DatetimeIndex((ns // period * period + origin.value).view('datetime64[ns]'))
+    days = timestamps.normalize()
+    unique_days = days.unique()
+    if offset.rule_code.split('-')[0] in ('M','A','Q','BM','BA','BQ','W','ME','YE','QE','BME','BYE','BQE'):
+        labels = pd.DatetimeIndex([offset.rollforward(d) for d in unique_days])
+    else:
+        labels = pd.DatetimeIndex([offset.rollback(d) for d in unique_days])
+    return labels[unique_days.get_indexer(days)]
+
+# Median of the `values` weighted by `weights`.
+def weighted_median(values, weights):
+    order = np.argsort(values)
+    values, weights = np.asarray(values)[order], np.asarray(weights)[order]
+    cumulative = np.cumsum(weights)
+    return values[np.searchsorted(cumulative, cumulative[-1]/2.)]
+
+def _median_count(df):
+    return df.groupby(['Variable','Sensor Name','Timestamp'])['Value'].agg(['median','count'])
+
+# Reads a data.csv (columns Variable, Sensor Name, Timestamp and Value) in chunks of
+# `chunksize` rows, keeping only the given variables and sensors, and resamples it to
+# `frequency` by the median as it goes, so memory is bounded by the chunk size and the
+# resampled output instead of the size of the file. A (variable, sensor, bin) group is
+# aggregated once a later bin of the same variable/sensor is read, so the median is
+# exact whenever each sensor's samples are in chronological order, whatever the order
+# between sensors. Samples arriving after their group was aggregated are aggregated
+# apart, and the group's value becomes the median of the partial medians weighted by
+# their number of samples (an approximation, reported with a warning). The bins of fixed
+# frequencies are counted from `origin` (see frequency_bins), which can't depend on the
+# data (as 'start_day' would on the first chunk), so that they don't depend on the order
+# of the samples in the file.
+# Returns the resampled data, indexed by (Variable, Sensor Name, Timestamp) like
+# Sensors.data, and the sensors' names in the order they first appear in the file.
+@instrumentation.timed('read_resampled_csv', rows=lambda path, result: len(result[0]))
+def read_resampled_csv(path, variables, sensor_names, frequency, chunksize=1000000, origin='epoch'):
+    if origin is None or origin == 'start_day':
+        raise ValueError("The origin of the bins of a chunked resampling can't be 'start_day'")
+    pending, partials = None, []
+    latest, approximate = None, False
+    seen = pd.Index([])
+    for chunk in pd.read_csv(path, usecols=['Variable','Sensor Name','Timestamp','Value'], chunksize=chunksize):
+        chunk = chunk.loc[chunk['Variable'].isin(variables) & chunk['Sensor Name'].isin(sensor_names)]
+        if chunk.shape[0] == 0:
+            continue
+        new_sensors = pd.unique(chunk['Sensor Name'])
+        seen = seen.append(pd.Index(new_sensors[~pd.Index(new_sensors).isin(seen)]))
+        timestamps = pd.to_datetime(chunk['Timestamp'])
+        chunk = chunk.assign(Timestamp=frequency_bins(timestamps, frequency, origin).values)
+        keys = pd.MultiIndex.from_arrays([chunk['Variable'], chunk['Sensor Name']])
+        if latest is not None and np.any(chunk['Timestamp'].values < latest.reindex(keys).values):
+            approximate = True
+        chunk_latest = chunk.groupby(['Variable','Sensor Name'])['Timestamp'].max()
+        latest = chunk_latest if latest is None else pd.concat([latest, chunk_latest]).groupby(level=[0,1]).max()
+        pending = chunk if pending is None else pd.concat([pending, chunk])
+        keys = pd.MultiIndex.from_arrays([pending['Variable'], pending['Sensor Name']])
+        still_open = pending['Timestamp'].values >= latest.reindex(keys).values
+        partials.append(_median_count(pending.loc[~still_open]))
+        pending = pending.loc[still_open]
+    if pending is not None:
+        partials.append(_median_count(pending))
+    if len(partials) == 0:
+        index = pd.MultiIndex.from_arrays([[],[],pd.DatetimeIndex([])], names=['Variable','Sensor Name','Timestamp'])
+        return pd.DataFrame({'Value': []}, index=index), seen
+    partials = pd.concat(partials)
+    split = partials.index.duplicated(keep=False)
+    if approximate and split.any():
+        print('Warning: samples out of chronological order in {}, medians of {} groups were approximated'.format(
+                path, len(partials.loc[split].index.unique())))
+    data = partials.loc[~split, 'median']
+    if split.any():
+        data = pd.concat([data, partials.loc[split].groupby(level=[0,1,2]).apply(
+                    lambda g: weighted_median(g['median'].values, g['count'].values))])
+    data = data.to_frame('Value').sort_index()
+    data.index.names = ['Variable','Sensor Name','Timestamp']
+    return data, seen
 
+# Splits the window from start_time to end_time (dates, as 'YYYY-MM-DD') in chunks of
+# chunk_days days and, unless by_variable is False, of one variable each, as the
+# (start, end, variable) query parameters of the Urban Observatory raw csv API. The
+# last chunk ends as the single request of Sensors(mode='get') did (at 00:59:59 of
+# end_time), the others one second before the next one starts.
+def fetch_chunks(start_time, end_time, variables, chunk_days=1, by_variable=True):
+    days = pd.date_range(pd.to_datetime(start_time), pd.to_datetime(end_time), freq='{}D'.format(chunk_days))
+    groups = [[v] for v in variables] if by_variable else [variables]
+    chunks = []
+    for i, day in enumerate(days):
+        if i+1 < len(days):
+            end = (days[i+1] - pd.Timedelta(seconds=1)).strftime('%Y%m%d%H%M%S')
+        else:
+            end = pd.to_datetime(end_time).strftime('%Y%m%d') + '005959'
+        for group in groups:
+            chunks.append((day.strftime('%Y%m%d%H%M%S'), end, '-and-'.join(group).lower()))
+    return chunks
+
+# Downloads and parses a chunk of the raw csv API, retrying up to `retries` times on
+# network errors, timeouts and 5xx/429 responses, with exponential backoff (backoff,
+# 2*backoff, ... seconds). An empty response is an empty frame.
+def fetch_csv_chunk(url, chunk, retries=3, backoff=1.0, timeout=60):
+    start, end, variable = chunk
+    query = '{}?start_time={}&end_time={}&variable={}'.format(url, start, end, variable)
+    for attempt in range(retries+1):
+        try:
+            with urllib.request.urlopen(query, timeout=timeout) as response:
+                body = response.read()
+            break
+        except urllib.error.HTTPError as e:
+            if (e.code < 500 and e.code != 429) or attempt == retries:
+                raise
+        except OSError: # URLError, timeouts and connection errors
+            if attempt == retries:
+                raise
+        time.sleep(backoff * 2**attempt)
+    try:
+        return pd.read_csv(io.BytesIO(body))
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame()
+
+# Fetches the raw csv API for a time window in chunks (see fetch_chunks) downloaded by
+# n_jobs threads, each one parsing its chunk while the others are still downloading.
+# Returns the chunks concatenated in time order, as the single request would.
+@instrumentation.timed('fetch_csv', rows=lambda url, result: len(result))
+def fetch_csv(url, start_time, end_time, variables, chunk_days=1, by_variable=True, n_jobs=8, retries=3, backoff=1.0, timeout=60):
+    chunks = fetch_chunks(start_time, end_time, variables, chunk_days, by_variable)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [executor.submit(fetch_csv_chunk, url, chunk, retries, backoff, timeout) for chunk in chunks]
+        frames = [f.result() for f in futures]
+    frames = [f for f in frames if len(f)]
+    if not frames:
+        return pd.DataFrame(columns=['Variable','name','Timestamp','Value','type','active','lon','lat'])
+    return pd.concat(frames, ignore_index=True).drop_duplicates()
+
+@instrumentation.timed('pull_osm_objects', rows=lambda bbox, result: len(result[0])+len(result[1]))
 def pull_osm_objects(bbox, line_objs, point_objs):
     points_query_string = ''.join(["node[\"highway\"=\"{}\"]{};".format(i,bbox) for i in point_objs])
     osm_points = "[out:json][timeout:100];({});out+geom;".format(points_query_string)
@@ -120,13 +518,129 @@ def pull_osm_objects(bbox, line_objs, point_objs):
     lines = gpd.GeoDataFrame(lines,crs={'init': 'epsg:4326'}).to_crs(fiona.crs.from_epsg(4326))
     return lines, points
 
-def pull_depr_sensors(sensors):
-    lsoa_path = '/home/adelsondias/Repos/newcastle/air-quality/shape/Lower_Layer_Super_Output_Areas_December_2011_Full_Extent__Boundaries_in_England_and_Wales/Lower_Layer_Super_Output_Areas_December_2011_Full_Extent__Boundaries_in_England_and_Wales.shp'
+# Reads the objects of a shapefile, only the ones whose bounds intersect `bbox` (an
+# Overpass-style "(south,west,north,east)" in lat/lon, transformed to the shapefile's
+# CRS) if given, and only the ones whose `column` contains `label` if given.
+def read_shapefile(path, bbox=None, column=None, label=None):
+    import re
+    import fiona.transform
+    with fiona.open(path) as source:
+        features = source
+        if bbox is not None:
+            south, west, north, east = parse_bbox(bbox)
+            xs, ys = fiona.transform.transform(fiona.crs.from_epsg(4326), source.crs,
+                                               [west, east, east, west], [south, south, north, north])
+            features = source.filter(bbox=(min(xs), min(ys), max(xs), max(ys)))
+        if column is not None and label is not None:
+            features = [f for f in features if re.search(label, str(f['properties'][column]))]
+        shapes = gpd.GeoDataFrame.from_features(list(features), crs=source.crs)
+    return shapes
+
+# Boolean mask telling which geometries of a GeoDataFrame intersect `geometry`
+# (preferably a prepared one, see shapely.prepared).
+def intersects(gdf, geometry):
+    return np.array([geometry.intersects(g) for g in gdf['geometry']], dtype=bool).reshape(-1)
+
+# Executor running each task as soon as it is submitted, for the 'serial' backend.
+class SerialExecutor(object):
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+# Returns an executor for the backend: 'serial', 'threads' or 'processes', the
+# last two with n_jobs workers (default: the number of CPUs).
+def get_executor(backend='serial', n_jobs=None):
+    if backend == 'serial':
+        return SerialExecutor()
+    elif backend == 'threads':
+        return concurrent.futures.ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count())
+    elif backend == 'processes':
+        return concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs or os.cpu_count())
+    raise ValueError('Unknown backend: {}'.format(backend))
+
+# Parses an Overpass-style bounding box "(south,west,north,east)".
+def parse_bbox(bbox):
+    south, west, north, east = [float(i) for i in bbox.strip('()').split(',')]
+    return south, west, north, east
+
+# Reads the OpenStreetMaps highway objects from a local extract instead of the
+# Overpass API, returning (lines, points) as pull_osm_objects does. It supports
+# OSM XML files (.osm), for which the Overpass query is reproduced (nodes of
+# point_objs types in the bbox; ways of line_objs types in the bbox plus the
+# ways sharing nodes with them), and GeoJSON files, whose Point/LineString
+# features are kept when their "highway" property is one of the types (or its
+# "_link" variant, for lines) and they intersect the bbox.
+@instrumentation.timed('read_osm_file', rows=lambda path, result: len(result[0])+len(result[1]))
+def read_osm_file(path, bbox, line_objs, point_objs):
+    south, west, north, east = parse_bbox(bbox)
+    box = shapely.geometry.box(west, south, east, north)
+    points, lines = [], []
+    if path.lower().endswith('.json') or path.lower().endswith('.geojson'):
+        with open(path) as f:
+            features = json.load(f)['features']
+        for feature in features:
+            highway = (feature.get('properties') or {}).get('highway', '')
+            geometry = shapely.geometry.shape(feature['geometry'])
+            if not geometry.intersects(box):
+                continue
+            if geometry.geom_type == 'Point' and highway in point_objs:
+                points.append({'geometry': geometry, 'highway': highway})
+            elif geometry.geom_type == 'LineString' and highway.replace('_link','') in line_objs:
+                lines.append({'geometry': geometry, 'highway': highway})
+    else:
+        import xml.etree.ElementTree as ET
+        nodes, ways = {}, []
+        for event, elem in ET.iterparse(path):
+            if elem.tag == 'node':
+                lon, lat = float(elem.get('lon')), float(elem.get('lat'))
+                nodes[elem.get('id')] = (lon, lat)
+                tags = {t.get('k'): t.get('v') for t in elem.findall('tag')}
+                if tags.get('highway') in point_objs and south <= lat <= north and west <= lon <= east:
+                    points.append({'geometry': shapely.geometry.Point([lon, lat]), 'highway': tags['highway']})
+                elem.clear()
+            elif elem.tag == 'way':
+                tags = {t.get('k'): t.get('v') for t in elem.findall('tag')}
+                ways.append(([nd.get('ref') for nd in elem.findall('nd')], tags.get('highway', '')))
+                elem.clear()
+        inside = lambda ref: ref in nodes and west <= nodes[ref][0] <= east and south <= nodes[ref][1] <= north
+        selected = set(i for i, (refs, highway) in enumerate(ways)
+                       if highway in line_objs and any(inside(ref) for ref in refs))
+        shared = set(ref for i in selected for ref in ways[i][0])
+        for i, (refs, highway) in enumerate(ways):
+            if i in selected or any(ref in shared for ref in refs):
+                coords = [nodes[ref] for ref in refs if ref in nodes]
+                if len(coords) >= 2:
+                    lines.append({'geometry': shapely.geometry.LineString(coords), 'highway': highway})
+    points = gpd.GeoDataFrame(points, columns=['geometry','highway'], crs={'init': 'epsg:4326'}).to_crs(fiona.crs.from_epsg(4326))
+    lines = gpd.GeoDataFrame(lines, columns=['geometry','highway'], crs={'init': 'epsg:4326'}).to_crs(fiona.crs.from_epsg(4326))
+    return lines, points
+
+# Joins the sensors with the deprivation covariates of the LSOA (shapefile at lsoa_path)
+# they are in, read from the deprivation csv at deprivation_path.
+@instrumentation.timed('pull_depr_sensors', rows=lambda sensors, result: len(result))
+def pull_depr_sensors(sensors, lsoa_path=None, deprivation_path=None):
+    if lsoa_path is None:
+        lsoa_path = '/home/adelsondias/Repos/newcastle/air-quality/shape/Lower_Layer_Super_Output_Areas_December_2011_Full_Extent__Boundaries_in_England_and_Wales/Lower_Layer_Super_Output_Areas_December_2011_Full_Extent__Boundaries_in_England_and_Wales.shp'
+    if deprivation_path is None:
+        deprivation_path = '/home/adelsondias/Downloads/deprivation.csv'
     city = gpd.read_file(lsoa_path)
     city = city[city['lsoa11nm'].str.contains('Newcastle upon Tyne')]
     city = city.to_crs(fiona.crs.from_epsg(4326))
     city.crs = {'init': 'epsg:4326', 'no_defs': True}
-    df = pd.read_csv('/home/adelsondias/Downloads/deprivation.csv')
+    df = pd.read_csv(deprivation_path)
     df = df[df['Local Authority District name (2013)'].str.contains('Newcastle')]
     dep_df = df.set_index('LSOA name (2011)').join(city.set_index('lsoa11nm'))
     dep_df = dep_df.dropna()
@@ -140,5 +654,5 @@ def pull_depr_sensors(sensors):
                 'Total population: mid 2012 (excluding prisoners)',
                 'Population aged 16-59: mid 2012 (excluding prisoners)',
                 'lsoa11cd', 'lsoa11nmw','geometry']])
-    dep_sensors = gpd.sjoin(sensors.sensors,dep_df,how='inner', op='intersects')
+    dep_sensors = gpd.sjoin(sensors.sensors,dep_df,how='inner', predicate='intersects')
     return dep_sensors